@@ -1,104 +1,803 @@
 ''' Library of common AWS S3 functions
 '''
 
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import csv
 import datetime
+import gzip
+import heapq
+import io
+import itertools
+import json
+from operator import attrgetter
+import os
+import queue
+import re
+import sqlite3
+import string
+import tempfile
+import threading
+import time
+from urllib.parse import unquote_plus
 import boto3
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
 from botocore.exceptions import ClientError
+from botocore.session import get_session
+try:
+    # ORC and Parquet inventory reports need pyarrow
+    import pyarrow.orc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Characters used to split a prefix into key ranges (in S3 listing order)
+SHARD_CHARS = string.digits + string.ascii_uppercase + string.ascii_lowercase
+# Listing pages each shard of a parallel listing buffers ahead of the merge
+SHARD_PAGES = 2
+# Compact (tuple-backed) record for a listed object
+ObjectRecord = namedtuple("ObjectRecord", ["key", "size", "etag", "last_modified"])
+# boto3's default session is not thread-safe, so client creation is serialized
+CLIENT_LOCK = threading.Lock()
+# Shared ClientRegistry (see get_registry)
+REGISTRY = None
+# get_metric_data accepts up to 500 queries per call
+MAX_METRIC_QUERIES = 500
+# S3 Inventory report folders are named for their creation time
+INVENTORY_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z$")
+# ORC and Parquet inventory column names for CSV schema fields
+INVENTORY_COLUMNS = {"Key": "key", "Size": "size", "ETag": "e_tag",
+                     "LastModifiedDate": "last_modified_date", "IsLatest": "is_latest",
+                     "IsDeleteMarker": "is_delete_marker"}
+
+
+class ClientRegistry:
+    ''' Shared boto3 clients and resources (one per service and region) built from a
+        single session, so that every caller reuses the same warm connection pools.
+        With a role ARN, the session's credentials come from STS AssumeRole and are
+        refreshed automatically before they expire.
+    '''
+    def __init__(self, session=None, role_arn=None, session_name="hortacloud-utilities",
+                 duration=3600, max_pool_connections=10):
+        ''' Create a registry
+            Keyword arguments:
+              session: boto3 Session (defaults to the default session, whichever it is
+                       when a client is requested)
+              role_arn: ARN of a role to assume
+              session_name: role session name
+              duration: assumed role credential lifetime in seconds
+              max_pool_connections: minimum connection pool size for each client
+        '''
+        self.role_arn = role_arn
+        self.session_name = session_name
+        self.duration = duration
+        self.max_pool_connections = max_pool_connections
+        self.clients = {}
+        self.resources = {}
+        self._session = session
+        if role_arn:
+            self._session = self._assume_role(session or boto3.session.Session())
+
+    def _assume_role(self, base):
+        ''' Return a session with refreshable assumed role credentials. The role is
+            assumed immediately, so errors are raised here rather than on first use.
+            Keyword arguments:
+              base: boto3 Session used to call STS
+            Returns:
+              boto3 Session
+        '''
+        sts = base.client('sts')
+
+        def refresh():
+            creds = sts.assume_role(RoleArn=self.role_arn, RoleSessionName=self.session_name,
+                                    DurationSeconds=self.duration)['Credentials']
+            return {"access_key": creds['AccessKeyId'], "secret_key": creds['SecretAccessKey'],
+                    "token": creds['SessionToken'],
+                    "expiry_time": creds['Expiration'].isoformat()}
+
+        credentials = RefreshableCredentials.create_from_metadata(
+            metadata=refresh(), refresh_using=refresh, method="sts-assume-role")
+        botocore_session = get_session()
+        botocore_session._credentials = credentials # pylint: disable=W0212
+        return boto3.session.Session(botocore_session=botocore_session,
+                                     region_name=base.region_name)
+
+    @property
+    def session(self):
+        ''' boto3 Session that clients are built from
+        '''
+        if self._session:
+            return self._session
+        if not boto3.DEFAULT_SESSION:
+            boto3.setup_default_session()
+        return boto3.DEFAULT_SESSION
+
+    def client(self, service, region=None, workers=0):
+        ''' Return a shared client. A client is rebuilt with a larger connection
+            pool when more workers than its pool allows will use it.
+            Keyword arguments:
+              service: service name
+              region: AWS region (defaults to the session's region)
+              workers: number of concurrent workers that will use the client
+            Returns:
+              boto3 client
+        '''
+        pool = max(self.max_pool_connections, workers)
+        with CLIENT_LOCK:
+            session = self.session
+            # Clients are tied to the session, which changes when a profile is selected
+            key = (session, service, region)
+            if key not in self.clients or self.clients[key][0] < pool:
+                self.clients[key] = (pool, session.client(
+                    service, region_name=region, config=Config(max_pool_connections=pool)))
+            return self.clients[key][1]
+
+    def resource(self, service, region=None):
+        ''' Return a shared resource
+            Keyword arguments:
+              service: service name
+              region: AWS region (defaults to the session's region)
+            Returns:
+              boto3 resource
+        '''
+        with CLIENT_LOCK:
+            session = self.session
+            key = (session, service, region)
+            if key not in self.resources:
+                self.resources[key] = session.resource(
+                    service, region_name=region,
+                    config=Config(max_pool_connections=self.max_pool_connections))
+            return self.resources[key]
+
+
+class ListingCache:
+    ''' Persistent cache of object listings (key, size, ETag, LastModified),
+        stored in SQLite and keyed by bucket and prefix
+    '''
+    def __init__(self, path, ttl=86400):
+        ''' Open (and create if necessary) a listing cache
+            Keyword arguments:
+              path: SQLite file path
+              ttl: seconds before a cached listing expires (0 to never expire)
+        '''
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS listing (bucket TEXT, prefix TEXT, fetched REAL,
+                                                PRIMARY KEY (bucket, prefix));
+            CREATE TABLE IF NOT EXISTS object (bucket TEXT, prefix TEXT, key TEXT,
+                                               size INTEGER, etag TEXT, last_modified REAL,
+                                               PRIMARY KEY (bucket, prefix, key));
+        ''')
+
+    def get(self, bucket, prefix):
+        ''' Return a cached listing
+            Keyword arguments:
+              bucket: bucket name
+              prefix: prefix
+            Returns:
+              List of ObjectRecords, or None if the listing is not cached or has expired
+        '''
+        with self.lock:
+            row = self.conn.execute("SELECT fetched FROM listing WHERE bucket=? AND prefix=?",
+                                    (bucket, prefix)).fetchone()
+            if not row or (self.ttl and time.time() - row[0] > self.ttl):
+                return None
+            rows = self.conn.execute("SELECT key,size,etag,last_modified FROM object "
+                                     + "WHERE bucket=? AND prefix=? ORDER BY key",
+                                     (bucket, prefix)).fetchall()
+        return [ObjectRecord(key, size, etag,
+                             datetime.datetime.fromtimestamp(mod, datetime.timezone.utc)
+                             if mod is not None else None)
+                for key, size, etag, mod in rows]
+
+    def put(self, bucket, prefix, records, probed=False):
+        ''' Replace the cached listing for a prefix
+            Keyword arguments:
+              bucket: bucket name
+              prefix: prefix
+              records: ObjectRecord iterable
+              probed: the listing was updated from a probe rather than fully re-listed
+                      (the time of the last full listing is kept, so the TTL still
+                      bounds changes that probes can't see)
+            Returns:
+              None
+        '''
+        rows = [(bucket, prefix, rec.key, rec.size, rec.etag,
+                 rec.last_modified.timestamp() if rec.last_modified else None)
+                for rec in records]
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM object WHERE bucket=? AND prefix=?", (bucket, prefix))
+            self.conn.executemany("INSERT INTO object VALUES (?,?,?,?,?,?)", rows)
+            if not probed:
+                self.conn.execute("INSERT OR REPLACE INTO listing VALUES (?,?,?)",
+                                  (bucket, prefix, time.time()))
+
+    def invalidate(self, bucket, prefix=""):
+        ''' Drop cached listings for every prefix that starts with a given prefix
+            Keyword arguments:
+              bucket: bucket name
+              prefix: prefix
+            Returns:
+              Number of listings dropped
+        '''
+        where = "bucket=? AND substr(prefix, 1, ?)=?"
+        with self.lock, self.conn:
+            self.conn.execute(f"DELETE FROM object WHERE {where}", (bucket, len(prefix), prefix))
+            return self.conn.execute(f"DELETE FROM listing WHERE {where}",
+                                     (bucket, len(prefix), prefix)).rowcount
+
+    def close(self):
+        ''' Close the cache
+        '''
+        self.conn.close()
+
 
 # *****************************************************************************
 # * Internal routines                                                         *
 # *****************************************************************************
 
 def _cloudwatch(region):
-    ''' Return a Cloudwatch accessor for a region
+    ''' Return a Cloudwatch accessor for a region (one client is shared per region)
         Keyword arguments:
           region: AWS region
         Returns:
           Cloudwatch accessor
     '''
-    return boto3.client('cloudwatch', region_name=region)
+    return get_registry().client('cloudwatch', region)
+
+
+def _bucket_regions(s3c, names):
+    ''' Return the region of each bucket
+        Keyword arguments:
+          s3c: S3 client
+          names: bucket names
+        Returns:
+          Dictionary of regions keyed by bucket name
+    '''
+    def location(name):
+        try:
+            region = s3c.get_bucket_location(Bucket=name).get("LocationConstraint")
+        except ClientError:
+            region = None
+        # Buckets in us-east-1 have no location constraint, and old eu-west-1 ones "EU"
+        return {None: "us-east-1", "": "us-east-1", "EU": "eu-west-1"}.get(region, region)
+
+    with ThreadPoolExecutor(max_workers=min(16, max(len(names), 1))) as executor:
+        return dict(zip(names, executor.map(location, names)))
 
 
-def _bucketstats(name, region, metric):
-    ''' Get the bucket size and object count for a given date
+def _bucketstats(names, region, metric, days=1):
+    ''' Get the daily bucket size and object count for buckets in a region, with
+        batched get_metric_data queries (two per bucket, MAX_METRIC_QUERIES per call)
         Keyword arguments:
-          name: bucket name
+          names: bucket names
           region: AWS region
           metric: metric
+          days: number of days (ending at midnight UTC)
         Returns:
-          Results dict
+          Dictionary keyed by bucket name of results dicts, each keyed by metric name
+          of {timestamp: value} dicts
     '''
     metriclist = [('BucketSizeBytes', 'StandardStorage'),
                   ('NumberOfObjects', 'AllStorageTypes')]
-    results = {}
+    queries = []
+    for idx, name in enumerate(names):
+        for metric_name, storage_type in metriclist:
+            queries.append({"Id": f"q{idx}_{metric_name.lower()}",
+                            "MetricStat": {"Metric": {
+                                "Namespace": "AWS/S3", "MetricName": metric_name,
+                                "Dimensions": [{'Name': 'BucketName', 'Value': name},
+                                               {'Name': 'StorageType',
+                                                'Value': storage_type}]},
+                                           "Period": 86400, "Stat": metric},
+                            "ReturnData": True})
     midnight = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    for metric_name, storage_type in metriclist:
-        metrics = _cloudwatch(region).get_metric_statistics(
-            Namespace='AWS/S3',
-            MetricName=metric_name,
-            StartTime=midnight - datetime.timedelta(days=1),
-            EndTime=midnight,
-            Period=86400,
-            Statistics=[metric],
-            Dimensions=[{'Name': 'BucketName', 'Value': name},
-                        {'Name': 'StorageType', 'Value': storage_type}])
-        if metrics['Datapoints']:
-            results[metric_name] = sorted(metrics['Datapoints'],
-                                          key=lambda row: row['Timestamp'])[-1][metric]
-            continue
+    results = {name: {} for name in names}
+    paginator = _cloudwatch(region).get_paginator('get_metric_data')
+    for start in range(0, len(queries), MAX_METRIC_QUERIES):
+        for page in paginator.paginate(MetricDataQueries=queries[start:start + MAX_METRIC_QUERIES],
+                                       StartTime=midnight - datetime.timedelta(days=days),
+                                       EndTime=midnight):
+            for row in page['MetricDataResults']:
+                idx, _, metric_name = row['Id'][1:].partition("_")
+                name = names[int(idx)]
+                metric_name = 'BucketSizeBytes' if metric_name == 'bucketsizebytes' \
+                              else 'NumberOfObjects'
+                results[name].setdefault(metric_name, {}).update(
+                    zip(row['Timestamps'], row['Values']))
     return results
 
 
+def _s3_client(workers=0):
+    ''' Return the shared S3 client, with a connection pool large enough for a worker pool
+        Keyword arguments:
+          workers: number of concurrent workers
+        Returns:
+          S3 client
+    '''
+    return get_registry().client('s3', workers=workers)
+
+
+def _record(obj):
+    ''' Convert an object dict from list_objects_v2 to an ObjectRecord
+        Keyword arguments:
+          obj: object dict
+        Returns:
+          ObjectRecord
+    '''
+    return ObjectRecord(obj["Key"], obj["Size"], obj.get("ETag", "").strip('"'),
+                        obj.get("LastModified"))
+
+
+def _iter_serial(s3c, bucket, prefix):
+    ''' Yield the objects under a prefix with a single paginator
+        Keyword arguments:
+          s3c: S3 client
+          bucket: bucket name
+          prefix: prefix
+        Returns:
+          ObjectRecord iterator
+    '''
+    paginator = s3c.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield _record(obj)
+
+
+def _iter_rollup(records, prefix):
+    ''' Roll up sizes and object counts for each child prefix of a key-ordered
+        record stream. Stats for a child are yielded as soon as the stream moves past it.
+        Keyword arguments:
+          records: ObjectRecord iterator (in key order)
+          prefix: parent prefix (ending with "/")
+        Returns:
+          Iterator of (child prefix name, stats dict) tuples
+    '''
+    child = None
+    stats = {}
+    for rec in records:
+        name, sep, _ = rec.key[len(prefix):].partition("/")
+        if not sep:
+            continue
+        if name != child:
+            if child is not None:
+                yield child, stats
+            child = name
+            stats = {"size": 0, "objects": 0}
+        stats["size"] += rec.size
+        stats["objects"] += 1
+    if child is not None:
+        yield child, stats
+
+
+def _rollup(records, prefix):
+    ''' Roll up sizes and object counts for each child prefix of a record stream
+        in any order
+        Keyword arguments:
+          records: ObjectRecord iterator
+          prefix: parent prefix (ending with "/")
+        Returns:
+          List of (child prefix name, stats dict) tuples, sorted by name
+    '''
+    children = {}
+    for rec in records:
+        name, sep, _ = rec.key[len(prefix):].partition("/")
+        if not sep:
+            continue
+        stats = children.setdefault(name, {"size": 0, "objects": 0})
+        stats["size"] += rec.size
+        stats["objects"] += 1
+    return sorted(children.items())
+
+
+def _open_location(location, seekable=False):
+    ''' Open a local file or S3 object for reading
+        Keyword arguments:
+          location: local path or S3 URL (s3://bucket/key)
+          seekable: download S3 objects to a temporary file (for random access)
+        Returns:
+          Binary file object
+    '''
+    if not location.startswith("s3://"):
+        return open(location, "rb")
+    bucket, _, key = location[5:].partition("/")
+    if not seekable:
+        return _s3_client().get_object(Bucket=bucket, Key=key)["Body"]
+    fhandle = tempfile.TemporaryFile()
+    _s3_client().download_fileobj(bucket, key, fhandle)
+    fhandle.seek(0)
+    return fhandle
+
+
+def _inventory_manifest(location):
+    ''' Find and read an S3 Inventory manifest
+        Keyword arguments:
+          location: manifest.json path or URL, or the inventory configuration's
+                    folder (the most recent report in it is used)
+        Returns:
+          Manifest dict, manifest location
+    '''
+    if not location.endswith(".json"):
+        location = location.rstrip("/")
+        if location.startswith("s3://"):
+            bucket, _, prefix = location[5:].partition("/")
+            reports = list(iter_prefixes(bucket, prefix))
+        else:
+            reports = os.listdir(location)
+        reports = sorted(name for name in reports if INVENTORY_DATE.match(name))
+        if not reports:
+            raise ValueError(f"No inventory reports found in {location}")
+        location = "/".join([location, reports[-1], "manifest.json"])
+    with _open_location(location) as fhandle:
+        return json.loads(fhandle.read()), location
+
+
+def _inventory_file(manifest, location, key):
+    ''' Return the location of an inventory data file
+        Keyword arguments:
+          manifest: manifest dict
+          location: manifest location
+          key: data file key (in the destination bucket)
+        Returns:
+          Local path or S3 URL
+    '''
+    if location.startswith("s3://"):
+        return f"s3://{manifest['destinationBucket'].split(':')[-1]}/{key}"
+    # Local copies keep the report layout (<config>/<date>/manifest.json and
+    # <config>/data/), or have the data files next to the manifest
+    mdir = os.path.dirname(location)
+    path = os.path.join(os.path.dirname(mdir), "data", os.path.basename(key))
+    return path if os.path.exists(path) else os.path.join(mdir, os.path.basename(key))
+
+
+def _iter_inventory_csv(fhandle, manifest, gzipped):
+    ''' Yield the rows of a CSV inventory data file as dicts of the needed fields
+        Keyword arguments:
+          fhandle: binary file object
+          manifest: manifest dict
+          gzipped: the file is gzip-compressed
+        Returns:
+          Iterator of row dicts
+    '''
+    schema = [field.strip() for field in manifest["fileSchema"].split(",")]
+    columns = [(field, schema.index(field)) for field in INVENTORY_COLUMNS if field in schema]
+    if gzipped:
+        fhandle = gzip.GzipFile(fileobj=fhandle)
+    for row in csv.reader(io.TextIOWrapper(fhandle, encoding="utf-8", newline="")):
+        row = {field: row[idx] for field, idx in columns}
+        # Keys are URL-encoded in CSV reports
+        row["Key"] = unquote_plus(row["Key"])
+        for field in ("IsLatest", "IsDeleteMarker"):
+            if field in row:
+                row[field] = row[field] == "true"
+        if row.get("LastModifiedDate"):
+            row["LastModifiedDate"] = datetime.datetime.fromisoformat(
+                row["LastModifiedDate"].replace("Z", "+00:00"))
+        row["Size"] = int(row["Size"]) if row.get("Size") else 0
+        yield row
+
+
+def _iter_inventory_columnar(fhandle, manifest):
+    ''' Yield the rows of an ORC or Parquet inventory data file as dicts of the
+        needed fields
+        Keyword arguments:
+          fhandle: seekable binary file object
+          manifest: manifest dict
+        Returns:
+          Iterator of row dicts
+    '''
+    if not pyarrow:
+        raise ImportError(f"pyarrow is needed to read {manifest['fileFormat']} inventory reports")
+    fmt = manifest["fileFormat"].upper()
+    if fmt == "PARQUET":
+        pfile = pyarrow.parquet.ParquetFile(fhandle)
+        names = set(pfile.schema_arrow.names)
+        columns = {field: col for field, col in INVENTORY_COLUMNS.items() if col in names}
+        batches = pfile.iter_batches(columns=list(columns.values()))
+    else:
+        ofile = pyarrow.orc.ORCFile(fhandle)
+        names = set(ofile.schema.names)
+        columns = {field: col for field, col in INVENTORY_COLUMNS.items() if col in names}
+        batches = (ofile.read_stripe(idx, columns=list(columns.values()))
+                   for idx in range(ofile.nstripes))
+    for batch in batches:
+        data = batch.to_pydict()
+        for idx in range(batch.num_rows):
+            row = {field: data[col][idx] for field, col in columns.items()}
+            row["Size"] = row.get("Size") or 0
+            yield row
+
+
+def _key_range_shards(prefix, workers, start_after=None):
+    ''' Split the keyspace under a prefix into contiguous key ranges
+        Keyword arguments:
+          prefix: prefix
+          workers: number of concurrent workers
+          start_after: only split the keys after this one
+        Returns:
+          List of (prefix, start_after, last) shards. A shard holds keys greater than
+          start_after and less than or equal to last (None means unbounded).
+    '''
+    count = min(len(SHARD_CHARS), workers * 4)
+    bounds = [None] + [prefix + SHARD_CHARS[(idx * len(SHARD_CHARS)) // count]
+                       for idx in range(1, count)] + [None]
+    shards = []
+    for low, high in zip(bounds, bounds[1:]):
+        if start_after:
+            if high is not None and high <= start_after:
+                continue
+            if low is None or low < start_after:
+                low = start_after
+        shards.append((prefix, low, high))
+    return shards
+
+
+def _plan_shards(s3c, bucket, prefix, workers, executor):
+    ''' Split a prefix into shards, first by delimiter discovery, then by key range.
+        When there are only a few children, each is probed with one listing page
+        (concurrently): children that fit in the page need no shard, and larger
+        ones are split by key range after the probed keys, so that one large child
+        is still listed in parallel.
+        Keyword arguments:
+          s3c: S3 client
+          bucket: bucket name
+          prefix: prefix
+          workers: number of concurrent workers
+          executor: ThreadPoolExecutor for the probes
+        Returns:
+          List of objects found during discovery, list of shards
+    '''
+    direct = []
+    while True:
+        page = s3c.list_objects_v2(Bucket=bucket, Prefix=prefix, Delimiter="/")
+        if page.get("IsTruncated"):
+            break
+        children = [pfx["Prefix"] for pfx in page.get("CommonPrefixes", [])]
+        direct.extend(page.get("Contents", []))
+        if len(children) == 1:
+            prefix = children[0]
+            continue
+        if len(children) >= workers * 4:
+            return direct, [(child, None, None) for child in children]
+        shards = []
+        probes = executor.map(lambda child: s3c.list_objects_v2(Bucket=bucket, Prefix=child),
+                              children)
+        for child, probe in zip(children, probes):
+            direct.extend(probe.get("Contents", []))
+            if probe.get("IsTruncated"):
+                shards.extend(_key_range_shards(child, workers,
+                                                probe["Contents"][-1]["Key"]))
+        return direct, shards
+    return direct, _key_range_shards(prefix, workers)
+
+
+def _list_shard(s3c, bucket, shard, pages, stop):
+    ''' Page through a single shard, queueing each page of records as it is listed
+        (followed by None, or by the exception that ended the listing)
+        Keyword arguments:
+          s3c: S3 client
+          bucket: bucket name
+          shard: (prefix, start_after, last) tuple
+          pages: bounded queue for lists of ObjectRecords
+          stop: Event set when the listing is abandoned
+        Returns:
+          None
+    '''
+    def put(item):
+        # Wait for room in the queue, unless the listing is abandoned
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    prefix, start_after, last = shard
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    try:
+        paginator = s3c.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            records = [_record(obj) for obj in page.get("Contents", [])
+                       if not last or obj["Key"] <= last]
+            if records and not put(records):
+                return
+            if last and page.get("Contents") and page["Contents"][-1]["Key"] > last:
+                break
+    except Exception as err: # pylint: disable=W0703
+        put(err)
+        return
+    put(None)
+
+
+def _iter_parallel(bucket, prefix, workers):
+    ''' Page through the shards of a prefix concurrently and yield the merged results.
+        Shards are yielded in key order as they are listed. At most one shard per
+        worker is listed at a time, and each buffers at most SHARD_PAGES pages, so
+        memory use does not grow with the size of the prefix.
+        Keyword arguments:
+          bucket: bucket name
+          prefix: prefix
+          workers: number of concurrent workers
+        Returns:
+          ObjectRecord iterator (in key order)
+    '''
+    s3c = _s3_client(workers)
+    stop = threading.Event()
+
+    def listed(executor, shards):
+        # Keep a window of shards in flight, in key order, and stream the first
+        remaining = iter(shards)
+
+        def start(shard):
+            pages = queue.Queue(maxsize=SHARD_PAGES)
+            executor.submit(_list_shard, s3c, bucket, shard, pages, stop)
+            return pages
+
+        window = deque(start(shard) for shard in itertools.islice(remaining, workers))
+        while window:
+            page = window[0].get()
+            if isinstance(page, Exception):
+                raise page
+            if page is None:
+                window.popleft()
+                for shard in itertools.islice(remaining, 1):
+                    window.append(start(shard))
+                continue
+            yield from page
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            direct, shards = _plan_shards(s3c, bucket, prefix, workers, executor)
+            direct = sorted((_record(obj) for obj in direct), key=attrgetter("key"))
+            yield from heapq.merge(direct, listed(executor, shards), key=attrgetter("key"))
+        finally:
+            # Let shards that are still listing give up if the caller stops early
+            stop.set()
+
+
+def _probe_listing(bucket, prefix, records, workers):
+    ''' Bring a cached listing up to date with one delimiter listing of its prefix.
+        Objects directly under the prefix are compared by ETag and LastModified, child
+        prefixes that were added are listed, and ones that were removed are dropped.
+        Objects replaced inside a child prefix that is still there are not seen.
+        Keyword arguments:
+          bucket: bucket name
+          prefix: prefix
+          records: cached ObjectRecords (in key order)
+          workers: number of concurrent listing workers (0 for a serial listing)
+        Returns:
+          List of ObjectRecords (in key order), and True if the listing changed
+    '''
+    def stamp(rec):
+        return rec.key, rec.size, rec.etag, \
+               rec.last_modified.timestamp() if rec.last_modified else None
+
+    cached = {}
+    direct = set()
+    for rec in records:
+        name, sep, _ = rec.key[len(prefix):].partition("/")
+        if sep:
+            cached.setdefault(prefix + name + "/", []).append(rec)
+        else:
+            direct.add(stamp(rec))
+    children = []
+    live = []
+    paginator = _s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        children.extend(pfx["Prefix"] for pfx in page.get("CommonPrefixes", []))
+        live.extend(_record(obj) for obj in page.get("Contents", []))
+    if set(children) == set(cached) and {stamp(rec) for rec in live} == direct:
+        return records, False
+    for child in children:
+        if child not in cached:
+            cached[child] = list(iter_objects(bucket, child, full=True, workers=workers))
+        live.extend(cached[child])
+    return sorted(live, key=attrgetter("key")), True
+
+
 # *****************************************************************************
 # * Callable routines                                                         *
 # *****************************************************************************
 
-def bucket_stats(bucket="", metric="Maximum", profile="", region="us-east-1"):
-    ''' Get statistics for one or more buckets
+def get_registry():
+    ''' Return the shared ClientRegistry that aws_s3_lib functions use (a registry
+        for the default session is created if none has been set)
+        Keyword arguments:
+          None
+        Returns:
+          ClientRegistry
+    '''
+    global REGISTRY # pylint: disable=W0603
+    with CLIENT_LOCK:
+        if REGISTRY is None:
+            REGISTRY = ClientRegistry()
+        return REGISTRY
+
+
+def set_registry(registry):
+    ''' Set the shared ClientRegistry that aws_s3_lib functions use
+        Keyword arguments:
+          registry: ClientRegistry
+        Returns:
+          None
+    '''
+    global REGISTRY # pylint: disable=W0603
+    REGISTRY = registry
+
+
+def bucket_stats(bucket="", metric="Maximum", profile="", region=None, days=0):
+    ''' Get statistics for one or more buckets. Buckets are grouped by region, and
+        each region's CloudWatch metrics are fetched with batched queries.
         Keyword arguments:
           bucket: bucket name
-          metric: metric ([Maximum], Minimum, Average, ExtendedStatistics,  SampleCount , Sum)
+          metric: metric ([Maximum], Minimum, Average, SampleCount, Sum)
           profile: profile
-          region: AWS region
+          region: AWS region (looked up for each bucket if not specified)
+          days: also return a daily time series over this many days
         Returns:
-          Rsults dict (keyed by bucket name if no bucket is specified)
+          Rsults dict (keyed by bucket name if no bucket is specified). Size and
+          object count are from the most recent day; with days, "series" is a list
+          of {"date", "size", "objects"} dicts in date order.
     '''
     if profile:
         profiles = boto3.session.Session().available_profiles
         if profile not in profiles:
             raise ValueError("Invalid profile %s" % (profile))
         boto3.setup_default_session(profile_name=profile)
-    s3r = boto3.resource('s3')
+    s3c = _s3_client()
     if bucket:
-        results = _bucketstats(bucket, region, metric)
-        bkt = s3r.Bucket(bucket)
-        stats = {"size": int(results.get('BucketSizeBytes', 0)),
-                 "objects": int(results.get('NumberOfObjects', 0))}
+        names = [bucket]
+        regions = {bucket: region} if region else _bucket_regions(s3c, names)
     else:
-        stats = {}
-        for bkt in s3r.buckets.all():
-            results = _bucketstats(bkt.name, region, metric)
-            stats[bkt.name] = {"size": int(results.get('BucketSizeBytes', 0)),
-                               "objects": int(results.get('NumberOfObjects', 0))}
+        response = s3c.list_buckets()
+        names = [bkt["Name"] for bkt in response["Buckets"]]
+        regions = {bkt["Name"]: bkt["BucketRegion"] for bkt in response["Buckets"]
+                   if bkt.get("BucketRegion")}
+        if region:
+            regions = {name: region for name in names}
+        regions.update(_bucket_regions(s3c, [name for name in names if name not in regions]))
+    by_region = {}
+    for name in names:
+        by_region.setdefault(regions[name], []).append(name)
+    stats = {}
+    for reg, rnames in by_region.items():
+        for name, results in _bucketstats(rnames, reg, metric, max(days, 1)).items():
+            sizes = results.get('BucketSizeBytes', {})
+            objects = results.get('NumberOfObjects', {})
+            stats[name] = {"size": int(sizes[max(sizes)]) if sizes else 0,
+                           "objects": int(objects[max(objects)]) if objects else 0}
+            if days:
+                stats[name]["series"] = [{"date": stamp.date().isoformat(),
+                                          "size": int(sizes.get(stamp, 0)),
+                                          "objects": int(objects.get(stamp, 0))}
+                                         for stamp in sorted(set(sizes) | set(objects))]
     if profile:
         boto3.setup_default_session(profile_name="default")
-    return stats
+    return stats[bucket] if bucket else stats
 
 
-def prefix_stats(bucket, prefix=""):
+def prefix_stats(bucket, prefix="", workers=0, inventory=None):
     ''' Return  stats for a bucket and optional prefix
         Keyword arguments:
           bucket: bucket name
           prefix: prefix
+          workers: number of concurrent listing workers (0 for a serial listing)
+          inventory: S3 Inventory report to read instead of listing (see iter_inventory)
         Returns:
           Dictionary of stats
     '''
-    s3r = boto3.resource('s3')
-    s3b = s3r.Bucket(bucket)
     size = objects = 0
-    for object_summary in s3b.objects.filter(Prefix=prefix):
+    for rec in iter_objects(bucket, prefix, full=True, workers=workers, inventory=inventory):
         objects += 1
-        size += object_summary.size
+        size += rec.size
     return {"size": size,
             "objects": objects}
 
@@ -127,51 +826,144 @@ def get_buckets(profile="default"):
     return buckets
 
 
-def get_objects(bucket, prefix="", full=False):
+def iter_inventory(location, prefix="", bucket=None):
+    ''' Yield the current objects in an S3 Inventory report, without any LIST
+        requests. Noncurrent versions and delete markers are skipped. Objects are
+        yielded in report order, which is not necessarily key order.
+        Keyword arguments:
+          location: manifest.json path or S3 URL, or the inventory configuration's
+                    folder (the most recent report in it is used). Data files are read
+                    from the destination bucket, or from a local copy of the report.
+          prefix: prefix
+          bucket: expected source bucket (optional)
+        Returns:
+          Iterator of ObjectRecords
+    '''
+    manifest, location = _inventory_manifest(location)
+    if bucket and manifest["sourceBucket"] != bucket:
+        raise ValueError(f"Inventory {location} is for bucket {manifest['sourceBucket']}, "
+                         + f"not {bucket}")
+    fmt = manifest["fileFormat"].upper()
+    for dfile in manifest["files"]:
+        path = _inventory_file(manifest, location, dfile["key"])
+        with _open_location(path, seekable=fmt != "CSV") as fhandle:
+            if fmt == "CSV":
+                rows = _iter_inventory_csv(fhandle, manifest, path.endswith(".gz"))
+            else:
+                rows = _iter_inventory_columnar(fhandle, manifest)
+            for row in rows:
+                if not row["Key"].startswith(prefix) or row.get("IsLatest") is False \
+                   or row.get("IsDeleteMarker"):
+                    continue
+                yield ObjectRecord(row["Key"], row["Size"], row.get("ETag", ""),
+                                   row.get("LastModifiedDate"))
+
+
+def iter_objects(bucket, prefix="", full=False, workers=0, inventory=None):
+    ''' Yield object keys in a bucket and optional prefix, one listing page at a time
+        Keyword arguments:
+          bucket: bucket name
+          prefix: prefix
+          full: yield ObjectRecords (key, size, etag, last_modified) instead of keys
+          workers: number of concurrent listing workers (0 for a serial listing)
+          inventory: S3 Inventory report to read instead of listing (see
+                     iter_inventory); objects are then not in key order
+        Returns:
+          Iterator of object keys or ObjectRecords
+    '''
+    if inventory:
+        records = iter_inventory(inventory, prefix, bucket)
+    elif workers:
+        records = _iter_parallel(bucket, prefix, workers)
+    else:
+        records = _iter_serial(_s3_client(), bucket, prefix)
+    for rec in records:
+        yield rec if full else rec.key
+
+
+def iter_prefixes(bucket, prefix="", full=False, workers=0, inventory=None):
+    ''' Yield prefixes in a bucket and optional prefix, one listing page at a time
+        Keyword arguments:
+          bucket: bucket name
+          prefix: prefix
+          full: yield (prefix, stats) tuples, computed from a single listing of the prefix
+          workers: number of concurrent listing workers (full only)
+          inventory: S3 Inventory report to read instead of listing (see iter_inventory)
+        Returns:
+          Iterator of prefixes or (prefix, stats dict) tuples
+    '''
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    if inventory:
+        stats = _rollup(iter_objects(bucket, prefix, full=True, inventory=inventory), prefix)
+        yield from stats if full else (name for name, _ in stats)
+        return
+    if full:
+        yield from _iter_rollup(iter_objects(bucket, prefix, full=True, workers=workers),
+                                prefix)
+        return
+    paginator = _s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        for pfx in page.get("CommonPrefixes", []):
+            yield pfx.get('Prefix').split("/")[-2]
+
+
+def cached_objects(bucket, prefix, cache, refresh=False, workers=0):
+    ''' Return the object records under a prefix. The prefix is fully listed if the
+        cached listing is missing, expired, or a refresh is forced; otherwise the
+        cached listing is checked with one delimiter listing, and only the child
+        prefixes that were added are listed (see _probe_listing).
+        Keyword arguments:
+          bucket: bucket name
+          prefix: prefix
+          cache: ListingCache
+          refresh: ignore any cached listing
+          workers: number of concurrent listing workers (0 for a serial listing)
+        Returns:
+          List of ObjectRecords
+    '''
+    records = None if refresh else cache.get(bucket, prefix)
+    if records is None:
+        records = list(iter_objects(bucket, prefix, full=True, workers=workers))
+        cache.put(bucket, prefix, records)
+        return records
+    records, changed = _probe_listing(bucket, prefix, records, workers)
+    if changed:
+        cache.put(bucket, prefix, records, probed=True)
+    return records
+
+
+def get_objects(bucket, prefix="", full=False, workers=0, inventory=None):
     ''' Return a list of object keys in a bucket and optional prefix
         Keyword arguments:
           bucket: bucket name
           prefix: prefix
           full: include size
+          workers: number of concurrent listing workers (0 for a serial listing)
+          inventory: S3 Inventory report to read instead of listing (see iter_inventory)
         Returns:
-          List of object keys or list of object key dicts
+          List of object keys or list of object key dicts (in key order)
     '''
-    s3r = boto3.resource('s3')
-    s3b = s3r.Bucket(bucket)
-    objectlist = []
-    for object_summary in s3b.objects.filter(Prefix=prefix):
-        if full:
-            itm = {"object": object_summary.key, "size": object_summary.size}
-        else:
-            itm = object_summary.key
-        objectlist.append(itm)
-    return objectlist
+    records = iter_objects(bucket, prefix, full=True, workers=workers, inventory=inventory)
+    if inventory:
+        records = sorted(records, key=attrgetter("key"))
+    if full:
+        return [{"object": rec.key, "size": rec.size} for rec in records]
+    return [rec.key for rec in records]
 
 
-def get_prefixes(bucket, prefix="", full=False):
+def get_prefixes(bucket, prefix="", full=False, workers=0, inventory=None):
     ''' Return a list ob prefixes in a bucket and optional prefix
         Keyword arguments:
           bucket: bucket name
           prefix: prefix
+          full: include size and object count (single listing of the prefix)
+          workers: number of concurrent listing workers (full only)
+          inventory: S3 Inventory report to read instead of listing (see iter_inventory)
         Returns:
-          List of prefixes
+          List of prefixes or dictionary of prefix stats
     '''
-    s3c = boto3.client('s3')
-    if prefix and not prefix.endswith("/"):
-        prefix += "/"
-    paginator = s3c.get_paginator('list_objects_v2')
-    pages = paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/")
-    prefixlist = []
-    prefixdict = {}
-    for page in pages:
-        prefixes = page.get("CommonPrefixes")
-        if not prefixes:
-            continue
-        for pfx in prefixes:
-            if full:
-                pre = pfx.get('Prefix').split("/")[-2]
-                stats = prefix_stats(bucket, prefix + pre)
-                prefixdict[pre] = stats
-            else:
-                prefixlist.append(pfx.get('Prefix').split("/")[-2])
-    return prefixdict if full else prefixlist
+    if full:
+        return dict(iter_prefixes(bucket, prefix, full=True, workers=workers,
+                                  inventory=inventory))
+    return list(iter_prefixes(bucket, prefix, inventory=inventory))
@@ -0,0 +1,169 @@
+''' Library of functions for planning and scheduling multi-sample upload batches
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import re
+try:
+    # YAML plans need PyYAML (JSON plans need nothing extra)
+    import yaml
+except ImportError:
+    yaml = None
+
+# Default concurrency limit (uploads at once) and per-upload throughput (MB/s)
+# for each storage source. Plans can override these.
+SOURCES = {"/nearline": {"limit": 2, "rate": 100},
+           "/nrs": {"limit": 8, "rate": 400},
+           "/groups": {"limit": 4, "rate": 200}}
+DEFAULT_SOURCE = {"limit": 4, "rate": 200}
+
+
+# *****************************************************************************
+# * Internal routines                                                         *
+# *****************************************************************************
+
+def _plan_sample(entry, defaults, products):
+    ''' Validate and normalize one sample entry of a plan
+        Keyword arguments:
+          entry: sample date string, or dict with sample, products, suffixes, and images
+          defaults: default products
+          products: valid product names
+        Returns:
+          Sample dict (sample, products, suffixes, images)
+    '''
+    # YAML reads unquoted sample dates as dates
+    if isinstance(entry, (str, datetime.date)):
+        entry = {"sample": str(entry)}
+    if not isinstance(entry, dict) or not entry.get("sample"):
+        raise ValueError(f"Invalid plan entry {entry}")
+    sample = str(entry["sample"])
+    if not re.search(r"\d{4}-\d{2}-\d{2}", sample):
+        raise ValueError(f"Invalid sample {sample}")
+    selected = entry.get("products", defaults)
+    unknown = set(selected) - set(products)
+    if unknown:
+        raise ValueError(f"Unknown product(s) for {sample}: {', '.join(sorted(unknown))}")
+    return {"sample": sample, "products": list(selected),
+            "suffixes": [str(suffix) for suffix in entry.get("suffixes", [])],
+            "images": entry.get("images")}
+
+
+# *****************************************************************************
+# * Callable routines                                                         *
+# *****************************************************************************
+
+def load_plan(path, products):
+    ''' Read a batch plan. A plan is a YAML or JSON mapping with a list of samples
+        (date strings, or dicts with sample, products, segmentation suffixes, and
+        an optional images base directory), optional default products, and
+        optional per-storage-source limits and rates.
+        Keyword arguments:
+          path: plan file (.json, or YAML)
+          products: valid product names
+        Returns:
+          List of sample dicts, dictionary of source settings keyed by source
+    '''
+    with open(path, encoding="utf8") as infile:
+        if path.endswith(".json"):
+            plan = json.load(infile)
+        else:
+            if not yaml:
+                raise ImportError("PyYAML is needed to read YAML plans (or use a .json plan)")
+            plan = yaml.safe_load(infile)
+    if not isinstance(plan, dict) or not plan.get("samples"):
+        raise ValueError(f"Plan {path} has no samples")
+    defaults = plan.get("products", ["images"])
+    samples = [_plan_sample(entry, defaults, products) for entry in plan["samples"]]
+    seen = set()
+    for sample in samples:
+        if sample["sample"] in seen:
+            raise ValueError(f"Sample {sample['sample']} is in the plan more than once")
+        seen.add(sample["sample"])
+    sources = {src: dict(settings) for src, settings in SOURCES.items()}
+    for src, settings in (plan.get("sources") or {}).items():
+        if isinstance(settings, int):
+            settings = {"limit": settings}
+        sources[src.rstrip("/")] = dict(sources.get(src.rstrip("/"), DEFAULT_SOURCE),
+                                        **settings)
+    return samples, sources
+
+
+def storage_source(path, sources):
+    ''' Return the storage source of a path: the longest configured source prefix
+        it is under, or its top-level directory
+        Keyword arguments:
+          path: local path
+          sources: dictionary of source settings keyed by source
+        Returns:
+          Source name
+    '''
+    matches = [src for src in sources if path == src or path.startswith(src + "/")]
+    if matches:
+        return max(matches, key=len)
+    return "/" + path.strip("/").split("/")[0]
+
+
+def run_by_source(tasks, sources):
+    ''' Run tasks with a separate pool for each storage source, so that no source
+        has more than its limit of tasks running at once
+        Keyword arguments:
+          tasks: list of (source, callable) tuples
+          sources: dictionary of source settings keyed by source
+        Returns:
+          List of task results (in task order)
+    '''
+    pools = {}
+    futures = []
+    try:
+        for src, func in tasks:
+            if src not in pools:
+                pools[src] = ThreadPoolExecutor(
+                    max_workers=sources.get(src, DEFAULT_SOURCE)["limit"])
+            futures.append(pools[src].submit(func))
+        return [future.result() for future in futures]
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True)
+
+
+def schedule(units, sources):
+    ''' Assign units of work to each storage source's concurrent lanes (largest
+        first, to the least-loaded lane, or of equally loaded lanes the one with the
+        fewest units) and estimate how long each source takes
+        Keyword arguments:
+          units: list of dicts with name, source, and bytes
+          sources: dictionary of source settings keyed by source
+        Returns:
+          Dictionary keyed by source of dicts with limit, rate, bytes, lanes (lists
+          of units), and seconds (estimated time for the busiest lane)
+    '''
+    result = {}
+    for unit in sorted(units, key=lambda unit: -unit["bytes"]):
+        settings = sources.get(unit["source"], DEFAULT_SOURCE)
+        plan = result.setdefault(unit["source"], {
+            "limit": settings["limit"], "rate": settings["rate"], "bytes": 0,
+            "lanes": [[] for _ in range(settings["limit"])], "loads": [0] * settings["limit"]})
+        # Equally loaded lanes (such as empty ones) take turns by unit count
+        lane = min(zip(plan["loads"], map(len, plan["lanes"]), range(settings["limit"])))[2]
+        plan["lanes"][lane].append(unit)
+        plan["loads"][lane] += unit["bytes"]
+        plan["bytes"] += unit["bytes"]
+    for plan in result.values():
+        plan["lanes"] = [lane for lane in plan["lanes"] if lane]
+        plan["seconds"] = max(plan.pop("loads")) / (plan["rate"] * 1024 * 1024)
+    return result
+
+
+def human_duration(seconds):
+    ''' Return a human-readable duration
+        Keyword arguments:
+          seconds: duration in seconds
+        Returns:
+          Duration string
+    '''
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds / 3600:.1f}h"
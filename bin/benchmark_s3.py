@@ -0,0 +1,89 @@
+''' This program will time aws_s3_lib listing functions against a bucket and
+    prefix, comparing the serial listing with the parallel sharded listing and,
+    optionally, an S3 Inventory report.
+'''
+
+import argparse
+import sys
+import time
+import colorlog
+from aws_s3_lib import get_objects, prefix_stats
+
+
+def timed(func, *args, **kwargs):
+    ''' Call a function and return its result and elapsed time
+        Keyword arguments:
+          func: function to call
+          args: positional arguments
+          kwargs: keyword arguments
+        Returns:
+          Function result, elapsed seconds
+    '''
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_benchmarks():
+    ''' Time get_objects and prefix_stats for each worker count (and inventory)
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    print(f"{'Function':<14}{'Workers':>8}{'Objects':>12}{'Seconds':>10}{'Speedup':>9}")
+    for func in (get_objects, prefix_stats):
+        serial = None
+        runs = [(workers, {"workers": workers}) for workers in [0] + ARG.WORKERS]
+        if ARG.INVENTORY:
+            runs.append(("inv", {"inventory": ARG.INVENTORY}))
+        for workers, kwargs in runs:
+            best = None
+            for _ in range(ARG.REPEAT):
+                result, elapsed = timed(func, ARG.BUCKET, ARG.PREFIX, **kwargs)
+                best = elapsed if best is None else min(best, elapsed)
+            count = len(result) if isinstance(result, list) else result["objects"]
+            if serial is None:
+                serial = (count, best)
+            elif count != serial[0]:
+                LOGGER.error("%s with %s workers found %d objects (serial found %d)",
+                             func.__name__, workers, count, serial[0])
+            print(f"{func.__name__:<14}{workers:>8}{count:>12}{best:>10.2f}"
+                  + f"{serial[1] / best:>8.1f}x")
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark serial and parallel S3 listings")
+    PARSER.add_argument('--bucket', dest='BUCKET', action='store',
+                        default='janelia-mouselight-imagery', help='Bucket')
+    PARSER.add_argument('--prefix', dest='PREFIX', action='store',
+                        required=True, help='Prefix to list')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int,
+                        nargs='+', default=[4, 8, 16], help='Worker counts to test')
+    PARSER.add_argument('--inventory', dest='INVENTORY', action='store',
+                        help='S3 Inventory manifest or folder to compare against')
+    PARSER.add_argument('--repeat', dest='REPEAT', action='store', type=int,
+                        default=1, help='Runs per configuration (best is reported)')
+    PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
+                        default=False, help='Flag, Chatty')
+    PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
+                        default=False, help='Flag, Very chatty')
+    ARG = PARSER.parse_args()
+
+    LOGGER = colorlog.getLogger()
+    ATTR = colorlog.colorlog.logging if "colorlog" in dir(colorlog) else colorlog
+    if ARG.DEBUG:
+        LOGGER.setLevel(ATTR.DEBUG)
+    elif ARG.VERBOSE:
+        LOGGER.setLevel(ATTR.INFO)
+    else:
+        LOGGER.setLevel(ATTR.WARNING)
+    HANDLER = colorlog.StreamHandler()
+    HANDLER.setFormatter(colorlog.ColoredFormatter())
+    LOGGER.addHandler(HANDLER)
+
+    run_benchmarks()
+    sys.exit(0)
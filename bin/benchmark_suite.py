@@ -0,0 +1,369 @@
+''' This program will build a synthetic MouseLight bucket on a local S3 stand-in
+    (moto, or an S3-compatible server such as MinIO) and time aws_s3_lib functions
+    and update_aws_neurons.process_prefix against it, recording AWS API call counts
+    and peak memory. Results can be saved as a baseline, and a later run compared
+    with it fails if anything found different items, made more calls, or used more
+    memory, or (when both runs timed several repeats) got slower.
+'''
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+import boto3
+import colorlog
+from aws_s3_lib import bucket_stats, get_objects, get_prefixes, prefix_stats
+from metrics_lib import Metrics
+import update_aws_neurons
+
+# Synthetic bucket sizes: tracings dates, neuron folders per date, keys in the image
+# prefix, and other buckets (for bucket_stats)
+SCALES = {"small": {"dates": 100, "neurons": 10, "image_keys": 5000, "buckets": 10},
+          "medium": {"dates": 1000, "neurons": 10, "image_keys": 100000, "buckets": 50},
+          "large": {"dates": 2000, "neurons": 15, "image_keys": 1000000, "buckets": 200}}
+BUCKET = update_aws_neurons.BUCKET
+TRACINGS = "Finished_Neurons"
+SAMPLE = "2019-01-01"
+AREAS = ["Primary motor area, Layer 5", "Secondary motor area, layer 2/3",
+         "Caudoputamen", "Thalamus", "Somatosensory areas, layer 6a"]
+METRICS = Metrics()
+# Times are only compared with a baseline when both are medians of this many runs
+MIN_TIMED_REPEAT = 3
+
+
+def synthetic_dates(count):
+    ''' Return consecutive sample dates
+        Keyword arguments:
+          count: number of dates
+        Returns:
+          List of YYYY-MM-DD strings
+    '''
+    first = datetime.date(2015, 1, 1)
+    return [(first + datetime.timedelta(days=idx)).isoformat() for idx in range(count)]
+
+
+def synthetic_objects(scale):
+    ''' Yield the objects in the synthetic bucket. Every neuron folder has a soma.txt
+        and consensus.swc; every third has no dendrite.swc.
+        Keyword arguments:
+          scale: scale dict
+        Returns:
+          Iterator of (key, body) tuples
+    '''
+    swc = b"# synthetic\n1 1 0.0 0.0 0.0 1.0 -1\n"
+    for date in synthetic_dates(scale["dates"]):
+        for idx in range(scale["neurons"]):
+            pre = f"tracings/{TRACINGS}/{date}/G-{idx + 1:03d}"
+            yield f"{pre}/soma.txt", AREAS[idx % len(AREAS)].encode()
+            yield f"{pre}/consensus.swc", swc
+            if idx % 3:
+                yield f"{pre}/dendrite.swc", swc
+    for idx in range(scale["image_keys"]):
+        yield (f"images/{SAMPLE}/ktx/{idx % 8 + 1}/{idx // 8 % 8 + 1}/{idx // 64 % 8 + 1}/"
+               + f"block_{idx}.ktx", b"k" * (idx % 64))
+
+
+def populate(scale):
+    ''' Create the synthetic bucket (and the buckets and CloudWatch metrics used by
+        bucket_stats). With moto, objects are added to its backend directly, which
+        is far faster than going through the S3 API.
+        Keyword arguments:
+          scale: scale dict
+        Returns:
+          None
+    '''
+    s3c = boto3.client('s3')
+    names = [BUCKET] + [f"benchmark-{idx:04d}" for idx in range(scale["buckets"])]
+    for name in names:
+        s3c.create_bucket(Bucket=name)
+    put = None
+    if not ARG.ENDPOINT:
+        try:
+            from moto.core import DEFAULT_ACCOUNT_ID # pylint: disable=C0415
+            from moto.s3.models import s3_backends # pylint: disable=C0415
+            backend = s3_backends[DEFAULT_ACCOUNT_ID]["global"]
+            put = lambda obj: backend.put_object(BUCKET, obj[0], obj[1])
+        except (ImportError, KeyError):
+            LOGGER.warning("moto backend not available; populating through the S3 API")
+    if not put:
+        put = lambda obj: s3c.put_object(Bucket=BUCKET, Key=obj[0], Body=obj[1])
+    start = time.perf_counter()
+    if ARG.ENDPOINT:
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            count = sum(1 for _ in executor.map(put, synthetic_objects(scale)))
+    else:
+        count = sum(1 for obj in synthetic_objects(scale) if put(obj) or True)
+    LOGGER.info("Created %d objects in %.1fs", count, time.perf_counter() - start)
+    if ARG.ENDPOINT:
+        return
+    midnight = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    cwc = boto3.client('cloudwatch', region_name="us-east-1")
+    for idx, name in enumerate(names):
+        cwc.put_metric_data(Namespace="AWS/S3", MetricData=[
+            {"MetricName": "BucketSizeBytes", "Value": float(idx * 1024 ** 3),
+             "Timestamp": midnight - datetime.timedelta(hours=12),
+             "Dimensions": [{"Name": "BucketName", "Value": name},
+                            {"Name": "StorageType", "Value": "StandardStorage"}]},
+            {"MetricName": "NumberOfObjects", "Value": float(idx * 1000),
+             "Timestamp": midnight - datetime.timedelta(hours=12),
+             "Dimensions": [{"Name": "BucketName", "Value": name},
+                            {"Name": "StorageType", "Value": "AllStorageTypes"}]}])
+
+
+def setup_neurons(scale):
+    ''' Set the update_aws_neurons state that normally comes from NeuronBrowser
+        Keyword arguments:
+          scale: scale dict
+        Returns:
+          None
+    '''
+    uan = update_aws_neurons
+    uan.LOGGER = LOGGER
+    for date in synthetic_dates(scale["dates"]):
+        uan.MAP[date] = {f"G-{idx + 1:03d}": f"{date}-{idx:03d}"
+                         for idx in range(scale["neurons"])}
+        uan.AREA[date] = AREAS[0]
+    for sid, area in enumerate(AREAS, start=1):
+        uan.STRUCT[area.replace(",", "")] = sid
+
+
+def run_process_prefix(workers, incremental=False):
+    ''' Run update_aws_neurons.process_prefix on the synthetic tracings
+        Keyword arguments:
+          workers: number of workers
+          incremental: skip unchanged metadata files
+        Returns:
+          Number of metadata files processed
+    '''
+    uan = update_aws_neurons
+    uan.ARG = SimpleNamespace(WRITE=True, INCREMENTAL=incremental, HIERARCHY=False,
+                              WORKERS=workers, INVALIDATE=False)
+    uan.S3_CLIENT = boto3.client('s3')
+    uan.S3_RESOURCE = boto3.resource('s3')
+    uan.NEURON_POOL = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    before = uan.COUNT["metadata"]
+    try:
+        uan.process_prefix(TRACINGS)
+    finally:
+        if uan.NEURON_POOL:
+            uan.NEURON_POOL.shutdown()
+    return uan.COUNT["metadata"] - before
+
+
+def benchmarks():
+    ''' Return the benchmarks to run
+        Keyword arguments:
+          None
+        Returns:
+          List of (name, function) tuples; each function returns an item count
+    '''
+    images = f"images/{SAMPLE}/"
+    tests = [("get_prefixes", lambda: len(get_prefixes(BUCKET, f"tracings/{TRACINGS}")))]
+    for workers in [0, ARG.WORKERS]:
+        tests.append((f"get_prefixes[full,workers={workers}]",
+                      lambda workers=workers: len(get_prefixes(BUCKET, f"tracings/{TRACINGS}",
+                                                               full=True, workers=workers))))
+        tests.append((f"get_objects[workers={workers}]",
+                      lambda workers=workers: len(get_objects(BUCKET, images, workers=workers))))
+        tests.append((f"prefix_stats[workers={workers}]",
+                      lambda workers=workers: prefix_stats(BUCKET, images,
+                                                           workers=workers)["objects"]))
+    if not ARG.ENDPOINT:
+        tests.append(("bucket_stats", lambda: len(bucket_stats())))
+    for workers in [1, ARG.WORKERS]:
+        tests.append((f"process_prefix[workers={workers}]",
+                      lambda workers=workers: run_process_prefix(workers)))
+    tests.append(("process_prefix[incremental]",
+                  lambda: run_process_prefix(ARG.WORKERS, incremental=True)))
+    return tests
+
+
+def measure(func):
+    ''' Time a benchmark (the median of ARG.REPEAT runs), count its AWS API calls
+        (in the first run), and measure its peak memory
+        Keyword arguments:
+          func: benchmark function
+        Returns:
+          Result dict
+    '''
+    times = []
+    for run in range(ARG.REPEAT):
+        before = dict(METRICS.calls)
+        start = time.perf_counter()
+        items = func()
+        times.append(time.perf_counter() - start)
+        if not run:
+            calls = {operation: count - before.get(operation, 0)
+                     for operation, count in METRICS.calls.items()
+                     if count != before.get(operation, 0)}
+    result = {"seconds": round(statistics.median(times), 4), "items": items,
+              "api_calls": calls, "api_total": sum(calls.values())}
+    if not ARG.NO_MEMORY:
+        # Separate run, since tracing slows everything down
+        tracemalloc.start()
+        func()
+        result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+        tracemalloc.stop()
+    return result
+
+
+def compare(results, baseline):
+    ''' Compare results with a baseline. Item and API call counts are the same on
+        every run, so any increase is a regression; times are noisy, so they are
+        only compared when both runs report the median of at least MIN_TIMED_REPEAT
+        runs, and a slowdown must exceed both the tolerance and the minimum delta.
+        Keyword arguments:
+          results: results dict
+          baseline: baseline dict
+        Returns:
+          List of regression messages
+    '''
+    regressions = []
+    if baseline.get("scale") != results["scale"]:
+        return [f"Baseline scale {baseline.get('scale')} does not match {results['scale']}"]
+    timed = min(results.get("repeat", 1), baseline.get("repeat", 1)) >= MIN_TIMED_REPEAT
+    if not timed:
+        LOGGER.warning("Times are not compared (the results and baseline both need "
+                       + "--repeat %d or more)", MIN_TIMED_REPEAT)
+    for name, base in baseline["results"].items():
+        current = results["results"].get(name)
+        if not current:
+            regressions.append(f"{name}: not run")
+            continue
+        if current["items"] != base["items"]:
+            regressions.append(f"{name}: {current['items']} items (baseline {base['items']})")
+        for operation, count in sorted(current["api_calls"].items()):
+            if count > base["api_calls"].get(operation, 0):
+                regressions.append(f"{name}: {count} {operation} calls "
+                                   + f"(baseline {base['api_calls'].get(operation, 0)})")
+        if timed and current["seconds"] > base["seconds"] * (1 + ARG.TOLERANCE) \
+           and current["seconds"] - base["seconds"] > ARG.MIN_DELTA:
+            regressions.append(f"{name}: {current['seconds']:.3f}s median "
+                               + f"(baseline {base['seconds']:.3f}s)")
+        if "peak_mb" in current and "peak_mb" in base \
+           and current["peak_mb"] > base["peak_mb"] * (1 + ARG.TOLERANCE) \
+           and current["peak_mb"] - base["peak_mb"] > 1:
+            regressions.append(f"{name}: {current['peak_mb']:.1f} MB peak "
+                               + f"(baseline {base['peak_mb']:.1f} MB)")
+    return regressions
+
+
+def run_suite():
+    ''' Build the synthetic bucket, run the benchmarks, and save or compare results
+        Keyword arguments:
+          None
+        Returns:
+          Number of regressions
+    '''
+    scale = dict(SCALES[ARG.SCALE])
+    for field in scale:
+        if getattr(ARG, field.upper()) is not None:
+            scale[field] = getattr(ARG, field.upper())
+    METRICS.instrument()
+    if not ARG.SKIP_POPULATE:
+        populate(scale)
+    setup_neurons(scale)
+    results = {"created": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "backend": "endpoint" if ARG.ENDPOINT else "moto",
+               "scale": scale, "workers": ARG.WORKERS, "repeat": ARG.REPEAT,
+               "results": {}}
+    print(f"{'Benchmark':<32}{'Items':>10}{'Seconds':>10}{'API calls':>11}{'Peak MB':>9}")
+    for name, func in benchmarks():
+        result = measure(func)
+        results["results"][name] = result
+        print(f"{name:<32}{result['items']:>10}{result['seconds']:>10.3f}"
+              + f"{result['api_total']:>11}{result.get('peak_mb', 0):>9.1f}")
+    if ARG.SAVE:
+        with open(ARG.SAVE, "w", encoding="utf8") as outfile:
+            json.dump(results, outfile, indent=2)
+        print(f"Results written to {ARG.SAVE}")
+    if not ARG.BASELINE:
+        return 0
+    with open(ARG.BASELINE, encoding="utf8") as infile:
+        regressions = compare(results, json.load(infile))
+    for msg in regressions:
+        LOGGER.error("Regression: %s", msg)
+    if not regressions:
+        print(f"No regressions against {ARG.BASELINE}")
+    return len(regressions)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark aws_s3_lib and update_aws_neurons on a synthetic bucket")
+    PARSER.add_argument('--scale', dest='SCALE', action='store', default='small',
+                        choices=list(SCALES), help='Synthetic bucket size')
+    PARSER.add_argument('--dates', dest='DATES', action='store', type=int,
+                        help='Tracings dates (overrides --scale)')
+    PARSER.add_argument('--neurons', dest='NEURONS', action='store', type=int,
+                        help='Neuron folders per date (overrides --scale)')
+    PARSER.add_argument('--image-keys', dest='IMAGE_KEYS', action='store', type=int,
+                        help='Keys in the image prefix (overrides --scale)')
+    PARSER.add_argument('--buckets', dest='BUCKETS', action='store', type=int,
+                        help='Additional buckets for bucket_stats (overrides --scale)')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int,
+                        default=8, help='Workers for the parallel variants')
+    PARSER.add_argument('--repeat', dest='REPEAT', action='store', type=int,
+                        default=1, help='Timed runs per benchmark (the median is reported; '
+                        + f'times are compared with a baseline at {MIN_TIMED_REPEAT} or more)')
+    PARSER.add_argument('--endpoint', dest='ENDPOINT', action='store_true', default=False,
+                        help='Flag, Use the S3-compatible server in AWS_ENDPOINT_URL '
+                             + '(e.g. MinIO) instead of moto')
+    PARSER.add_argument('--skip-populate', dest='SKIP_POPULATE', action='store_true',
+                        default=False, help='Flag, Use an already populated bucket (--endpoint)')
+    PARSER.add_argument('--no-memory', dest='NO_MEMORY', action='store_true',
+                        default=False, help='Flag, Skip peak memory measurement')
+    PARSER.add_argument('--save', dest='SAVE', action='store',
+                        help='Write results (usable as a baseline) to this file')
+    PARSER.add_argument('--baseline', dest='BASELINE', action='store',
+                        help='Baseline file to compare results with')
+    PARSER.add_argument('--tolerance', dest='TOLERANCE', action='store', type=float,
+                        default=0.25, help='Allowed slowdown and memory growth (fraction)')
+    PARSER.add_argument('--min-delta', dest='MIN_DELTA', action='store', type=float,
+                        default=0.25, help='Slowdowns under this many seconds are ignored')
+    PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
+                        default=False, help='Flag, Chatty')
+    PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
+                        default=False, help='Flag, Very chatty')
+    ARG = PARSER.parse_args()
+
+    LOGGER = colorlog.getLogger()
+    ATTR = colorlog.colorlog.logging if "colorlog" in dir(colorlog) else colorlog
+    if ARG.DEBUG:
+        LOGGER.setLevel(ATTR.DEBUG)
+    elif ARG.VERBOSE:
+        LOGGER.setLevel(ATTR.INFO)
+    else:
+        LOGGER.setLevel(ATTR.WARNING)
+    HANDLER = colorlog.StreamHandler()
+    HANDLER.setFormatter(colorlog.ColoredFormatter())
+    LOGGER.addHandler(HANDLER)
+
+    if ARG.ENDPOINT:
+        if not os.environ.get("AWS_ENDPOINT_URL"):
+            LOGGER.critical("AWS_ENDPOINT_URL is not set")
+            sys.exit(-1)
+        sys.exit(1 if run_suite() else 0)
+    try:
+        from moto import mock_aws # pylint: disable=C0412
+    except ImportError:
+        LOGGER.critical("moto is required (pip install 'moto[s3,cloudwatch]'), "
+                        + "or use --endpoint")
+        sys.exit(-1)
+    # Never let a moto run touch a real account
+    os.environ.update(AWS_ACCESS_KEY_ID="testing", AWS_SECRET_ACCESS_KEY="testing",
+                      AWS_SESSION_TOKEN="testing", AWS_DEFAULT_REGION="us-east-1")
+    os.environ.pop("AWS_PROFILE", None)
+    with mock_aws():
+        FAILED = run_suite()
+    sys.exit(1 if FAILED else 0)
@@ -4,17 +4,49 @@
 '''
 
 import argparse
-import glob
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import json
 import re
 import os
 import sys
+import threading
+import boto3
 import colorlog
 import inquirer
+from batch_lib import human_duration, load_plan, run_by_source, schedule, storage_source
+from metrics_lib import Metrics, summary_lines
+from scan_lib import ScanCache, human_size, scan_tree, shard_tree
+from upload_lib import MB, ReadAhead, Transfer, TransferJournal, UploadManifest, \
+                       execute_transfers
 
 BASE = "/groups/mousebrainmicro/mousebrainmicro"
 IMAGE_BASE = ["/nrs/mouselight/SAMPLES", "/nearline/mouselight/data/RENDER_archive"]
+# Uploads from nearline storage are staged with read-ahead (see --stage)
+NEARLINE = "/nearline/"
 CARVEOUT_BASE = ["/nrs/funke/mouselight", "/nrs/funke/mouselight-v2"]
 BUCKET = "s3://janelia-mouselight-imagery"
+PROFILE = "FlyLightPDSAdmin"
+PRODUCTS = ["images", "registration", "segmentation", "tracings", "carveouts"]
+# Products written to each script (or uploaded in-process with --execute)
+UNITS = {"images": ["images"], "cluster": ["registration", "segmentation", "tracings"],
+         "carveouts": ["carveouts"]}
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "hortacloud-utilities")
+TRANSFERS = []
+SOURCES = {}
+SCAN_CACHE = None
+READAHEAD = None
+# Batch plans upload several samples at once, sharing one stager and its budgets
+READAHEAD_LOCK = threading.Lock()
+METRICS = None
+# Cluster job graph: job name -> {"product": product, "deps": [job names]}
+JOBS = {}
+# LSF job group for cluster jobs (batch plans cap concurrent jobs with a group limit)
+JOB_GROUP = None
+# Shards with more members than this read their include filters from a file, so
+# that bsub command lines stay well under the argument length limit
+MAX_FILTERS = 50
 
 
 def get_target(base_dir, suffix=None):
@@ -32,11 +64,272 @@ def get_target(base_dir, suffix=None):
     return "/".join(dlist)
 
 
+def add_transfer(fhandle, verb, source, target):
+    ''' Write an AWS CLI command for a transfer, or queue it for in-process execution
+        Keyword arguments:
+          fhandle: script file handle (None to queue the transfer)
+          verb: cp or sync
+          source: local source
+          target: AWS S3 target
+        Returns:
+          None
+    '''
+    if fhandle:
+        fhandle.write(f"aws s3 {verb} {source} {target} --only-show-errors --profile {PROFILE}\n")
+    else:
+        TRANSFERS.append(Transfer(verb, source, target))
+
+
+def get_scan_cache():
+    ''' Return the shared directory scan cache (opened on first use)
+        Keyword arguments:
+          None
+        Returns:
+          ScanCache
+    '''
+    global SCAN_CACHE # pylint: disable=W0603
+    if not SCAN_CACHE:
+        SCAN_CACHE = ScanCache(os.path.join(CACHE_DIR, "scan.db"))
+    return SCAN_CACHE
+
+
+def get_readahead(transfers):
+    ''' Return the shared read-ahead stager if transfers should be staged (with
+        --stage auto, only transfers from nearline storage are)
+        Keyword arguments:
+          transfers: list of Transfers
+        Returns:
+          ReadAhead, or None
+    '''
+    global READAHEAD # pylint: disable=W0603
+    if ARG.STAGE == "never" or ARG.NO_JOURNAL:
+        return None
+    if ARG.STAGE == "auto" and not any(trn.source.startswith(NEARLINE) for trn in transfers):
+        return None
+    with READAHEAD_LOCK:
+        if not READAHEAD:
+            READAHEAD = ReadAhead(memory=int(ARG.STAGE_MEMORY * MB),
+                                  disk=int(ARG.STAGE_DISK * 1024 * MB), scratch=ARG.STAGE_DIR,
+                                  readers=ARG.STAGE_READERS)
+        return READAHEAD
+
+
+def add_source(product, source):
+    ''' Record a local source for the pre-flight summary
+        Keyword arguments:
+          product: product name
+          source: local file or directory
+        Returns:
+          None
+    '''
+    SOURCES.setdefault(product, []).append(source)
+
+
+def preflight_summary():
+    ''' Scan every recorded source and report how much data each product will upload
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not SOURCES:
+        return
+    cache = get_scan_cache()
+    sources = [(product, source) for product, slist in SOURCES.items() for source in slist]
+    def scan(src):
+        with (METRICS.timer(f"scan.{src[0]}") if METRICS else nullcontext()):
+            return scan_tree(src[1], workers=ARG.SCAN_WORKERS, cache=cache)
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        results = list(executor.map(scan, sources))
+    print(f"Pre-flight summary for {ARG.SAMPLE}")
+    for product in SOURCES:
+        files = size = 0
+        for (prod, source), result in zip(sources, results):
+            if prod != product:
+                continue
+            files += result["files"]
+            size += result["bytes"]
+            for fsize, path in result["largest"][:3]:
+                LOGGER.info("%s: %s (%s)", product, path, human_size(fsize))
+        print(f"  {product:<14}{files:>12,} files {human_size(size):>12}")
+
+
+def run_transfers(sample, transfers, name=None, profile=PROFILE):
+    ''' Execute queued transfers in-process
+        Keyword arguments:
+          sample: sample date
+          transfers: list of Transfers
+          name: name for the manifest, journal, and verification report (defaults to
+                the sample date)
+          profile: AWS profile (None to use the current default session)
+        Returns:
+          True if every upload succeeded and verified, False otherwise
+    '''
+    if not transfers:
+        return True
+    name = name or sample
+    manifest = None
+    if not ARG.NO_MANIFEST:
+        manifest = UploadManifest(ARG.MANIFEST
+                                  or os.path.join(CACHE_DIR, "manifests", f"{name}.db"))
+    journal = None
+    if not ARG.NO_JOURNAL:
+        journal = TransferJournal(ARG.JOURNAL
+                                  or os.path.join(CACHE_DIR, "journals", f"{name}.jsonl"),
+                                  resume=ARG.RESUME)
+    try:
+        failed, report = execute_transfers(transfers, profile=profile, threads=ARG.THREADS,
+                                           chunk_size=ARG.CHUNK_SIZE, manifest=manifest,
+                                           verify=ARG.VERIFY, hash_workers=ARG.HASH_WORKERS,
+                                           journal=journal, metrics=METRICS,
+                                           readahead=get_readahead(transfers))
+    finally:
+        if manifest:
+            manifest.close()
+        if journal:
+            journal.close()
+    for path, err in failed:
+        LOGGER.error("Could not upload %s: %s", path, err)
+    if report is not None:
+        write_verification_report(report, sample, name)
+    if failed:
+        LOGGER.critical("%s: %d upload(s) failed", name, len(failed))
+        return False
+    if report and any(row["status"] in ("mismatch", "missing") for row in report):
+        LOGGER.critical("%s: verification failed", name)
+        return False
+    return True
+
+
+def write_verification_report(report, sample, name):
+    ''' Write the per-sample verification report and print a summary
+        Keyword arguments:
+          report: list of report dicts from execute_transfers
+          sample: sample date
+          name: report name
+        Returns:
+          None
+    '''
+    counts = {}
+    for row in report:
+        counts[row["status"]] = counts.get(row["status"], 0) + 1
+        if row["status"] in ("mismatch", "missing"):
+            LOGGER.error("%s: %s (local %s, remote %s)", row["status"], row["key"],
+                         row["local"], row["remote"])
+        elif row["status"] == "unverifiable":
+            LOGGER.warning("Could not verify %s", row["key"])
+    fname = ARG.VERIFY_REPORT or f"{name}_verification.json"
+    with open(fname, "w", encoding="utf8") as outfile:
+        json.dump({"sample": sample, "algorithm": ARG.VERIFY, "chunk_size": ARG.CHUNK_SIZE,
+                   "summary": counts, "files": report}, outfile, indent=2)
+    print(f"Verification ({ARG.VERIFY}): "
+          + ", ".join(f"{count:,} {status}" for status, count in sorted(counts.items())))
+    print(f"Verification report written to {fname}")
+
+
+def job_tag():
+    ''' Return the sample tag used in job names: the month and day, or in batch mode
+        (where samples from different years are queued together) the whole sample
+        name without dashes
+        Keyword arguments:
+          None
+        Returns:
+          Job name tag
+    '''
+    if JOB_GROUP:
+        return ARG.SAMPLE.replace("-", "")
+    return "".join(ARG.SAMPLE.split("-")[1:3])
+
+
+def add_job(clu, product, name, command, deps=(), slots=None):
+    ''' Write a bsub command for a job and add the job to the job graph. The job
+        will not start until all of its dependencies are done.
+        Keyword arguments:
+          clu: cluster file handle
+          product: product name
+          name: job name
+          command: command to run
+          deps: names of jobs that must finish first
+          slots: slots for the job (defaults to --slots)
+        Returns:
+          None
+    '''
+    wait = ""
+    if deps:
+        wait = ' -w "' + " && ".join(f"done({dep})" for dep in deps) + '"'
+    if JOB_GROUP:
+        wait += f" -g {JOB_GROUP}"
+    clu.write(f"bsub -J {name}{wait} -n {slots or ARG.SLOTS} -P mouselight '{command}'\n")
+    JOBS[name] = {"product": product, "deps": list(deps)}
+
+
+def write_dependent_jobs(clu):
+    ''' Write jobs that depend on the upload jobs: a metadata refresh that waits
+        for the tracings uploads, and a final barrier that waits for every job.
+        Keyword arguments:
+          clu: cluster file handle
+        Returns:
+          None
+    '''
+    tag = job_tag()
+    tracings = [name for name, job in JOBS.items() if job["product"] == "tracings"]
+    if ARG.REFRESH_METADATA and tracings:
+        program = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "update_aws_neurons.py")
+        clu.write("echo 'Refreshing neuron metadata'\n")
+        add_job(clu, "metadata", f"meta{tag}",
+                f"{sys.executable} {program} --write --incremental --refresh-mapping "
+                + "--tracings Finished_Neurons tracing_complete", deps=tracings, slots=1)
+    if ARG.BARRIER and JOBS:
+        clu.write("echo 'Waiting for all jobs'\n")
+        add_job(clu, "barrier", f"done{tag}", f"echo Uploads for {ARG.SAMPLE} are complete",
+                deps=list(JOBS), slots=1)
+
+
+def write_cluster_sync(clu, product, job, source, target):
+    ''' Write bsub commands to sync a directory. With more than one shard, the
+        directory is split into shards of roughly equal size, each synced by its own
+        job with include filters. A shard with many members (such as the files of a
+        flat directory) has its filters written to a file, and xargs splits them
+        across as many sync commands as the argument limits need.
+        Keyword arguments:
+          clu: cluster file handle
+          product: product name
+          job: job name
+          source: local directory
+          target: AWS S3 target
+        Returns:
+          None
+    '''
+    shards = [(0, [])]
+    if ARG.SHARDS > 1:
+        shards = shard_tree(source, ARG.SHARDS, workers=ARG.SCAN_WORKERS,
+                            cache=get_scan_cache())
+    for idx, (size, members) in enumerate(shards, start=1):
+        name = f"{job}-s{idx}" if len(shards) > 1 else job
+        patterns = [f"{member}*" if member.endswith("/") else member for member in members]
+        filters = ""
+        if members:
+            LOGGER.info("%s shard %d: %d entries, %s", job, idx, len(members), human_size(size))
+            filters = ' --exclude "*"'
+        if len(members) > MAX_FILTERS:
+            fname = os.path.abspath(f"{ARG.SAMPLE}_{name}.filters")
+            with open(fname, "w", encoding="utf8") as outfile:
+                outfile.write("".join(f"--include={pattern}\n" for pattern in patterns))
+            add_job(clu, product, name, f'xargs -d "\\n" -a {fname} aws s3 sync {source}/ '
+                    + f"{target}/{filters} --only-show-errors --profile {PROFILE}")
+            continue
+        filters += "".join(f' --include "{pattern}"' for pattern in patterns)
+        add_job(clu, product, name, f"aws s3 sync {source}/ {target}/{filters} "
+                + f"--only-show-errors --profile {PROFILE}")
+
+
 def process_images(base, img):
     ''' Write copy commands for images.
         Keyword arguments:
           base: images base directory
-          img: image file handle
+          img: image file handle (None to queue transfers)
         Returns:
           None
     '''
@@ -44,15 +337,16 @@ def process_images(base, img):
     source = "/".join([base, "ktx/"])
     target = get_target("images", "ktx/")
     if os.path.exists(source):
-        img.write(f"aws s3 sync {source} {target} --only-show-errors --profile FlyLightPDSAdmin\n")
+        add_source("images", source)
+        add_transfer(img, "sync", source, target)
     else:
         LOGGER.warning("Could not find %s", source)
     target = get_target("images")
     for file in ["default.0.tif", "default.1.tif", "tilebase.cache.yml", "transform.txt"]:
         source = "/".join([base, file])
         if os.path.exists(source):
-            img.write(f"aws s3 cp {source} {target}/ --only-show-errors "
-                      + "--profile FlyLightPDSAdmin\n")
+            add_source("images", source)
+            add_transfer(img, "cp", source, f"{target}/")
         else:
             LOGGER.warning("Could not find %s", source)
 
@@ -64,47 +358,52 @@ def process_registration(clu):
         Returns:
           None
     '''
-    mmdd = "".join(ARG.SAMPLE.split("-")[1:3])
+    tag = job_tag()
     source = "/".join([BASE, "registration/Database", ARG.SAMPLE])
     clu.write("echo 'Uploading registration'\n")
     if os.path.exists(source):
+        add_source("registration", source)
         target = get_target("registration")
-        clu.write(f"bsub -J reg{mmdd} -n 4 -P mouselight 'aws s3 sync "
-                  + f"{source}/ {target}/ --only-show-errors --profile FlyLightPDSAdmin'\n")
+        write_cluster_sync(clu, "registration", f"reg{tag}", source, target)
     else:
         LOGGER.warning("Could not find %s", source)
 
 
-def process_segmentation(clu):
+def process_segmentation(clu, suffixes=None):
     ''' Write copy commands for segmentation files.
         Keyword arguments:
           clu: cluster file handle
+          suffixes: segmentation suffixes (the user is prompted if not specified)
         Returns:
           None
     '''
-    mmdd = "".join(ARG.SAMPLE.split("-")[1:3])
-    done = False
+    tag = job_tag()
     prefix = "/".join([BASE, 'cluster/Reconstructions', ARG.SAMPLE])
-    suffix = []
-    while not done:
-        question = [inquirer.Text("suffix", message="segmantation suffix(es)")
-                   ]
-        answer = inquirer.prompt(question)
-        if answer["suffix"]:
-            source = "/".join([prefix, answer["suffix"]])
-            if os.path.exists(source):
-                suffix.append(source)
+    if suffixes is None:
+        suffixes = []
+        done = False
+        while not done:
+            question = [inquirer.Text("suffix", message="segmantation suffix(es)")
+                       ]
+            answer = inquirer.prompt(question)
+            if answer["suffix"]:
+                suffixes.append(answer["suffix"])
             else:
-                LOGGER.warning("Could not find %s", source)
+                done = True
+    suffix = []
+    for sfx in suffixes:
+        source = "/".join([prefix, sfx])
+        if os.path.exists(source):
+            add_source("segmentation", source)
+            suffix.append(source)
         else:
-            done = True
+            LOGGER.warning("Could not find %s", source)
     #target = "/".join([BUCKET, f"segmentation/{ARG.SAMPLE}"])
     target = get_target("segmentation")
     counter = 1
     clu.write("echo 'Uploading segmentation'\n")
     for source in suffix:
-        clu.write(f"bsub -J seg{mmdd}-{str(counter)} -n 4 -P mouselight 'aws s3 sync "
-                  + f"{source}/ {target}/ --only-show-errors --profile FlyLightPDSAdmin'\n")
+        write_cluster_sync(clu, "segmentation", f"seg{tag}-{str(counter)}", source, target)
         counter += 1
 
 
@@ -115,7 +414,7 @@ def process_tracings(clu):
         Returns:
           None
     '''
-    mmdd = "".join(ARG.SAMPLE.split("-")[1:3])
+    tag = job_tag()
     counter = 1
     clu.write("echo 'Uploading tracings'\n")
     for sub in ["Finished_Neurons", "tracing_complete"]:
@@ -124,10 +423,10 @@ def process_tracings(clu):
             sub2 = "shared_tracing/Finished_Neurons"
         source = "/".join([BASE, sub2, ARG.SAMPLE])
         if os.path.exists(source):
+            add_source("tracings", source)
             #target = "/".join([BUCKET, f"tracings/{sub}/{ARG.SAMPLE}"])
             target = get_target(f"tracings/{sub}")
-            clu.write(f"bsub -J tra{mmdd}-{str(counter)} -n 4 -P mouselight 'aws s3 sync "
-                      + f"{source}/ {target}/ --only-show-errors --profile FlyLightPDSAdmin'\n")
+            write_cluster_sync(clu, "tracings", f"tra{tag}-{str(counter)}", source, target)
             counter += 1
         else:
             LOGGER.warning("Could not find %s", source)
@@ -140,9 +439,7 @@ def check_ktx(base):
         Returns:
           True if the ktx directory is valid, False if not
     '''
-    base += "/ktx"
-    files = os.listdir(base)
-    return "block_8_xy_.ktx" in files
+    return os.path.isfile("/".join([base, "ktx", "block_8_xy_.ktx"]))
 
 
 def get_sample():
@@ -153,12 +450,15 @@ def get_sample():
           None
     '''
     if not ARG.SAMPLE:
-        sample_date = []
+        candidates = []
         for test_base in IMAGE_BASE:
-            for smp in glob.glob(test_base + "/*/ktx"):
-                sdate = smp.split("/")[-2]
-                if re.search(r"^\d\d\d\d-\d\d-\d\d", sdate):
-                    sample_date.append(sdate)
+            if os.path.isdir(test_base):
+                with os.scandir(test_base) as entries:
+                    candidates.extend(entry.path for entry in entries
+                                      if re.search(r"^\d\d\d\d-\d\d-\d\d", entry.name))
+        with ThreadPoolExecutor(max_workers=ARG.SCAN_WORKERS) as executor:
+            found = executor.map(lambda smp: os.path.isdir(smp + "/ktx"), candidates)
+            sample_date = [smp.split("/")[-1] for smp, ktx in zip(candidates, found) if ktx]
         sample_date.sort(reverse=True)
         sample_date.insert(0, "(Enter manually)")
         question = [inquirer.List("sample",
@@ -173,7 +473,7 @@ def get_sample():
 def process_carveouts(crv):
     ''' Write copy commands for carveouts.
         Keyword arguments:
-          crv: carveouts file handle
+          crv: carveouts file handle (None to queue transfers)
         Returns:
           None
     '''
@@ -184,71 +484,359 @@ def process_carveouts(crv):
             continue
         LOGGER.info(f"Using carveouts from {cbase}")
         source = cbase + "/"
+        add_source("carveouts", source)
         target = get_target("carveouts")
         if os.path.exists(cbase):
             print(source, target)
-            crv.write(f"aws s3 sync {source} {target} --only-show-errors --profile FlyLightPDSAdmin\n")
+            add_transfer(crv, "sync", source, target)
     
 
-def process_sample():
-    ''' Process the specified sample to create upload files.
+def start_metrics():
+    ''' Start collecting metrics if a metrics file or Prometheus textfile was given
         Keyword arguments:
           None
         Returns:
           None
     '''
-    get_sample()
-    question = [inquirer.Checkbox("products",
-                                  message="Enter products to upload",
-                                  choices=["images", "registration", "segmentation", "tracings", "carveouts"],
-                                  default=["images"],
-                                 )
-               ]
-    answer = inquirer.prompt(question)
-    products = answer["products"]
-    if "images" in products:
-        found = False
+    global METRICS # pylint: disable=W0603
+    if ARG.METRICS_FILE or ARG.PROMETHEUS_FILE:
+        METRICS = Metrics(ARG.METRICS_FILE, ARG.PROMETHEUS_FILE, interval=ARG.METRICS_INTERVAL,
+                          job="generate_upload_script")
+
+
+def stop_metrics():
+    ''' Write the final metrics snapshot and log a summary
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if METRICS:
+        for line in summary_lines(METRICS.close()):
+            LOGGER.info(line)
+
+
+def find_image_base(base=None, prompt=True):
+    ''' Find the images base directory for the sample
+        Keyword arguments:
+          base: images base directory (searched for in IMAGE_BASE if not specified)
+          prompt: prompt the user if the directory can't be found
+        Returns:
+          Images base directory
+    '''
+    if not base:
         for test_base in IMAGE_BASE:
-            ibase = "/".join([test_base, ARG.SAMPLE])
-            if os.path.exists(ibase):
-                found = True
+            if os.path.exists("/".join([test_base, ARG.SAMPLE])):
+                base = "/".join([test_base, ARG.SAMPLE])
                 break
-        if not found:
-            question = [inquirer.Text("base", message="images base directory")
-                       ]
-            answer = inquirer.prompt(question)
-            ibase = answer["base"]
-            if not os.path.exists("/".join([ibase, "ktx"])):
-                LOGGER.error("Could not find ktx directory in %s", ibase)
-                sys.exit(-1)
-        if not check_ktx(ibase):
-            LOGGER.error("Image files under %s use an obsolete naming scheme", ibase)
+    if not base:
+        if not prompt:
+            LOGGER.error("Could not find images for %s", ARG.SAMPLE)
             sys.exit(-1)
-        with open(f"{ARG.SAMPLE}_images.sh", "w", encoding="utf8") as img:
+        question = [inquirer.Text("base", message="images base directory")
+                   ]
+        answer = inquirer.prompt(question)
+        base = answer["base"]
+    if not os.path.exists("/".join([base, "ktx"])):
+        LOGGER.error("Could not find ktx directory in %s", base)
+        sys.exit(-1)
+    if not check_ktx(base):
+        LOGGER.error("Image files under %s use an obsolete naming scheme", base)
+        sys.exit(-1)
+    return base
+
+
+def plan_sample(products, suffixes=None, image_base=None, prompt=True):
+    ''' Write upload scripts and queue in-process transfers for the sample
+        Keyword arguments:
+          products: products to upload
+          suffixes: segmentation suffixes (the user is prompted if not specified)
+          image_base: images base directory (searched for if not specified)
+          prompt: prompt the user for an images base directory that can't be found
+        Returns:
+          Dictionary of script names keyed by unit (None for in-process transfers)
+    '''
+    scripts = {}
+    if "images" in products:
+        ibase = find_image_base(image_base, prompt)
+        scripts["images"] = None if ARG.EXECUTE else f"{ARG.SAMPLE}_images.sh"
+        with (nullcontext() if ARG.EXECUTE
+              else open(scripts["images"], "w", encoding="utf8")) as img:
             process_images(ibase, img)
-    if any(itm in products for itm in ["registration", "segmentation", "tracings"]):
-        with open(f"{ARG.SAMPLE}_cluster.sh", "w", encoding="utf8") as clu:
+    if any(itm in products for itm in UNITS["cluster"]):
+        scripts["cluster"] = f"{ARG.SAMPLE}_cluster.sh"
+        with open(scripts["cluster"], "w", encoding="utf8") as clu:
             if "registration" in products:
                 process_registration(clu)
             if "segmentation" in products:
-                process_segmentation(clu)
+                process_segmentation(clu, suffixes)
             if "tracings" in products:
                 process_tracings(clu)
+            write_dependent_jobs(clu)
     if "carveouts" in products:
-        with open(f"{ARG.SAMPLE}_carveouts.sh", "w", encoding="utf8") as crv:
+        scripts["carveouts"] = None if ARG.EXECUTE else f"{ARG.SAMPLE}_carveouts.sh"
+        with (nullcontext() if ARG.EXECUTE
+              else open(scripts["carveouts"], "w", encoding="utf8")) as crv:
             process_carveouts(crv)
+    return scripts
+
+
+def process_sample():
+    ''' Process the specified sample to create upload files.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    get_sample()
+    question = [inquirer.Checkbox("products",
+                                  message="Enter products to upload",
+                                  choices=PRODUCTS,
+                                  default=["images"],
+                                 )
+               ]
+    answer = inquirer.prompt(question)
+    plan_sample(answer["products"])
+    start_metrics()
+    try:
+        if not ARG.SKIP_SUMMARY:
+            preflight_summary()
+        if not run_transfers(ARG.SAMPLE, TRANSFERS):
+            sys.exit(-1)
+    finally:
+        stop_metrics()
+
+
+def plan_batch(samples, sources):
+    ''' Write scripts and queue transfers for every sample in a plan
+        Keyword arguments:
+          samples: list of sample dicts from load_plan
+          sources: dictionary of storage source settings
+        Returns:
+          List of unit dicts (sample, unit, script, transfers, paths, source)
+    '''
+    global JOB_GROUP # pylint: disable=W0603
+    JOB_GROUP = f"/mouselight/uploads{storage_source(BASE, sources)}"
+    units = []
+    for entry in samples:
+        ARG.SAMPLE = entry["sample"]
+        TRANSFERS.clear()
+        SOURCES.clear()
+        JOBS.clear()
+        scripts = plan_sample(entry["products"], entry["suffixes"], entry["images"],
+                              prompt=False)
+        for unit, script in scripts.items():
+            paths = [path for product in UNITS[unit] for path in SOURCES.get(product, [])]
+            if not paths:
+                continue
+            units.append({"sample": ARG.SAMPLE, "unit": unit, "script": script, "paths": paths,
+                          "source": storage_source(paths[0], sources),
+                          "transfers": [] if unit == "cluster" else
+                                       [trn for trn in TRANSFERS
+                                        if any(trn.source == path for path in paths)]})
+    return units
+
+
+def scan_units(units, sources):
+    ''' Scan the local sources of every unit, with each storage source's scans
+        limited to its concurrency limit, and add file counts and sizes to the units
+        Keyword arguments:
+          units: list of unit dicts
+          sources: dictionary of storage source settings
+        Returns:
+          None
+    '''
+    cache = get_scan_cache()
+    def scan(unit, path):
+        with (METRICS.timer(f"scan.{unit}") if METRICS else nullcontext()):
+            return scan_tree(path, workers=ARG.SCAN_WORKERS, cache=cache)
+
+    tasks = [(storage_source(path, sources), partial(scan, unit["unit"], path))
+             for unit in units for path in unit["paths"]]
+    results = iter(run_by_source(tasks, sources))
+    for unit in units:
+        unit["files"] = unit["bytes"] = 0
+        for _ in unit["paths"]:
+            result = next(results)
+            unit["files"] += result["files"]
+            unit["bytes"] += result["bytes"]
+
+
+def print_schedule(units, plan):
+    ''' Print the combined schedule with estimated sizes and durations
+        Keyword arguments:
+          units: list of unit dicts
+          plan: schedule from batch_lib.schedule
+        Returns:
+          None
+    '''
+    print(f"Batch plan for {len({unit['sample'] for unit in units})} sample(s)")
+    print(f"  {'Sample':<12}{'Unit':<11}{'Source':<12}{'Files':>12}{'Size':>12}")
+    for unit in units:
+        print(f"  {unit['sample']:<12}{unit['unit']:<11}{unit['source']:<12}"
+              + f"{unit['files']:>12,}{human_size(unit['bytes']):>12}")
+    print(f"  {'Source':<12}{'Limit':>6}{'Units':>7}{'Size':>12}{'Estimate':>10}")
+    for src, splan in sorted(plan.items()):
+        print(f"  {src:<12}{splan['limit']:>6}{sum(len(lane) for lane in splan['lanes']):>7}"
+              + f"{human_size(splan['bytes']):>12}{human_duration(splan['seconds']):>10}")
+    total = sum(splan["bytes"] for splan in plan.values())
+    seconds = max((splan["seconds"] for splan in plan.values()), default=0)
+    print(f"Total: {human_size(total)}, estimated {human_duration(seconds)} "
+          + "(storage sources upload concurrently)")
+
+
+def write_schedule(units, plan):
+    ''' Write a shell script that submits the cluster scripts (with a job group
+        limit) and runs the other upload scripts in concurrent lanes for each
+        storage source
+        Keyword arguments:
+          units: list of unit dicts
+          plan: schedule from batch_lib.schedule
+        Returns:
+          Schedule script name, or None if no scripts were written
+    '''
+    cluster = [unit for unit in units if unit["unit"] == "cluster"]
+    lanes = {}
+    for src, splan in sorted(plan.items()):
+        slanes = [[unit["script"] for unit in lane if unit["script"] and unit["unit"] != "cluster"]
+                  for lane in splan["lanes"]]
+        if any(slanes):
+            lanes[src] = [lane for lane in slanes if lane]
+    if not cluster and not lanes:
+        return None
+    fname = ARG.SCHEDULE or f"{os.path.splitext(os.path.basename(ARG.PLAN))[0]}_schedule.sh"
+    with open(fname, "w", encoding="utf8") as outfile:
+        outfile.write("#!/bin/bash\n")
+        if cluster:
+            # LSF runs at most the source's limit of jobs in the group at once
+            limit = plan[cluster[0]["source"]]["limit"]
+            outfile.write(f"bgadd -L {limit} {JOB_GROUP} 2>/dev/null "
+                          + f"|| bgmod -L {limit} {JOB_GROUP}\n")
+            for unit in cluster:
+                outfile.write(f"bash {unit['script']}\n")
+        for src, slanes in lanes.items():
+            outfile.write(f"echo 'Uploading from {src} ({len(slanes)} at a time)'\n")
+            for lane in slanes:
+                outfile.write("(" + "; ".join(f"bash {script}" for script in lane) + ") &\n")
+        outfile.write("wait\n")
+    return fname
+
+
+def process_batch():
+    ''' Plan every sample in a batch plan, print the combined schedule, and write
+        the schedule script or run the transfers in-process
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    try:
+        samples, sources = load_plan(ARG.PLAN, PRODUCTS)
+    except (ImportError, OSError, ValueError) as err:
+        LOGGER.critical("Could not load plan %s: %s", ARG.PLAN, err)
+        sys.exit(-1)
+    units = plan_batch(samples, sources)
+    start_metrics()
+    try:
+        scan_units(units, sources)
+        plan = schedule(units, sources)
+        print_schedule(units, plan)
+        fname = write_schedule(units, plan)
+        if fname:
+            print(f"Schedule written to {fname}")
+        if not ARG.EXECUTE:
+            return
+        # Sessions are not thread-safe, so the profile is selected once for every sample
+        boto3.setup_default_session(profile_name=PROFILE)
+        tasks = [(unit["source"],
+                  partial(run_transfers, unit["sample"], unit["transfers"],
+                          unit["sample"] if unit["unit"] == "images"
+                          else f"{unit['sample']}_{unit['unit']}", profile=None))
+                 for unit in units if unit["transfers"]]
+        if not all(run_by_source(tasks, sources)):
+            sys.exit(-1)
+    finally:
+        stop_metrics()
 
 
 if __name__ == '__main__':
     PARSER = argparse.ArgumentParser(
         description="Generate command files to upload MouseLight data")
     PARSER.add_argument('--sample', dest='SAMPLE', action='store',
-                        required=True, help='Sample date')
+                        help='Sample date (prompted for if not specified)')
+    PARSER.add_argument('--plan', dest='PLAN', action='store',
+                        help='Batch plan (YAML or JSON) of samples, products, and suffixes')
+    PARSER.add_argument('--schedule', dest='SCHEDULE', action='store',
+                        help='Schedule script for --plan (defaults to <plan>_schedule.sh)')
+    PARSER.add_argument('--execute', dest='EXECUTE', action='store_true',
+                        default=False,
+                        help='Flag, Upload images and carveouts in-process instead of writing scripts')
+    PARSER.add_argument('--threads', dest='THREADS', action='store', type=int,
+                        default=32, help='Concurrent transfer threads (with --execute)')
+    PARSER.add_argument('--chunk-size', dest='CHUNK_SIZE', action='store', type=int,
+                        default=8, help='Multipart chunk size in MB (with --execute)')
+    PARSER.add_argument('--manifest', dest='MANIFEST', action='store',
+                        help='Upload manifest file (with --execute)')
+    PARSER.add_argument('--no-manifest', dest='NO_MANIFEST', action='store_true',
+                        default=False, help='Flag, Compare against AWS S3 listings only')
+    PARSER.add_argument('--journal', dest='JOURNAL', action='store',
+                        help='Transfer journal file (with --execute)')
+    PARSER.add_argument('--no-journal', dest='NO_JOURNAL', action='store_true',
+                        default=False, help='Flag, Upload without a transfer journal')
+    PARSER.add_argument('--resume', dest='RESUME', action='store_true',
+                        default=False, help='Flag, Resume an interrupted upload from its journal')
+    PARSER.add_argument('--verify', dest='VERIFY', action='store', choices=['md5', 'sha256'],
+                        help='Verify uploads against AWS S3 ETags (md5) or checksums (sha256) '
+                             + '(with --execute)')
+    PARSER.add_argument('--hash-workers', dest='HASH_WORKERS', action='store', type=int,
+                        help='Hashing processes for --verify (defaults to the CPU count)')
+    PARSER.add_argument('--verify-report', dest='VERIFY_REPORT', action='store',
+                        help='Verification report file (defaults to <sample>_verification.json)')
+    PARSER.add_argument('--stage', dest='STAGE', action='store', default='auto',
+                        choices=['auto', 'always', 'never'],
+                        help='Read-ahead staging of files before uploading (with --execute; '
+                             + 'auto stages nearline sources)')
+    PARSER.add_argument('--stage-dir', dest='STAGE_DIR', action='store',
+                        help='Scratch directory for staging (memory only if not specified)')
+    PARSER.add_argument('--stage-memory', dest='STAGE_MEMORY', action='store', type=float,
+                        default=1024, help='Staging memory budget in MB')
+    PARSER.add_argument('--stage-disk', dest='STAGE_DISK', action='store', type=float,
+                        default=50, help='Staging scratch directory budget in GB')
+    PARSER.add_argument('--stage-readers', dest='STAGE_READERS', action='store', type=int,
+                        default=4, help='Staging reader threads')
+    PARSER.add_argument('--shards', dest='SHARDS', action='store', type=int,
+                        default=1, help='Size-balanced cluster jobs per synced directory')
+    PARSER.add_argument('--slots', dest='SLOTS', action='store', type=int,
+                        default=4, help='Slots per cluster job')
+    PARSER.add_argument('--refresh-metadata', dest='REFRESH_METADATA', action='store_true',
+                        default=False,
+                        help='Flag, Add a cluster job to refresh neuron metadata after tracings')
+    PARSER.add_argument('--barrier', dest='BARRIER', action='store_true',
+                        default=False, help='Flag, Add a cluster job that waits for all jobs')
+    PARSER.add_argument('--scan-workers', dest='SCAN_WORKERS', action='store', type=int,
+                        default=16, help='Concurrent directory scanners')
+    PARSER.add_argument('--skip-summary', dest='SKIP_SUMMARY', action='store_true',
+                        default=False, help='Flag, Skip the pre-flight size summary')
+    PARSER.add_argument('--metrics-file', dest='METRICS_FILE', action='store',
+                        help='JSON-lines file for throughput and AWS API metrics')
+    PARSER.add_argument('--prometheus-file', dest='PROMETHEUS_FILE', action='store',
+                        help='Prometheus textfile for throughput and AWS API metrics')
+    PARSER.add_argument('--metrics-interval', dest='METRICS_INTERVAL', action='store',
+                        type=float, default=30, help='Seconds between metrics snapshots')
     PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
                         default=False, help='Flag, Chatty')
     PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
                         default=False, help='Flag, Very chatty')
     ARG = PARSER.parse_args()
+    if ARG.VERIFY and not ARG.EXECUTE:
+        PARSER.error("--verify requires --execute")
+    if ARG.RESUME and (ARG.NO_JOURNAL or not ARG.EXECUTE):
+        PARSER.error("--resume requires --execute and a journal")
+    if ARG.STAGE == "always" and (ARG.NO_JOURNAL or not ARG.EXECUTE):
+        PARSER.error("--stage always requires --execute and a journal")
+    if ARG.PLAN and (ARG.SAMPLE or ARG.MANIFEST or ARG.JOURNAL or ARG.VERIFY_REPORT):
+        PARSER.error("--plan names files per sample, so it can't be used with --sample, "
+                     + "--manifest, --journal, or --verify-report")
 
     LOGGER = colorlog.getLogger()
     ATTR = colorlog.colorlog.logging if "colorlog" in dir(colorlog) else colorlog
@@ -262,5 +850,8 @@ if __name__ == '__main__':
     HANDLER.setFormatter(colorlog.ColoredFormatter())
     LOGGER.addHandler(HANDLER)
 
-    process_sample()
+    if ARG.PLAN:
+        process_batch()
+    else:
+        process_sample()
     sys.exit(0)
@@ -0,0 +1,285 @@
+''' Library of functions for collecting upload and AWS API metrics
+'''
+
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import math
+import os
+import threading
+import time
+import boto3
+
+# Latencies are kept in log-spaced buckets (four per doubling, starting at 1 ms),
+# so percentiles are accurate to about 20%
+BUCKETS_PER_DOUBLING = 4
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+class Metrics:
+    ''' Thread-safe collector of per-product throughput, API call counts, and
+        per-operation latencies. Snapshots are appended to a JSON-lines file at a
+        fixed interval and, optionally, written to a Prometheus textfile.
+    '''
+    def __init__(self, path=None, textfile=None, interval=30, job=""):
+        ''' Start collecting metrics
+            Keyword arguments:
+              path: JSON-lines metrics file
+              textfile: Prometheus textfile (for the node exporter textfile collector)
+              interval: seconds between snapshots
+              job: job label for the Prometheus textfile
+        '''
+        self.path = path
+        self.textfile = textfile
+        self.job = job
+        self.lock = threading.Lock()
+        self.start = self.last_time = time.time()
+        self.products = {}
+        self.last_products = {}
+        self.calls = {}
+        self.retries = {}
+        self.errors = {}
+        self.latency = {}
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.stop = threading.Event()
+        self.thread = None
+        if path or textfile:
+            self.thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+            self.thread.start()
+
+    def _run(self, interval):
+        ''' Write snapshots until stopped
+            Keyword arguments:
+              interval: seconds between snapshots
+            Returns:
+              None
+        '''
+        while not self.stop.wait(interval):
+            self.emit()
+
+    def _before_call(self, context, **_):
+        ''' botocore before-call handler: start the call timer
+        '''
+        context["metrics_start"] = time.perf_counter()
+
+    def _after_call(self, event_name, context, parsed=None, http_response=None, **_):
+        ''' botocore after-call and after-call-error handler: record the call
+        '''
+        if "metrics_start" not in context:
+            return
+        operation = event_name.split(".", 1)[1]
+        self.observe(operation, time.perf_counter() - context.pop("metrics_start"))
+        retries = (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        failed = http_response is None or http_response.status_code >= 300
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            if retries:
+                self.retries[operation] = self.retries.get(operation, 0) + retries
+            if failed:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def instrument(self, target=None):
+        ''' Time every AWS API call made by a boto3 session or client. Clients
+            inherit the session's handlers when they are created, so the default
+            session should be instrumented before any clients are built.
+            Keyword arguments:
+              target: boto3 Session or client (defaults to the default session)
+            Returns:
+              None
+        '''
+        if target is None:
+            if not boto3.DEFAULT_SESSION:
+                boto3.setup_default_session()
+            target = boto3.DEFAULT_SESSION
+        events = target.meta.events if hasattr(target, "meta") else target.events
+        events.register("before-call", self._before_call, unique_id="metrics-before-call")
+        events.register("after-call", self._after_call, unique_id="metrics-after-call")
+        events.register("after-call-error", self._after_call,
+                        unique_id="metrics-after-call-error")
+
+    def observe(self, operation, seconds):
+        ''' Record the duration of an operation
+            Keyword arguments:
+              operation: operation name
+              seconds: duration
+            Returns:
+              None
+        '''
+        bucket = max(0, math.ceil(math.log2(max(seconds, 1e-6) * 1000) * BUCKETS_PER_DOUBLING))
+        with self.lock:
+            hist = self.latency.setdefault(operation, {"count": 0, "sum": 0, "max": 0,
+                                                       "buckets": {}})
+            hist["count"] += 1
+            hist["sum"] += seconds
+            hist["max"] = max(hist["max"], seconds)
+            hist["buckets"][bucket] = hist["buckets"].get(bucket, 0) + 1
+
+    @contextmanager
+    def timer(self, operation):
+        ''' Context manager that records the duration of its block
+            Keyword arguments:
+              operation: operation name
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(operation, time.perf_counter() - start)
+
+    def add(self, product, objects=0, nbytes=0):
+        ''' Count objects and bytes for a product
+            Keyword arguments:
+              product: product name
+              objects: number of objects
+              nbytes: number of bytes
+            Returns:
+              None
+        '''
+        with self.lock:
+            totals = self.products.setdefault(product, {"objects": 0, "bytes": 0})
+            totals["objects"] += objects
+            totals["bytes"] += nbytes
+
+    def snapshot(self):
+        ''' Return the current metrics. Rates are since the previous snapshot, and
+            latency percentiles are upper bounds of their histogram buckets.
+            Keyword arguments:
+              None
+            Returns:
+              Metrics dict
+        '''
+        now = time.time()
+        with self.lock:
+            window = max(now - self.last_time, 1e-6)
+            products = {}
+            for product, totals in self.products.items():
+                last = self.last_products.get(product, {"objects": 0, "bytes": 0})
+                products[product] = dict(totals,
+                                         objects_per_second=(totals["objects"] - last["objects"])
+                                         / window,
+                                         bytes_per_second=(totals["bytes"] - last["bytes"])
+                                         / window)
+            self.last_products = {product: dict(totals)
+                                  for product, totals in self.products.items()}
+            self.last_time = now
+            latency = {}
+            for operation, hist in self.latency.items():
+                latency[operation] = {"count": hist["count"], "mean": hist["sum"] / hist["count"],
+                                      "max": hist["max"]}
+                for quantile in QUANTILES:
+                    latency[operation][f"p{int(quantile * 100)}"] = \
+                        min(_percentile(hist, quantile), hist["max"])
+            return {"time": datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+                    "elapsed": now - self.start, "products": products,
+                    "calls": dict(self.calls), "retries": dict(self.retries),
+                    "errors": dict(self.errors), "latency": latency}
+
+    def emit(self):
+        ''' Append a snapshot to the metrics file and rewrite the Prometheus textfile
+            Keyword arguments:
+              None
+            Returns:
+              Metrics dict
+        '''
+        snap = self.snapshot()
+        if self.path:
+            with open(self.path, "a", encoding="utf8") as outfile:
+                outfile.write(json.dumps(snap) + "\n")
+        if self.textfile:
+            self._write_textfile(snap)
+        return snap
+
+    def _write_textfile(self, snap):
+        ''' Write a snapshot in the Prometheus text format. The file is replaced
+            atomically so that the collector never reads a partial file.
+            Keyword arguments:
+              snap: metrics dict
+            Returns:
+              None
+        '''
+        job = f'job="{self.job}",' if self.job else ""
+        lines = []
+        for name, field, label in [("objects_total", "objects", "product"),
+                                   ("bytes_total", "bytes", "product")]:
+            lines.append(f"# TYPE hortacloud_{name} counter")
+            lines.extend(f'hortacloud_{name}{{{job}{label}="{product}"}} {totals[field]}'
+                         for product, totals in snap["products"].items())
+        for name, counts in [("api_calls_total", snap["calls"]),
+                             ("api_retries_total", snap["retries"]),
+                             ("api_errors_total", snap["errors"])]:
+            lines.append(f"# TYPE hortacloud_{name} counter")
+            lines.extend(f'hortacloud_{name}{{{job}operation="{operation}"}} {count}'
+                         for operation, count in counts.items())
+        lines.append("# TYPE hortacloud_latency_seconds summary")
+        for operation, stats in snap["latency"].items():
+            for quantile in QUANTILES:
+                lines.append(f'hortacloud_latency_seconds{{{job}operation="{operation}",'
+                             + f'quantile="{quantile}"}} {stats[f"p{int(quantile * 100)}"]}')
+            lines.append(f'hortacloud_latency_seconds_count{{{job}operation="{operation}"}} '
+                         + f'{stats["count"]}')
+            lines.append(f'hortacloud_latency_seconds_sum{{{job}operation="{operation}"}} '
+                         + f'{stats["mean"] * stats["count"]}')
+        tmp = self.textfile + ".tmp"
+        with open(tmp, "w", encoding="utf8") as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.textfile)
+
+    def close(self):
+        ''' Stop the snapshot thread and write a final snapshot
+            Keyword arguments:
+              None
+            Returns:
+              Final metrics dict
+        '''
+        self.stop.set()
+        if self.thread:
+            self.thread.join()
+        return self.emit()
+
+
+# *****************************************************************************
+# * Internal routines                                                         *
+# *****************************************************************************
+
+def _percentile(hist, quantile):
+    ''' Return the upper bound of the histogram bucket holding a quantile
+        Keyword arguments:
+          hist: latency histogram
+          quantile: quantile (0-1)
+        Returns:
+          Latency in seconds
+    '''
+    target = quantile * hist["count"]
+    seen = 0
+    for bucket in sorted(hist["buckets"]):
+        seen += hist["buckets"][bucket]
+        if seen >= target:
+            return 2 ** (bucket / BUCKETS_PER_DOUBLING) / 1000
+    return hist["max"]
+
+
+# *****************************************************************************
+# * Callable routines                                                         *
+# *****************************************************************************
+
+def summary_lines(snap):
+    ''' Return a human-readable summary of a metrics snapshot
+        Keyword arguments:
+          snap: metrics dict
+        Returns:
+          List of lines
+    '''
+    lines = []
+    elapsed = max(snap["elapsed"], 1e-6)
+    for product, totals in snap["products"].items():
+        lines.append(f"{product}: {totals['objects']:,} objects, {totals['bytes']:,} bytes "
+                     + f"({totals['objects'] / elapsed:.1f} objects/s, "
+                     + f"{totals['bytes'] / elapsed / 1024 / 1024:.1f} MB/s)")
+    for operation, stats in sorted(snap["latency"].items()):
+        calls = snap["calls"].get(operation, stats["count"])
+        lines.append(f"{operation}: {calls:,} call(s), p50 {stats['p50']:.3f}s, "
+                     + f"p95 {stats['p95']:.3f}s, p99 {stats['p99']:.3f}s, "
+                     + f"{snap['retries'].get(operation, 0)} retries, "
+                     + f"{snap['errors'].get(operation, 0)} errors")
+    return lines
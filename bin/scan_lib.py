@@ -0,0 +1,198 @@
+''' Library of functions for scanning local directory trees
+'''
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import heapq
+import json
+import os
+import sqlite3
+import threading
+
+
+class ScanCache:
+    ''' Persistent cache (SQLite) of per-directory scan results, keyed by directory
+        path and mtime. A directory's mtime changes when entries are added, removed,
+        or renamed, but not when an existing file is rewritten in place.
+    '''
+    def __init__(self, path):
+        ''' Open (and create if necessary) a scan cache
+            Keyword arguments:
+              path: SQLite file path
+        '''
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS directory (path TEXT PRIMARY KEY, "
+                          + "mtime INTEGER, stats TEXT)")
+
+    def get(self, path, mtime):
+        ''' Return cached stats for a directory
+            Keyword arguments:
+              path: directory path
+              mtime: current directory mtime (ns)
+            Returns:
+              Stats dict, or None if not cached or the directory has changed
+        '''
+        with self.lock:
+            row = self.conn.execute("SELECT mtime,stats FROM directory WHERE path=?",
+                                    (path,)).fetchone()
+        if not row or row[0] != mtime:
+            return None
+        return json.loads(row[1])
+
+    def put(self, path, mtime, stats):
+        ''' Cache stats for a directory
+            Keyword arguments:
+              path: directory path
+              mtime: directory mtime (ns)
+              stats: stats dict
+            Returns:
+              None
+        '''
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO directory VALUES (?,?,?)",
+                              (path, mtime, json.dumps(stats)))
+
+    def close(self):
+        ''' Close the cache
+        '''
+        self.conn.close()
+
+
+# *****************************************************************************
+# * Internal routines                                                         *
+# *****************************************************************************
+
+def _scan_directory(path, cache, top):
+    ''' Return stats for the files directly in a directory, and its subdirectories
+        Keyword arguments:
+          path: directory path
+          cache: ScanCache (or None)
+          top: number of largest files to keep
+        Returns:
+          Stats dict (files, bytes, histogram, largest, dirs)
+    '''
+    mtime = os.stat(path).st_mtime_ns
+    stats = cache.get(path, mtime) if cache else None
+    if stats:
+        return stats
+    stats = {"files": 0, "bytes": 0, "histogram": {}, "largest": [], "dirs": []}
+    sizes = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=True):
+                stats["dirs"].append(entry.name)
+            elif entry.is_file(follow_symlinks=True):
+                size = entry.stat().st_size
+                sizes.append((size, entry.name))
+                stats["files"] += 1
+                stats["bytes"] += size
+                bucket = str(size.bit_length())
+                stats["histogram"][bucket] = stats["histogram"].get(bucket, 0) + 1
+    stats["largest"] = heapq.nlargest(top, sizes)
+    if cache:
+        cache.put(path, mtime, stats)
+    return stats
+
+
+# *****************************************************************************
+# * Callable routines                                                         *
+# *****************************************************************************
+
+def scan_tree(path, workers=16, cache=None, top=10):
+    ''' Scan a directory tree with a pool of os.scandir workers
+        Keyword arguments:
+          path: directory path
+          workers: number of concurrent scanners
+          cache: ScanCache (unchanged directories are not re-scanned)
+          top: number of largest files to report
+        Returns:
+          Dictionary with file count, total bytes, size histogram (file counts keyed
+          by power-of-two size bucket: bucket n holds sizes < 2**n), and list of
+          (size, path) tuples for the largest files
+    '''
+    result = {"files": 0, "bytes": 0, "histogram": {}, "largest": []}
+    if os.path.isfile(path):
+        size = os.path.getsize(path)
+        return {"files": 1, "bytes": size, "histogram": {size.bit_length(): 1},
+                "largest": [(size, path)]}
+    largest = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_directory, path, cache, top): path}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dpath = pending.pop(future)
+                stats = future.result()
+                result["files"] += stats["files"]
+                result["bytes"] += stats["bytes"]
+                for bucket, count in stats["histogram"].items():
+                    result["histogram"][int(bucket)] = \
+                        result["histogram"].get(int(bucket), 0) + count
+                largest = heapq.nlargest(top, largest + [(size, os.path.join(dpath, name))
+                                                         for size, name in stats["largest"]])
+                for name in stats["dirs"]:
+                    subdir = os.path.join(dpath, name)
+                    pending[executor.submit(_scan_directory, subdir, cache, top)] = subdir
+    result["largest"] = largest
+    return result
+
+
+def human_size(size):
+    ''' Return a human-readable size
+        Keyword arguments:
+          size: size in bytes
+        Returns:
+          Size string
+    '''
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if size < 1024 or unit == "TB":
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+
+
+def shard_tree(path, count, workers=16, cache=None):
+    ''' Split a directory tree into shards of roughly equal total size. The tree is
+        divided into units (files and directories), expanding the largest directories
+        into their contents until no directory is bigger than an even share, and the
+        units are assigned to shards largest-first (longest processing time).
+        Keyword arguments:
+          path: directory path
+          count: number of shards
+          workers: number of concurrent scanners
+          cache: ScanCache
+        Returns:
+          List of (bytes, members) tuples, where members are paths relative to the
+          directory (directories end with "/")
+    '''
+    def entries(rel):
+        units = []
+        with os.scandir(os.path.join(path, rel)) as dentries:
+            for entry in dentries:
+                relpath = os.path.join(rel, entry.name) if rel else entry.name
+                if entry.is_dir(follow_symlinks=True):
+                    units.append((scan_tree(entry.path, workers, cache)["bytes"], relpath, True))
+                elif entry.is_file(follow_symlinks=True):
+                    units.append((entry.stat().st_size, relpath, False))
+        return units
+
+    units = entries("")
+    share = sum(unit[0] for unit in units) / count
+    while len(units) < count * 8:
+        dirs = [unit for unit in units if unit[2]]
+        if not dirs:
+            break
+        largest = max(dirs)
+        if len(units) >= count and largest[0] <= share:
+            break
+        units.remove(largest)
+        units.extend(entries(largest[1]))
+    shards = [(0, idx, []) for idx in range(count)]
+    for size, relpath, isdir in sorted(units, reverse=True):
+        total, idx, members = heapq.heappop(shards)
+        members.append(relpath + "/" if isdir else relpath)
+        heapq.heappush(shards, (total + size, idx, members))
+    return [(total, members) for total, _, members in sorted(shards, key=lambda shard: shard[1])
+            if members]
@@ -4,17 +4,28 @@
 '''
 
 import argparse
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import hashlib
 import json
 import os
+import re
 import socket
+import sqlite3
 import sys
-import boto3
+import threading
+import time
+from botocore.exceptions import ClientError
 import inquirer
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import colorlog
 from tqdm.auto import tqdm
-from aws_s3_lib import get_prefixes
+from aws_s3_lib import ClientRegistry, ListingCache, cached_objects, get_prefixes, \
+                       iter_objects, set_registry
+from metrics_lib import Metrics, summary_lines
 
 #pylint: disable=W0703
 
@@ -25,16 +36,38 @@ AREA = {}
 MAP = {}
 STRUCT = {}
 PARENT = {}
+ANCESTORS = {}
+FIRST = {}
+EULER = []
+SPARSE = []
 MISSING = {}
 DATE = {}
 MISSING_NEURON = {}
 S3_CLIENT = S3_RESOURCE = ""
+CACHE = None
+NEURON_POOL = None
+SESSION = None
+LATENCY = {}
+METRICS = None
+INDEX = []
+COUNT_LOCK = threading.Lock()
 # General
 BUCKET = "janelia-mouselight-imagery"
 URL_PREFIX = {"http": f"https://{BUCKET}.s3.amazonaws.com",
               "s3": f"s3://{BUCKET}"}
 TEMPLATE = "An exception of type %s occurred. Arguments:\n%s"
-COUNT = {"date_aws" : 0, "insert": 0, "metadata": 0}
+COUNT = {"date_aws" : 0, "insert": 0, "metadata": 0, "bytes": 0,
+         "created": 0, "updated": 0, "unchanged": 0}
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "hortacloud-utilities",
+                          "s3_listing.db")
+MAPPING_FILE = os.path.join(os.path.expanduser("~"), ".cache", "hortacloud-utilities",
+                            "neuronbrowser_mapping.db")
+SNAPSHOT_VERSION = 1
+# Consolidated neuron index: sorted JSON lines, and a table of the byte offset of
+# every INDEX_BLOCK-th line for ranged reads
+INDEX_KEY = "neurons/index.jsonl"
+INDEX_OFFSETS_KEY = "neurons/index-offsets.json"
+INDEX_BLOCK = 64
 
 # -----------------------------------------------------------------------------
 
@@ -47,9 +80,34 @@ def terminate_program(msg=None):
     """
     if msg:
         LOGGER.critical(msg)
+    if METRICS:
+        for line in summary_lines(METRICS.close()):
+            LOGGER.info(line)
     sys.exit(-1 if msg else 0)
 
 
+def get_session():
+    ''' Return the shared HTTP session (created on first use). The session pools
+        connections and retries connection errors and 5xx responses with
+        exponential backoff.
+        Keyword arguments:
+          None
+        Returns:
+          requests Session
+    '''
+    global SESSION # pylint: disable=W0603
+    if not SESSION:
+        retry = Retry(total=ARG.RETRIES, backoff_factor=0.5,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET", "POST"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=max(10, ARG.WORKERS), max_retries=retry)
+        SESSION = requests.Session()
+        SESSION.mount("http://", adapter)
+        SESSION.mount("https://", adapter)
+        SESSION.headers["Accept-Encoding"] = "gzip, deflate"
+    return SESSION
+
+
 def call_responder(server, endpoint, payload='', authenticate=False):
     ''' Call a responder
         Keyword arguments:
@@ -64,26 +122,31 @@ def call_responder(server, endpoint, payload='', authenticate=False):
     if not CONFIG[server]['url']:
         terminate_program("No URL found for %s" % (server))
     url = CONFIG[server]['url'] + endpoint
+    label = "/".join([server, endpoint]) if endpoint else server
     headers = {}
     if authenticate:
         headers["Authorization"] = "Bearer " + os.environ['NEURONBROWSER_JWT']
+    start = time.perf_counter()
     try:
         if payload:
             headers['Accept'] = 'application/json'
-            headers["Accept-Encoding"] = "gzip, deflate, br"
-            headers["Connection"] = "keep-alive"
             headers["Content-Type"] = "application/json"
             headers["DNT"] = "1"
             headers['host'] = socket.gethostname()
             headers["Origin"] = "http://neuronbrowser.mouselight.int.janelia.org"
-            req = requests.post(url, headers=headers, data=payload)
+            query = re.search(r"\w+", json.loads(payload).get("query", ""))
+            if query:
+                label += " " + query[0]
+            req = get_session().post(url, headers=headers, data=payload, timeout=ARG.TIMEOUT)
         else:
-            if authenticate:
-                req = requests.get(url, headers=headers)
-            else:
-                req = requests.get(url)
+            req = get_session().get(url, headers=headers, timeout=ARG.TIMEOUT)
     except requests.exceptions.RequestException as err:
         terminate_program(err)
+    elapsed = time.perf_counter() - start
+    LATENCY.setdefault(label, []).append(elapsed)
+    if METRICS:
+        METRICS.observe(label, elapsed)
+    LOGGER.debug("%s: %.3fs (%d bytes)", label, elapsed, len(req.content))
     if req.status_code == 200:
         try:
             return req.json()
@@ -102,42 +165,121 @@ def call_responder(server, endpoint, payload='', authenticate=False):
 def initialize_program():
     """ Initialize
     """
-    global CONFIG, AWS, S3_CLIENT, S3_RESOURCE # pylint: disable=W0603
+    global CONFIG, AWS, S3_CLIENT, S3_RESOURCE, CACHE, METRICS # pylint: disable=W0603
+    if ARG.METRICS_FILE or ARG.PROMETHEUS_FILE:
+        METRICS = Metrics(ARG.METRICS_FILE, ARG.PROMETHEUS_FILE, interval=ARG.METRICS_INTERVAL,
+                          job="update_aws_neurons")
+        # Instrument the default session before any clients are created
+        METRICS.instrument()
+    if ARG.CACHE:
+        CACHE = ListingCache(ARG.CACHE_FILE, ttl=int(ARG.CACHE_TTL * 3600))
     data = call_responder('config', 'config/rest_services')
     CONFIG = data['config']
     data = call_responder('config', 'config/aws')
     AWS = data['config']
+    # One registry (and connection pool) is shared by this program and aws_s3_lib.
+    # Assumed role credentials are refreshed before they expire.
+    pool = max(10, 2 * ARG.WORKERS)
     if ARG.MANIFOLD == "dev":
-        S3_CLIENT = boto3.client('s3')
-        S3_RESOURCE = boto3.resource('s3')
+        registry = ClientRegistry(max_pool_connections=pool)
     else:
-        sts_client = boto3.client('sts')
         try:
-            aro = sts_client.assume_role(RoleArn=AWS['role_arn'],
-                                         RoleSessionName="AssumeRoleSession1")
+            registry = ClientRegistry(role_arn=AWS['role_arn'],
+                                      session_name="AssumeRoleSession1",
+                                      max_pool_connections=pool)
         except Exception as err:
             LOGGER.error("Could not assume STS role")
             terminate_program(TEMPLATE % (type(err).__name__, err.args))
-        credentials = aro['Credentials']
-        S3_CLIENT = boto3.client('s3',
-                                 aws_access_key_id=credentials['AccessKeyId'],
-                                 aws_secret_access_key=credentials['SecretAccessKey'],
-                                 aws_session_token=credentials['SessionToken'])
-        S3_RESOURCE = boto3.resource('s3',
-                                     aws_access_key_id=credentials['AccessKeyId'],
-                                     aws_secret_access_key=credentials['SecretAccessKey'],
-                                     aws_session_token=credentials['SessionToken'])
+        if METRICS:
+            METRICS.instrument(registry.session)
+    set_registry(registry)
+    S3_CLIENT = registry.client('s3')
+    S3_RESOURCE = registry.resource('s3')
 
 
-def get_mapping():
-    ''' Get mapping of dates to neurons and populate MAP dictionary.
+def load_mapping():
+    ''' Populate the MAP, AREA, STRUCT, and PARENT dictionaries from a mapping snapshot
+        Keyword arguments:
+          None
+        Returns:
+          True if a current snapshot was loaded, False otherwise
+    '''
+    if not os.path.exists(ARG.MAPPING_FILE):
+        return False
+    conn = sqlite3.connect(ARG.MAPPING_FILE)
+    try:
+        meta = dict(conn.execute("SELECT key,value FROM meta"))
+        if meta.get("version") != str(SNAPSHOT_VERSION):
+            LOGGER.warning("Ignoring mapping snapshot with version %s", meta.get("version"))
+            return False
+        age = time.time() - float(meta["created"])
+        if ARG.MAPPING_TTL and age > ARG.MAPPING_TTL * 3600:
+            LOGGER.info("Mapping snapshot is %.1f hours old", age / 3600)
+            return False
+        for sdate, tag, nid in conn.execute("SELECT date,tag,id FROM injection ORDER BY rowid"):
+            MAP.setdefault(sdate, {})[tag] = nid
+        AREA.update(conn.execute("SELECT date,name FROM injection_area ORDER BY rowid"))
+        for sid, name, parent in conn.execute("SELECT structure_id,name,parent FROM brain_area "
+                                              + "ORDER BY rowid"):
+            PARENT[sid] = {"name": name, "parent": parent}
+            STRUCT[name] = sid
+    except sqlite3.DatabaseError as err:
+        LOGGER.warning("Could not read mapping snapshot %s: %s", ARG.MAPPING_FILE, err)
+        for mapping in (MAP, AREA, PARENT, STRUCT):
+            mapping.clear()
+        return False
+    finally:
+        conn.close()
+    LOGGER.info("Loaded mapping snapshot %s from %s", meta["marker"][:12],
+                datetime.fromtimestamp(float(meta["created"])).strftime("%Y-%m-%d %H:%M:%S"))
+    return True
+
+
+def save_mapping(marker):
+    ''' Write the MAP, AREA, STRUCT, and PARENT dictionaries to a mapping snapshot
+        Keyword arguments:
+          marker: content hash of the NeuronBrowser responses
+        Returns:
+          None
+    '''
+    if os.path.dirname(ARG.MAPPING_FILE):
+        os.makedirs(os.path.dirname(ARG.MAPPING_FILE), exist_ok=True)
+    conn = sqlite3.connect(ARG.MAPPING_FILE)
+    with conn:
+        conn.executescript('''
+            DROP TABLE IF EXISTS meta;
+            DROP TABLE IF EXISTS injection;
+            DROP TABLE IF EXISTS injection_area;
+            DROP TABLE IF EXISTS brain_area;
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE injection (date TEXT, tag TEXT, id TEXT);
+            CREATE TABLE injection_area (date TEXT PRIMARY KEY, name TEXT);
+            CREATE TABLE brain_area (structure_id PRIMARY KEY, name TEXT, parent);
+        ''')
+        conn.executemany("INSERT INTO meta VALUES (?,?)",
+                         [("version", str(SNAPSHOT_VERSION)), ("created", str(time.time())),
+                          ("marker", marker)])
+        conn.executemany("INSERT INTO injection VALUES (?,?,?)",
+                         [(sdate, tag, nid) for sdate, neurons in MAP.items()
+                          for tag, nid in neurons.items()])
+        conn.executemany("INSERT INTO injection_area VALUES (?,?)", AREA.items())
+        conn.executemany("INSERT INTO brain_area VALUES (?,?,?)",
+                         [(sid, row["name"], row["parent"]) for sid, row in PARENT.items()])
+    conn.close()
+
+
+def fetch_mapping():
+    ''' Fetch the mapping of dates to neurons and the brain area hierarchy from
+        NeuronBrowser and populate the MAP, AREA, STRUCT, and PARENT dictionaries.
         Keyword arguments:
           None
         Returns:
           None
     '''
+    marker = hashlib.sha256()
     payload = {"query":"{injections {sample {sampleDate} neurons {idString tag} brainArea {name}}}"}
     response = call_responder("neuronbrowser", "", json.dumps(payload))
+    marker.update(json.dumps(response, sort_keys=True).encode("utf-8"))
     for row in tqdm(response["data"]["injections"], desc="Injections"):
         if not (row["sample"] and row['neurons']):
             continue
@@ -149,6 +291,7 @@ def get_mapping():
         AREA[sdate] = row["brainArea"]["name"]
     payload = {"query":"{brainAreas{structureId name parentStructureId}}"}
     response = call_responder("neuronbrowser", "", json.dumps(payload))
+    marker.update(json.dumps(response, sort_keys=True).encode("utf-8"))
     for row in tqdm(response["data"]["brainAreas"], desc="Brain areas"):
         if row["name"] in STRUCT:
             terminate_program(f"{row['name']} is duplicated")
@@ -157,6 +300,59 @@ def get_mapping():
         PARENT[row["structureId"]] = {"name": row["name"],
                                       "parent": row["parentStructureId"]}
         STRUCT[row["name"]] = row["structureId"]
+    save_mapping(marker.hexdigest())
+
+
+def build_ancestry():
+    ''' Build the brain area ancestry index from PARENT: a table of ancestor IDs for
+        every area, and an Euler tour with a sparse table of minimum-depth areas for
+        constant-time lowest common ancestor lookups.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    children = {}
+    for sid, row in PARENT.items():
+        if row["parent"] in PARENT:
+            children.setdefault(row["parent"], []).append(sid)
+    for root in [sid for sid, row in PARENT.items() if row["parent"] not in PARENT]:
+        ANCESTORS[root] = ()
+        FIRST[root] = len(EULER)
+        EULER.append(root)
+        stack = [(root, iter(children.get(root, [])))]
+        while stack:
+            sid, kids = stack[-1]
+            child = next(kids, None)
+            if child is None:
+                stack.pop()
+                if stack:
+                    EULER.append(stack[-1][0])
+                continue
+            ANCESTORS[child] = (sid,) + ANCESTORS[sid]
+            FIRST[child] = len(EULER)
+            EULER.append(child)
+            stack.append((child, iter(children.get(child, []))))
+    SPARSE.append(list(EULER))
+    span = 1
+    while 2 * span <= len(EULER):
+        prev = SPARSE[-1]
+        SPARSE.append([min(prev[idx], prev[idx + span], key=lambda sid: len(ANCESTORS[sid]))
+                       for idx in range(len(EULER) - 2 * span + 1)])
+        span *= 2
+
+
+def get_mapping():
+    ''' Get mapping of dates to neurons and populate MAP dictionary. The mapping is
+        loaded from a local snapshot unless it is missing, stale, or a refresh is forced.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if ARG.REFRESH_MAPPING or not load_mapping():
+        fetch_mapping()
+    build_ancestry()
 
 
 def read_object(key):
@@ -172,8 +368,54 @@ def read_object(key):
         return None
     except Exception as err:
         terminate_program(TEMPLATE % (type(err).__name__, err.args))
-    txt = obj['Body'].read().decode('utf-8')
-    return txt
+    body = obj['Body'].read()
+    with COUNT_LOCK:
+        COUNT["bytes"] += len(body)
+    if METRICS:
+        METRICS.add("/".join(key.split("/")[:2]), 1, len(body))
+    return body.decode('utf-8')
+
+
+def get_neurons(pre):
+    ''' Return the files in each neuron folder under a tracings date prefix, from a
+        single listing of the date. If the listing cache is enabled, a cached listing
+        is checked with one delimiter listing of the date, and only neuron folders
+        that were added are listed; the whole date is re-listed when the cached
+        listing has expired.
+        Keyword arguments:
+          pre: tracings date prefix
+        Returns:
+          Dictionary (keyed by neuron name) of file sizes keyed by file name
+    '''
+    pre += "/"
+    if CACHE:
+        records = cached_objects(BUCKET, pre, CACHE)
+    else:
+        records = iter_objects(BUCKET, pre, full=True)
+    neurons = {}
+    for rec in records:
+        name, sep, file = rec.key[len(pre):].partition("/")
+        if sep:
+            neurons.setdefault(name, {})[file] = rec.size
+    return neurons
+
+
+def lowest_common_ancestor(sid1, sid2):
+    ''' Return the lowest common ancestor of two brain areas
+        Keyword arguments:
+          sid1: area ID
+          sid2: area ID
+        Returns:
+          Area ID (None if the areas are not in the same hierarchy)
+    '''
+    if sid1 not in ANCESTORS or sid2 not in ANCESTORS:
+        return None
+    if (ANCESTORS[sid1][-1:] or (sid1,)) != (ANCESTORS[sid2][-1:] or (sid2,)):
+        return None
+    first, last = sorted((FIRST[sid1], FIRST[sid2]))
+    level = (last - first + 1).bit_length() - 1
+    return min(SPARSE[level][first], SPARSE[level][last - (1 << level) + 1],
+               key=lambda sid: len(ANCESTORS[sid]))
 
 
 def traverse_struct(sid, additional):
@@ -182,90 +424,265 @@ def traverse_struct(sid, additional):
           sid: area ID
           additional: additional areas
         Returns:
-          Parent ID, additional areas
+          Root ID, additional areas
     '''
-    if sid not in PARENT or not PARENT[sid]["parent"]:
+    if not ANCESTORS.get(sid):
         return None, additional
-    psid = PARENT[sid]["parent"]
-    if psid:
-        if PARENT[psid]["name"]:
-            additional += "\n" + PARENT[psid]["name"]
-        if "parent" in PARENT[psid] and PARENT[psid]["parent"]:
-            psid, additional = traverse_struct(psid, additional)
-        return psid, additional
+    names = [PARENT[psid]["name"] for psid in ANCESTORS[sid] if PARENT[psid]["name"]]
+    return ANCESTORS[sid][-1], additional + "".join("\n" + name for name in names)
+
+
+def process_neuron(pre, date, name, files):
+    ''' Build the metadata for a single neuron
+        Keyword arguments:
+          pre: tracings date prefix
+          date: sample date
+          name: neuron name
+          files: dictionary of file sizes keyed by file name
+        Returns:
+          Neuron metadata dict
+    '''
+    payload = {"originalName": name}
+    somaloc = None
+    if files.get("soma.txt"):
+        somaloc = read_object("/".join([pre, name, "soma.txt"]))
+    if somaloc:
+        LOGGER.debug("%s, %s, %s", name, somaloc, AREA[date])
+        payload["somaLocation"] = somaloc
+        payload["injectionLocation"] = AREA[date]
+        if ARG.HIERARCHY:
+            # Areas missing from NeuronBrowser are only reported with --hierarchy
+            newloc = somaloc.strip().replace(",", "")
+            if newloc not in STRUCT:
+                MISSING[somaloc] = True
+            else:
+                payload["somaLocationHierarchy"] = [PARENT[sid]["name"] for sid
+                                                    in ANCESTORS.get(STRUCT[newloc], ())]
+    swc_prefix = "/".join([pre, name])
+    for swc in ["consensus", "dendrite"]:
+        if files.get(swc + ".swc"):
+            key = "/".join([swc_prefix, swc]) + ".swc"
+            payload[swc] = "/".join(["../..", key])
+    return payload
+
+
+def process_date(tloc, date):
+    ''' Build the metadata for every mapped neuron on a date
+        Keyword arguments:
+          tloc: tracings location
+          date: sample date
+        Returns:
+          Metadata dict keyed by neuron ID (None if the date has no neuron mappings)
+    '''
+    DATE[date] = True
+    if date not in MAP:
+        LOGGER.warning("%s has no neuron mappings", date)
+        MISSING_NEURON[date] = True
+        return None
+    pre = "/".join(["tracings", tloc, date])
+    neurons = get_neurons(pre)
+    if not neurons:
+        terminate_program(f"{tloc}/{date} has no prefixes on AWS S3")
+    names = [name for name in neurons if name in MAP[date] and name.startswith("G-")]
+    mapper = NEURON_POOL.map if NEURON_POOL else map
+    payloads = mapper(lambda name: process_neuron(pre, date, name, neurons[name]), names)
+    return {MAP[date][name]: payload for name, payload in zip(names, payloads)}
+
+
+def remote_digest(key):
+    ''' Return the ETag and stored content digest of an S3 object
+        Keyword arguments:
+          key: object key
+        Returns:
+          ETag, digest (None, None if the object does not exist)
+    '''
+    try:
+        head = S3_CLIENT.head_object(Bucket=BUCKET, Key=key)
+    except ClientError as err:
+        if err.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None, None
+        terminate_program(TEMPLATE % (type(err).__name__, err.args))
+    return head["ETag"].strip('"'), head.get("Metadata", {}).get("sha256")
+
+
+def put_json(key, payload, etag=None):
+    ''' Upload a JSON payload. In incremental mode, the upload is skipped if the
+        existing object's ETag (MD5 of the body) or stored SHA-256 digest of the
+        canonical JSON matches.
+        Keyword arguments:
+          key: object key
+          payload: JSON payload
+          etag: known ETag of the existing object (from a listing)
+        Returns:
+          None
+    '''
+    body = json.dumps(payload).encode("utf-8")
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True,
+                                       separators=(",", ":")).encode("utf-8")).hexdigest()
+    put_body(key, body, digest, etag)
+
+
+def put_body(key, body, digest, etag=None):
+    ''' Upload an object body. In incremental mode, the upload is skipped if the
+        existing object's ETag (MD5 of the body) or stored SHA-256 digest matches.
+        Keyword arguments:
+          key: object key
+          body: object body (bytes)
+          digest: SHA-256 digest of the content, stored as object metadata
+          etag: known ETag of the existing object (from a listing)
+        Returns:
+          None
+    '''
+    if ARG.INCREMENTAL:
+        md5 = hashlib.md5(body).hexdigest()
+        status = "unchanged"
+        if etag != md5:
+            etag, stored = remote_digest(key)
+            if etag is None:
+                status = "created"
+            elif etag != md5 and stored != digest:
+                status = "updated"
+        COUNT[status] += 1
+        if status == "unchanged":
+            LOGGER.debug(f"Unchanged {BUCKET}/{key}")
+            return
+    if ARG.WRITE:
+        try:
+            obj = S3_RESOURCE.Object(BUCKET, key)
+            _ = obj.put(Body=body, Metadata={"sha256": digest})
+        except Exception as err:
+            terminate_program(TEMPLATE % (type(err).__name__, err.args))
+        if METRICS:
+            METRICS.add("metadata", 1, len(body))
+    LOGGER.debug(f"Put {BUCKET}/{key}")
+
+
+def write_metadata(tloc, date, mdata, etags):
+    ''' Write the metadata file(s) for a date
+        Keyword arguments:
+          tloc: tracings location
+          date: sample date
+          mdata: metadata dict keyed by neuron ID
+          etags: dictionary of existing metadata file ETags keyed by object key
+        Returns:
+          None
+    '''
+    key = "/".join(["neurons", tloc, date, "metadata.json"])
+    COUNT["metadata"] += 1
+    payload = {"title": date + " MouseLight published neurons",
+               "neurons": mdata}
+    # AWS S3
+    put_json(key, payload, etags.get(key))
+    if tloc == "tracing_complete":
+        put_json("/".join(["images", date, "neurons.json"]), payload)
 
 
 def process_prefix(tloc):
-    ''' Return the contents of a specified S3 object
+    ''' Create metadata files for every date in a tracings location. With more than
+        one worker, dates (and the neurons within them) are processed concurrently;
+        metadata files are always written in date order.
         Keyword arguments:
           tloc: tracings location
         Returns:
           None
     '''
+    if CACHE and ARG.INVALIDATE:
+        LOGGER.info("Invalidated %d cached listings for %s",
+                    CACHE.invalidate(BUCKET, "tracings/" + tloc), tloc)
     dates = get_prefixes(BUCKET, prefix="tracings/" + tloc)
-    for date in tqdm(dates, desc=tloc, position=0, leave=False):
-        mdata = {}
-        DATE[date] = True
-        if date not in MAP:
-            LOGGER.warning("%s has no neuron mappings", date)
-            MISSING_NEURON[date] = True
-            continue
-        pre = "/".join(["tracings", tloc, date])
-        names = get_prefixes(BUCKET, prefix=pre)
-        if not names:
-            terminate_program(f"{tloc}/{date} has no prefixes on AWS S3")
-        mdata = {}
-        #for name in tqdm(names, desc="Neuron tag", position=1, leave=False):
-        for name in names:
-            if name not in MAP[date]:
-                #LOGGER.warning("Name %s in not in mapping for %s", name, date)
-                continue
-            if not name.startswith("G-"):
-                continue
-            populated = True
-            payload = {"originalName": name}
-            key = "/".join([pre, name, "soma.txt"])
-            somaloc = read_object(key)
-            if somaloc:
-                LOGGER.debug("%s, %s, %s", name, somaloc, AREA[date])
-                payload["somaLocation"] = somaloc
-                payload["injectionLocation"] = AREA[date]
-                newloc = AREA[date]
-                #newloc = somaloc.replace(",", "")
-                #if newloc not in STRUCT:
-                #    MISSING[somaloc] = True
-                #elif STRUCT[newloc]:
-                #    sid, additional = traverse_struct(STRUCT[newloc], "")
-                #    newloc += additional
-            swc_prefix = "/".join([pre, name])
-            for swc in ["consensus", "dendrite"]:
-                key = "/".join([swc_prefix, swc]) + ".swc"
-                if read_object(key):
-                    payload[swc] = "/".join(["../..", key])
-            mdata[MAP[date][name]] = payload
-        if populated:
-            key = "/".join(["neurons", tloc, date, "metadata.json"])
-            COUNT["metadata"] += 1
-            payload = {"title": date + " MouseLight published neurons",
-                       "neurons": mdata}
-            # AWS S3
-            if ARG.WRITE:
-                try:
-                    obj = S3_RESOURCE.Object(BUCKET, key)
-                    _ = obj.put(Body=json.dumps(payload))
-                except Exception as err:
-                    terminate_program(TEMPLATE % (type(err).__name__, err.args))
-            else:
-                LOGGER.debug(f"Put {BUCKET}/{key}")
-            if tloc == "tracing_complete":
-                key = "/".join(["images", date, "neurons.json"])
-                if ARG.WRITE:
-                    try:
-                        obj = S3_RESOURCE.Object(BUCKET, key)
-                        _ = obj.put(Body=json.dumps(payload))
-                    except Exception as err:
-                        terminate_program(TEMPLATE % (type(err).__name__, err.args))
-                LOGGER.debug(f"Put {BUCKET}/{key}")
+    etags = {}
+    if ARG.INCREMENTAL:
+        etags = {rec.key: rec.etag
+                 for rec in iter_objects(BUCKET, f"neurons/{tloc}/", full=True)}
+    executor = ThreadPoolExecutor(max_workers=ARG.WORKERS) if ARG.WORKERS > 1 else None
+    mapper = executor.map if executor else map
+    results = mapper(lambda date: process_date(tloc, date), dates)
+    for date, mdata in tqdm(zip(dates, results), total=len(dates), desc=tloc,
+                            position=0, leave=False):
+        if mdata:
+            write_metadata(tloc, date, mdata, etags)
+            INDEX.extend(index_record(tloc, date, nid, payload)
+                         for nid, payload in mdata.items())
+    if executor:
+        executor.shutdown()
+
+
+def index_record(tloc, date, nid, payload):
+    ''' Return the neuron index record for a neuron
+        Keyword arguments:
+          tloc: tracings location
+          date: sample date
+          nid: neuron ID
+          payload: neuron metadata dict
+        Returns:
+          Index record dict
+    '''
+    record = {"id": nid, "tracings": tloc, "date": date,
+              "originalName": payload["originalName"],
+              "somaLocation": payload.get("somaLocation")}
+    for swc in ["consensus", "dendrite"]:
+        if payload.get(swc):
+            record[swc] = payload[swc][len("../../"):]
+    return record
+
+
+def write_index(tlocs):
+    ''' Write the consolidated neuron index. Records for tracings locations that
+        were not processed in this run are kept from the existing index. The index
+        is one JSON line per neuron, sorted by neuron ID, and the offset table lists
+        the first ID and byte offset of every block of INDEX_BLOCK lines, so a
+        neuron can be found with one ranged GET.
+        Keyword arguments:
+          tlocs: processed tracings locations
+        Returns:
+          None
+    '''
+    existing = read_object(INDEX_KEY) or ""
+    records = [rec for rec in map(json.loads, existing.splitlines())
+               if rec["tracings"] not in tlocs] + INDEX
+    records.sort(key=lambda rec: (rec["id"], rec["tracings"]))
+    lines = [json.dumps(rec, sort_keys=True, separators=(",", ":")).encode("utf-8") + b"\n"
+             for rec in records]
+    blocks = []
+    offset = 0
+    for idx, line in enumerate(lines):
+        if not idx % INDEX_BLOCK:
+            blocks.append([records[idx]["id"], offset])
+        offset += len(line)
+    body = b"".join(lines)
+    # The index is written first; its ETag lets readers detect a newer index
+    put_body(INDEX_KEY, body, hashlib.sha256(body).hexdigest())
+    put_json(INDEX_OFFSETS_KEY, {"version": 1, "index": INDEX_KEY, "count": len(records),
+                                 "size": offset, "etag": hashlib.md5(body).hexdigest(),
+                                 "block": INDEX_BLOCK, "blocks": blocks})
+    print(f"Neurons in index:        {len(records)}")
+
+
+def lookup_neuron(nid):
+    ''' Find a neuron in the consolidated index with a ranged read of the block(s)
+        that can hold its ID
+        Keyword arguments:
+          nid: neuron ID
+        Returns:
+          List of index records (one per tracings location)
+    '''
+    offsets = read_object(INDEX_OFFSETS_KEY)
+    if not offsets:
+        terminate_program(f"{INDEX_OFFSETS_KEY} not found")
+    offsets = json.loads(offsets)
+    firsts = [block[0] for block in offsets["blocks"]]
+    end = bisect_right(firsts, nid)
+    if not end:
+        # The ID sorts before the first block (or the index is empty)
+        return []
+    start = max(bisect_left(firsts, nid) - 1, 0)
+    last = offsets["blocks"][end][1] - 1 if end < len(firsts) else offsets["size"] - 1
+    try:
+        obj = S3_CLIENT.get_object(Bucket=BUCKET, Key=offsets["index"], IfMatch=offsets["etag"],
+                                   Range=f"bytes={offsets['blocks'][start][1]}-{last}")
+    except ClientError as err:
+        terminate_program(TEMPLATE % (type(err).__name__, err.args))
+    return [rec for rec in map(json.loads, obj["Body"].read().splitlines()) if rec["id"] == nid]
 
 
 def process_neurons():
@@ -275,18 +692,36 @@ def process_neurons():
         Returns:
           None
     '''
+    global NEURON_POOL # pylint: disable=W0603
     get_mapping()
-    choices = {"Finished neurons": "Finished_Neurons",
-               "Tracing complete": "tracing_complete"}
-    quest = [inquirer.Checkbox('checklist',
-                               message='Select tracings to process',
-                               choices=choices.keys())]
-    tracings = inquirer.prompt(quest)
-    for tloc in [choices[key] for key in tracings["checklist"]]:
+    if ARG.WORKERS > 1:
+        NEURON_POOL = ThreadPoolExecutor(max_workers=ARG.WORKERS)
+    tlocs = ARG.TRACINGS
+    if not tlocs:
+        choices = {"Finished neurons": "Finished_Neurons",
+                   "Tracing complete": "tracing_complete"}
+        quest = [inquirer.Checkbox('checklist',
+                                   message='Select tracings to process',
+                                   choices=choices.keys())]
+        tracings = inquirer.prompt(quest)
+        tlocs = [choices[key] for key in tracings["checklist"]]
+    for tloc in tlocs:
         process_prefix(tloc)
+    if NEURON_POOL:
+        NEURON_POOL.shutdown()
+    if not ARG.NO_INDEX:
+        write_index(tlocs)
     print(f"Dates in AWS S3:         {len(DATE)}")
     print(f"Missing neuron mappings: {len(MISSING_NEURON)}")
     print(f"Metadata files written:  {COUNT['metadata']}")
+    print(f"Bytes downloaded:        {COUNT['bytes']}")
+    if ARG.INCREMENTAL:
+        print(f"Files created:           {COUNT['created']}")
+        print(f"Files updated:           {COUNT['updated']}")
+        print(f"Files unchanged:         {COUNT['unchanged']}")
+    for label, times in LATENCY.items():
+        LOGGER.info("%s: %d call(s), %.2fs total, %.2fs max", label, len(times),
+                    sum(times), max(times))
     if MISSING:
       print("Areas missing from Neuron Browser:")
       for key in MISSING:
@@ -302,9 +737,46 @@ if __name__ == '__main__':
                         default='prod', choices=['dev', 'prod'], help='manifold')
     PARSER.add_argument('--url', dest='URL', action='store',
                         default='s3', choices=['http', 's3'], help='URL style (http or s3)')
+    PARSER.add_argument('--tracings', dest='TRACINGS', action='store', nargs='+',
+                        choices=['Finished_Neurons', 'tracing_complete'],
+                        help='Tracings to process (prompts if not specified)')
     PARSER.add_argument('--write', dest='WRITE', action='store_true',
                         default=False,
                         help='Flag, Actually modify image state')
+    PARSER.add_argument('--hierarchy', dest='HIERARCHY', action='store_true',
+                        default=False, help='Flag, Add soma location ancestor areas to metadata')
+    PARSER.add_argument('--incremental', dest='INCREMENTAL', action='store_true',
+                        default=False, help='Flag, Only upload metadata files that changed')
+    PARSER.add_argument('--no-index', dest='NO_INDEX', action='store_true',
+                        default=False, help='Flag, Do not update the consolidated neuron index')
+    PARSER.add_argument('--lookup', dest='LOOKUP', action='store', nargs='+',
+                        help='Look up neuron IDs in the consolidated index and exit')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int,
+                        default=1, help='Number of dates (and neurons) to process concurrently')
+    PARSER.add_argument('--mapping-file', dest='MAPPING_FILE', action='store',
+                        default=MAPPING_FILE, help='NeuronBrowser mapping snapshot file')
+    PARSER.add_argument('--mapping-ttl', dest='MAPPING_TTL', action='store', type=float,
+                        default=24, help='Hours before the mapping snapshot is refreshed (0=never)')
+    PARSER.add_argument('--refresh-mapping', dest='REFRESH_MAPPING', action='store_true',
+                        default=False, help='Flag, Re-fetch the mapping from NeuronBrowser')
+    PARSER.add_argument('--timeout', dest='TIMEOUT', action='store', type=float,
+                        default=120, help='HTTP request timeout in seconds')
+    PARSER.add_argument('--retries', dest='RETRIES', action='store', type=int,
+                        default=5, help='HTTP retries for connection errors and 5xx responses')
+    PARSER.add_argument('--cache', dest='CACHE', action='store_true',
+                        default=False, help='Flag, Cache S3 listings between runs')
+    PARSER.add_argument('--cache-file', dest='CACHE_FILE', action='store',
+                        default=CACHE_FILE, help='S3 listing cache file')
+    PARSER.add_argument('--cache-ttl', dest='CACHE_TTL', action='store', type=float,
+                        default=24, help='Hours before a cached listing expires (0=never)')
+    PARSER.add_argument('--invalidate', dest='INVALIDATE', action='store_true',
+                        default=False, help='Flag, Discard cached listings for processed tracings')
+    PARSER.add_argument('--metrics-file', dest='METRICS_FILE', action='store',
+                        help='JSON-lines file for throughput and AWS API metrics')
+    PARSER.add_argument('--prometheus-file', dest='PROMETHEUS_FILE', action='store',
+                        help='Prometheus textfile for throughput and AWS API metrics')
+    PARSER.add_argument('--metrics-interval', dest='METRICS_INTERVAL', action='store',
+                        type=float, default=30, help='Seconds between metrics snapshots')
     PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
                         default=False, help='Flag, Chatty')
     PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
@@ -324,5 +796,9 @@ if __name__ == '__main__':
     LOGGER.addHandler(HANDLER)
 
     initialize_program()
+    if ARG.LOOKUP:
+        for neuron in ARG.LOOKUP:
+            print(json.dumps(lookup_neuron(neuron), indent=2))
+        terminate_program()
     process_neurons()
     terminate_program()
@@ -0,0 +1,1199 @@
+''' Library of functions for uploading local files to AWS S3 in-process
+'''
+
+import base64
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+import hashlib
+import json
+import mmap
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.exceptions import ClientError
+from tqdm.auto import tqdm
+from aws_s3_lib import get_registry, iter_objects
+
+# A single "aws s3 cp" (file to prefix) or "aws s3 sync" (directory to prefix) transfer
+Transfer = namedtuple("Transfer", ["verb", "source", "target"])
+MB = 1024 * 1024
+# S3 multipart uploads are limited to 10,000 parts
+MAX_PARTS = 10000
+# Target bytes per hashing task (small files are hashed in batches)
+HASH_BATCH = 64 * MB
+# Block size for copying staged data to scratch files
+COPY_BLOCK = 8 * MB
+
+
+class UploadManifest:
+    ''' Local record (SQLite) of the files that have been uploaded, with their
+        size and mtime at upload time
+    '''
+    def __init__(self, path, batch=500):
+        ''' Open (and create if necessary) a manifest
+            Keyword arguments:
+              path: SQLite file path
+              batch: number of records between commits
+        '''
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.batch = batch
+        self.pending = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS upload (path TEXT PRIMARY KEY, key TEXT, "
+                          + "size INTEGER, mtime REAL, checksum TEXT, uploaded REAL)")
+
+    def entries(self, source):
+        ''' Return the recorded uploads under a local directory
+            Keyword arguments:
+              source: local directory
+            Returns:
+              Dictionary of (key, size, mtime) tuples keyed by local path
+        '''
+        source = os.path.join(source, "")
+        rows = self.conn.execute("SELECT path,key,size,mtime FROM upload "
+                                 + "WHERE path >= ? AND path < ?",
+                                 (source, source[:-1] + chr(ord(os.sep) + 1)))
+        return {path: (key, size, mtime) for path, key, size, mtime in rows}
+
+    def lookup(self, path):
+        ''' Return the recorded upload of a local file
+            Keyword arguments:
+              path: local path
+            Returns:
+              (key, size, mtime) tuple, or None if the file has not been recorded
+        '''
+        row = self.conn.execute("SELECT key,size,mtime FROM upload WHERE path=?",
+                                (path,)).fetchone()
+        return tuple(row) if row else None
+
+    def checksum(self, path, size, mtime):
+        ''' Return the recorded checksum of a local file, if it is unchanged
+            Keyword arguments:
+              path: local path
+              size: file size
+              mtime: file mtime
+            Returns:
+              Checksum, or None if none is recorded for this size and mtime
+        '''
+        row = self.conn.execute("SELECT checksum FROM upload WHERE path=? AND size=? AND mtime=?",
+                                (path, size, mtime)).fetchone()
+        return row[0] if row else None
+
+    def record(self, path, key, size, mtime, checksum=None):
+        ''' Record a successful upload
+            Keyword arguments:
+              path: local path
+              key: object key
+              size: file size
+              mtime: file mtime
+              checksum: optional file checksum
+            Returns:
+              None
+        '''
+        self.conn.execute("INSERT OR REPLACE INTO upload VALUES (?,?,?,?,?,?)",
+                          (path, key, size, mtime, checksum, time.time()))
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.conn.commit()
+            self.pending = 0
+
+    def flush(self):
+        ''' Commit pending records
+        '''
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        ''' Commit pending records and close the manifest
+        '''
+        self.conn.commit()
+        self.conn.close()
+
+
+class TransferJournal:
+    ''' Append-only journal (JSON lines) of completed uploads and checkpointed
+        multipart uploads, used to resume an interrupted run. Events are:
+          create: a multipart upload was started (path, bucket, key, size, mtime,
+                  upload_id, part_size)
+          part: a part was uploaded (upload_id, part)
+          complete: a file was uploaded (path, bucket, key, size, mtime, etag)
+          abort: a multipart upload was abandoned (upload_id)
+        Uploads are tracked by (local path, bucket, key), so one file can be
+        uploaded to several keys.
+    '''
+    def __init__(self, path, resume=False):
+        ''' Open a journal
+            Keyword arguments:
+              path: journal file path
+              resume: replay an existing journal (otherwise it is started over, and
+                      its open multipart uploads are left in stale)
+        '''
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.completed = {}
+        self.multipart = {}
+        self.stale = []
+        good = self._replay(path) if os.path.exists(path) else 0
+        if not resume:
+            self.stale = list(self.multipart.values())
+            self.completed = {}
+            self.multipart = {}
+        self.fhandle = open(path, "a" if resume else "w", encoding="utf8")
+        if resume and self.fhandle.tell() > good:
+            # Drop a line cut off by a crash, so new events start on a line of their own
+            self.fhandle.truncate(good)
+            self.fhandle.seek(good)
+
+    def _replay(self, path):
+        ''' Rebuild the journal state from its events
+            Keyword arguments:
+              path: journal file path
+            Returns:
+              Length of the journal up to the end of its last complete event
+        '''
+        targets = {}
+        good = 0
+        with open(path, "rb") as fhandle:
+            for line in fhandle:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete line")
+                    event = json.loads(line)
+                except ValueError:
+                    # The last line may have been cut off by a crash
+                    break
+                good += len(line)
+                target = (event.get("path"), event.get("bucket"), event.get("key"))
+                if event["event"] == "create":
+                    event["parts"] = {}
+                    self.multipart[target] = event
+                    targets[event["upload_id"]] = target
+                elif event["event"] == "part" and event["upload_id"] in targets:
+                    state = self.multipart.get(targets[event["upload_id"]])
+                    if state and state["upload_id"] == event["upload_id"]:
+                        state["parts"][event["part"]["PartNumber"]] = event["part"]
+                elif event["event"] == "complete":
+                    self.completed[target] = (event["size"], event["mtime"], event["etag"])
+                    self.multipart.pop(target, None)
+                elif event["event"] == "abort" and event["upload_id"] in targets:
+                    state = self.multipart.get(targets[event["upload_id"]])
+                    if state and state["upload_id"] == event["upload_id"]:
+                        self.multipart.pop(targets[event["upload_id"]])
+        return good
+
+    def _write(self, event, sync=False):
+        ''' Append an event
+            Keyword arguments:
+              event: event dict
+              sync: flush the event to disk
+            Returns:
+              None
+        '''
+        self.fhandle.write(json.dumps(event) + "\n")
+        self.fhandle.flush()
+        if sync:
+            os.fsync(self.fhandle.fileno())
+
+    def committed(self, upload):
+        ''' Return True if a file has been uploaded and has not changed since
+            Keyword arguments:
+              upload: (local path, bucket, key, size, mtime) tuple
+            Returns:
+              True or False
+        '''
+        return self.completed.get(tuple(upload[:3]), ())[:2] == tuple(upload[3:])
+
+    def resumable(self, upload, part_size):
+        ''' Return the checkpointed multipart upload for a file, if it can be continued
+            Keyword arguments:
+              upload: (local path, bucket, key, size, mtime) tuple
+              part_size: part size in bytes
+            Returns:
+              create event dict (with parts keyed by part number), or None
+        '''
+        state = self.multipart.get(tuple(upload[:3]))
+        if not state or (state["size"], state["mtime"], state["part_size"]) \
+                        != (*upload[3:], part_size):
+            return None
+        return state
+
+    def create(self, upload, upload_id, part_size):
+        ''' Record the start of a multipart upload
+            Keyword arguments:
+              upload: (local path, bucket, key, size, mtime) tuple
+              upload_id: multipart upload ID
+              part_size: part size in bytes
+            Returns:
+              None
+        '''
+        path, bucket, key, size, mtime = upload
+        event = {"event": "create", "path": path, "bucket": bucket, "key": key, "size": size,
+                 "mtime": mtime, "upload_id": upload_id, "part_size": part_size}
+        self._write(event, sync=True)
+        self.multipart[(path, bucket, key)] = dict(event, parts={})
+
+    def part(self, upload_id, part):
+        ''' Record an uploaded part
+            Keyword arguments:
+              upload_id: multipart upload ID
+              part: part dict (PartNumber, ETag and any checksums)
+            Returns:
+              None
+        '''
+        self._write({"event": "part", "upload_id": upload_id, "part": part})
+
+    def complete(self, upload, etag):
+        ''' Record a completed upload
+            Keyword arguments:
+              upload: (local path, bucket, key, size, mtime) tuple
+              etag: object ETag
+            Returns:
+              None
+        '''
+        path, bucket, key, size, mtime = upload
+        self._write({"event": "complete", "path": path, "bucket": bucket, "key": key,
+                     "size": size, "mtime": mtime, "etag": etag})
+        self.completed[(path, bucket, key)] = (size, mtime, etag)
+        self.multipart.pop((path, bucket, key), None)
+
+    def abort(self, upload_id):
+        ''' Record an abandoned multipart upload
+            Keyword arguments:
+              upload_id: multipart upload ID
+            Returns:
+              None
+        '''
+        self._write({"event": "abort", "upload_id": upload_id})
+
+    def close(self):
+        ''' Close the journal
+        '''
+        self.fhandle.close()
+
+class StagedPiece:
+    ''' One piece (a file, or a part of a multipart upload) that a ReadAhead has
+        read into memory or a scratch file. The staged data counts against the
+        ReadAhead's budget until it is released.
+    '''
+    def __init__(self, owner, where, size):
+        ''' Track staged data
+            Keyword arguments:
+              owner: ReadAhead whose budget the data counts against
+              where: "memory" or "disk"
+              size: staged bytes
+        '''
+        self.owner = owner
+        self.where = where
+        self.size = size
+        self.data = None
+        self.path = None
+
+    def read(self):
+        ''' Return the staged data
+            Keyword arguments:
+              None
+            Returns:
+              Piece data
+        '''
+        if self.where == "memory":
+            return self.data
+        with open(self.path, "rb") as fhandle:
+            return fhandle.read()
+
+    def release(self):
+        ''' Free the staged data
+            Keyword arguments:
+              None
+            Returns:
+              None
+        '''
+        self.data = None
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+        self.owner.free(self.where, self.size)
+
+
+class ReadAhead:
+    ''' Read-ahead staging for uploads from slow storage (such as nearline). Reader
+        threads each take a batch of consecutive pieces (files, or parts of large
+        files) and read them sequentially, in upload order, into memory or into a
+        scratch directory; the uploads take staged pieces from a queue as they are
+        ready, so reads overlap with network writes. Each staged piece counts
+        against the memory and disk budgets until it has been uploaded, so readers
+        wait rather than run too far ahead, and files larger than the budgets
+        stream through them part by part. One ReadAhead can be shared by
+        concurrent uploads to share its budgets.
+    '''
+    def __init__(self, memory=1024 * MB, disk=0, scratch=None, readers=4, batch=256 * MB):
+        ''' Set up staging
+            Keyword arguments:
+              memory: memory budget in bytes
+              disk: scratch directory budget in bytes
+              scratch: scratch directory (None to stage in memory only)
+              readers: number of reader threads
+              batch: bytes of consecutive pieces each reader takes at a time
+        '''
+        self.budget = {"memory": memory, "disk": disk if scratch else 0}
+        self.used = {"memory": 0, "disk": 0}
+        self.scratch = scratch
+        self.readers = readers
+        self.batch = batch
+        self.cond = threading.Condition()
+        if scratch:
+            os.makedirs(scratch, exist_ok=True)
+
+    def _reserve(self, size, stop):
+        ''' Wait until there is room in a budget for a piece, and reserve it
+            Keyword arguments:
+              size: bytes to stage
+              stop: Event set when staging is abandoned
+            Returns:
+              "memory" or "disk", or None if the piece doesn't fit either budget (it
+              is then read from the source by its upload) or staging was abandoned
+        '''
+        if size > self.budget["memory"] and size > self.budget["disk"]:
+            return None
+        with self.cond:
+            while not stop.is_set():
+                for where in ("memory", "disk"):
+                    if self.used[where] + size <= self.budget[where]:
+                        self.used[where] += size
+                        return where
+                self.cond.wait()
+        return None
+
+    def free(self, where, size):
+        ''' Return staged bytes to a budget
+            Keyword arguments:
+              where: "memory" or "disk"
+              size: bytes
+            Returns:
+              None
+        '''
+        with self.cond:
+            self.used[where] -= size
+            self.cond.notify_all()
+
+    def _read(self, upload, pieces, stop, metrics, ready):
+        ''' Stage pieces of a file, queueing each one as soon as it is read
+            Keyword arguments:
+              upload: (local path, bucket, key, size, mtime) tuple
+              pieces: list of (part number, offset, length) tuples
+              stop: Event set when staging is abandoned
+              metrics: Metrics (file reads are timed)
+              ready: queue for (upload, piece, StagedPiece or None) tuples
+            Returns:
+              None
+        '''
+        with open(upload[0], "rb") as fhandle:
+            for piece in pieces:
+                _, offset, length = piece
+                where = self._reserve(length, stop)
+                if stop.is_set():
+                    if where:
+                        self.free(where, length)
+                    return
+                if not where:
+                    ready.put((upload, piece, None))
+                    continue
+                staged = StagedPiece(self, where, length)
+                try:
+                    with (metrics.timer("file.read") if metrics else nullcontext()):
+                        fhandle.seek(offset)
+                        if where == "memory":
+                            staged.data = fhandle.read(length)
+                        else:
+                            fdesc, staged.path = tempfile.mkstemp(dir=self.scratch,
+                                                                  suffix=".staged")
+                            with os.fdopen(fdesc, "wb") as outfile:
+                                while length > 0:
+                                    block = fhandle.read(min(length, COPY_BLOCK))
+                                    if not block:
+                                        break
+                                    outfile.write(block)
+                                    length -= len(block)
+                except OSError:
+                    staged.release()
+                    raise
+                ready.put((upload, piece, staged))
+
+    def stage(self, work, metrics=None):
+        ''' Stage pieces and yield them as they are ready
+            Keyword arguments:
+              work: list of (upload, pieces) tuples, where pieces is a list of
+                    (part number, offset, length) tuples to upload
+              metrics: Metrics (file reads, and waits for staged pieces, are timed)
+            Returns:
+              Iterator of (upload, piece, staged) tuples, where staged is a
+              StagedPiece, or None (not staged). If a file can't be read, its
+              remaining pieces are replaced by one (upload, None, error) tuple. The
+              caller must release each StagedPiece once it has been uploaded.
+        '''
+        batches = queue.Queue()
+        batch = []
+        nbytes = 0
+        for upload, pieces in work:
+            for piece in pieces:
+                if not batch or batch[-1][0] is not upload:
+                    batch.append((upload, []))
+                batch[-1][1].append(piece)
+                nbytes += piece[2]
+                if nbytes >= self.batch:
+                    batches.put(batch)
+                    batch = []
+                    nbytes = 0
+        if batch:
+            batches.put(batch)
+        ready = queue.Queue()
+        stop = threading.Event()
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    try:
+                        batch = batches.get_nowait()
+                    except queue.Empty:
+                        break
+                    for upload, pieces in batch:
+                        if stop.is_set():
+                            break
+                        try:
+                            self._read(upload, pieces, stop, metrics, ready)
+                        except Exception as err: # pylint: disable=W0703
+                            ready.put((upload, None, err))
+            finally:
+                ready.put(None)
+
+        threads = [threading.Thread(target=reader, daemon=True)
+                   for _ in range(min(self.readers, batches.qsize()))]
+        for thread in threads:
+            thread.start()
+        try:
+            running = len(threads)
+            while running:
+                with (metrics.timer("stage.wait") if metrics else nullcontext()):
+                    item = ready.get()
+                if item is None:
+                    running -= 1
+                else:
+                    yield item
+        finally:
+            stop.set()
+            with self.cond:
+                self.cond.notify_all()
+            for thread in threads:
+                thread.join()
+            while not ready.empty():
+                item = ready.get()
+                if item and isinstance(item[2], StagedPiece):
+                    item[2].release()
+
+
+# *****************************************************************************
+# * Internal routines                                                         *
+# *****************************************************************************
+
+def _cp_key(source, prefix):
+    ''' Return the key "aws s3 cp" uploads a file to: a target ending in "/" (or a
+        bucket) is a prefix the file name is added to, and any other target is the key
+        Keyword arguments:
+          source: local file path
+          prefix: key from the target S3 URL
+        Returns:
+          Object key
+    '''
+    if not prefix or prefix.endswith("/"):
+        return prefix + os.path.basename(source)
+    return prefix
+
+
+def _local_files(source):
+    ''' Return the files under a directory
+        Keyword arguments:
+          source: directory
+        Returns:
+          Dictionary of (size, mtime) tuples keyed by path relative to the directory
+    '''
+    files = {}
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(source, rel)) as entries:
+            for entry in entries:
+                path = os.path.join(rel, entry.name) if rel else entry.name
+                if entry.is_dir(follow_symlinks=True):
+                    stack.append(path)
+                elif entry.is_file(follow_symlinks=True):
+                    stat = entry.stat()
+                    files[path] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+def _sync_plan(source, target, manifest=None):
+    ''' Return the uploads needed to sync a directory to an S3 prefix. As with
+        "aws s3 sync", a file is uploaded if it is missing, differs in size, or is
+        newer than the remote copy. If the manifest has records for the directory,
+        they are used in place of a remote listing.
+        Keyword arguments:
+          source: local directory
+          target: S3 URL of target prefix
+          manifest: UploadManifest
+        Returns:
+          List of (local path, bucket, key, size, mtime) tuples
+    '''
+    bucket, prefix = split_s3_url(target)
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    recorded = manifest.entries(source) if manifest else {}
+    remote = {}
+    if not recorded:
+        remote = {rec.key: rec for rec in iter_objects(bucket, prefix, full=True)}
+    uploads = []
+    for path, (size, mtime) in sorted(_local_files(source).items()):
+        key = prefix + path.replace(os.sep, "/")
+        path = os.path.join(source, path)
+        if recorded:
+            if recorded.get(path) == (key, size, mtime):
+                continue
+        else:
+            rec = remote.get(key)
+            # LastModified has one-second resolution
+            if rec and rec.size == size and rec.last_modified.timestamp() >= int(mtime):
+                if manifest:
+                    manifest.record(path, key, size, mtime)
+                continue
+        uploads.append((path, bucket, key, size, mtime))
+    return uploads
+
+
+def _transfer_files(transfers):
+    ''' Return every local file covered by a list of transfers
+        Keyword arguments:
+          transfers: list of Transfers
+        Returns:
+          List of (local path, bucket, key, size, mtime) tuples
+    '''
+    files = []
+    for transfer in transfers:
+        bucket, prefix = split_s3_url(transfer.target)
+        if transfer.verb == "sync":
+            if prefix and not prefix.endswith("/"):
+                prefix += "/"
+            for path, (size, mtime) in sorted(_local_files(transfer.source).items()):
+                files.append((os.path.join(transfer.source, path), bucket,
+                              prefix + path.replace(os.sep, "/"), size, mtime))
+            continue
+        key = _cp_key(transfer.source, prefix)
+        stat = os.stat(transfer.source)
+        files.append((transfer.source, bucket, key, stat.st_size, stat.st_mtime))
+    return files
+
+
+def _part_ranges(size, chunk):
+    ''' Return the byte ranges of the parts a file is uploaded in. As in s3transfer,
+        files at or above the threshold are uploaded in parts, and the part size is
+        doubled until there are no more than MAX_PARTS parts.
+        Keyword arguments:
+          size: file size
+          chunk: multipart threshold and chunk size in bytes
+        Returns:
+          List of (offset, length) tuples, and True if the upload is multipart
+    '''
+    if size < chunk:
+        return [(0, size)], False
+    while -(-size // chunk) > MAX_PARTS:
+        chunk *= 2
+    return [(offset, min(chunk, size - offset)) for offset in range(0, size, chunk)], True
+
+
+def _hash_ranges(ranges, algorithm):
+    ''' Hash byte ranges of local files through memory-mapped reads (run in a
+        worker process)
+        Keyword arguments:
+          ranges: list of (path, offset, length) tuples
+          algorithm: md5 or sha256
+        Returns:
+          List of digests
+    '''
+    digests = []
+    for path, offset, length in ranges:
+        digest = hashlib.new(algorithm)
+        if length:
+            with open(path, "rb") as fhandle, \
+                 mmap.mmap(fhandle.fileno(), length, offset=offset, access=mmap.ACCESS_READ) as mem:
+                digest.update(mem)
+        digests.append(digest.digest())
+    return digests
+
+
+def _submit_checksums(executor, files, algorithm, chunk):
+    ''' Submit hashing tasks for local files to a process pool
+        Keyword arguments:
+          executor: ProcessPoolExecutor
+          files: list of (local path, size) tuples
+          algorithm: md5 or sha256
+          chunk: multipart threshold and chunk size in bytes
+        Returns:
+          Dictionary of (multipart flag, [(task, index)] part locations) keyed by
+          local path, and list of task futures
+    '''
+    plan = {}
+    futures = []
+    batch = []
+    batch_bytes = 0
+    for path, size in files:
+        ranges, multipart = _part_ranges(size, chunk)
+        locations = []
+        for offset, length in ranges:
+            locations.append((len(futures), len(batch)))
+            batch.append((path, offset, length))
+            batch_bytes += length
+            if batch_bytes >= HASH_BATCH:
+                futures.append(executor.submit(_hash_ranges, batch, algorithm))
+                batch = []
+                batch_bytes = 0
+        plan[path] = (multipart, locations)
+    if batch:
+        futures.append(executor.submit(_hash_ranges, batch, algorithm))
+    return plan, futures
+
+
+def _collect_checksums(plan, futures, algorithm):
+    ''' Combine part digests into S3-compatible checksums. For MD5, this is the
+        ETag (hex digest, or the digest of the part digests with a part count suffix
+        for multipart uploads). For SHA-256, this is the base64 ChecksumSHA256 value
+        (composite for multipart uploads).
+        Keyword arguments:
+          plan: part locations from _submit_checksums
+          futures: task futures from _submit_checksums
+          algorithm: md5 or sha256
+        Returns:
+          Dictionary of checksums keyed by local path
+    '''
+    results = [future.result() for future in futures]
+    encode = (lambda digest: digest.hex()) if algorithm == "md5" \
+             else (lambda digest: base64.b64encode(digest).decode())
+    checksums = {}
+    for path, (multipart, locations) in plan.items():
+        digests = [results[task][idx] for task, idx in locations]
+        if multipart:
+            checksums[path] = encode(hashlib.new(algorithm, b"".join(digests)).digest()) \
+                              + f"-{len(digests)}"
+        else:
+            checksums[path] = encode(digests[0])
+    return checksums
+
+
+def _remote_checksums(transfers, files, algorithm, threads):
+    ''' Return the remote checksums for uploaded files. MD5 ETags for synced
+        directories come from listings; everything else is fetched with HEAD requests.
+        Keyword arguments:
+          transfers: list of Transfers
+          files: list of (local path, bucket, key, size, mtime) tuples
+          algorithm: md5 or sha256
+          threads: number of concurrent requests
+        Returns:
+          Dictionary of checksums keyed by (bucket, key). The checksum is None if the
+          object does not exist, and "" if it has no checksum for the algorithm.
+    '''
+    remote = {}
+    if algorithm == "md5":
+        for transfer in transfers:
+            if transfer.verb == "sync":
+                bucket, prefix = split_s3_url(transfer.target)
+                if prefix and not prefix.endswith("/"):
+                    prefix += "/"
+                for rec in iter_objects(bucket, prefix, full=True):
+                    remote[(bucket, rec.key)] = rec.etag
+    client = get_registry().client('s3', workers=threads)
+
+    def head(obj):
+        args = {"ChecksumMode": "ENABLED"} if algorithm == "sha256" else {}
+        try:
+            resp = client.head_object(Bucket=obj[0], Key=obj[1], **args)
+        except ClientError as err:
+            if err.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        if algorithm == "md5":
+            return resp["ETag"].strip('"')
+        return resp.get("ChecksumSHA256", "")
+
+    missing = [(bucket, key) for _, bucket, key, _, _ in files if (bucket, key) not in remote]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        remote.update(zip(missing, executor.map(head, missing)))
+    return remote
+
+
+def _compare(local, remote):
+    ''' Compare a local checksum with the remote one
+        Keyword arguments:
+          local: local checksum
+          remote: remote checksum (None if missing, "" if not available)
+        Returns:
+          Status (verified, mismatch, missing, or unverifiable)
+    '''
+    if remote is None:
+        return "missing"
+    # Composite checksums may be reported without the part count suffix
+    if local == remote or local.partition("-")[0] == remote:
+        return "verified"
+    # Different part counts (or no stored checksum) can't be compared
+    if not remote or local.partition("-")[2] != remote.partition("-")[2]:
+        return "unverifiable"
+    return "mismatch"
+
+
+def _product(upload):
+    ''' Return the product an upload belongs to (the first component of its key)
+        Keyword arguments:
+          upload: (local path, bucket, key, size, mtime) tuple
+        Returns:
+          Product name
+    '''
+    return upload[2].split("/", 1)[0]
+
+
+def _part_info(number, resp):
+    ''' Return the part dict needed to complete a multipart upload
+        Keyword arguments:
+          number: part number
+          resp: upload_part response or list_parts part
+        Returns:
+          Part dict (PartNumber, ETag and any checksums)
+    '''
+    part = {"PartNumber": number, "ETag": resp["ETag"]}
+    part.update({name: value for name, value in resp.items()
+                 if name.startswith("Checksum") and name != "ChecksumType"})
+    return part
+
+
+def _put_file(client, upload, extra_args, metrics=None, staged=None):
+    ''' Upload a file in a single request
+        Keyword arguments:
+          client: S3 client
+          upload: (local path, bucket, key, size, mtime) tuple
+          extra_args: extra put_object arguments
+          metrics: Metrics (file reads are timed)
+          staged: StagedPiece to upload from instead of reading the file
+        Returns:
+          ETag
+    '''
+    if staged:
+        body = staged.read()
+    else:
+        with open(upload[0], "rb") as fhandle, \
+             (metrics.timer("file.read") if metrics else nullcontext()):
+            body = fhandle.read()
+    return client.put_object(Bucket=upload[1], Key=upload[2], Body=body,
+                             **extra_args)["ETag"].strip('"')
+
+
+def _put_part(client, upload, upload_id, number, offset, length, extra_args, metrics=None,
+              staged=None):
+    ''' Upload one part of a multipart upload
+        Keyword arguments:
+          client: S3 client
+          upload: (local path, bucket, key, size, mtime) tuple
+          upload_id: multipart upload ID
+          number: part number
+          offset: part offset in the file
+          length: part length
+          extra_args: extra arguments (ChecksumAlgorithm is passed on)
+          metrics: Metrics (file reads are timed)
+          staged: StagedPiece to upload from instead of reading the part
+        Returns:
+          Part dict
+    '''
+    if staged:
+        body = staged.read()
+    else:
+        with open(upload[0], "rb") as fhandle, \
+             (metrics.timer("file.read") if metrics else nullcontext()):
+            fhandle.seek(offset)
+            body = fhandle.read(length)
+    args = {key: val for key, val in extra_args.items() if key == "ChecksumAlgorithm"}
+    resp = client.upload_part(Bucket=upload[1], Key=upload[2], UploadId=upload_id,
+                              PartNumber=number, Body=body, **args)
+    return _part_info(number, resp)
+
+
+def _start_multipart(client, journal, upload, part_size, extra_args):
+    ''' Continue a checkpointed multipart upload, or start a new one
+        Keyword arguments:
+          client: S3 client
+          journal: TransferJournal
+          upload: (local path, bucket, key, size, mtime) tuple
+          part_size: part size in bytes
+          extra_args: extra create_multipart_upload arguments
+        Returns:
+          Upload ID, and dictionary of uploaded part dicts keyed by part number
+    '''
+    state = journal.resumable(upload, part_size)
+    if state:
+        try:
+            parts = {}
+            paginator = client.get_paginator("list_parts")
+            for page in paginator.paginate(Bucket=upload[1], Key=upload[2],
+                                           UploadId=state["upload_id"]):
+                for part in page.get("Parts", []):
+                    parts[part["PartNumber"]] = _part_info(part["PartNumber"], part)
+            return state["upload_id"], parts
+        except ClientError as err:
+            if err.response["Error"]["Code"] == "AccessDenied":
+                # Fall back to the parts checkpointed in the journal
+                return state["upload_id"], state["parts"]
+            if err.response["Error"]["Code"] != "NoSuchUpload":
+                raise
+            journal.abort(state["upload_id"])
+    upload_id = client.create_multipart_upload(Bucket=upload[1], Key=upload[2],
+                                               **extra_args)["UploadId"]
+    journal.create(upload, upload_id, part_size)
+    return upload_id, {}
+
+
+def _journaled_uploads(client, uploads, journal, chunk, threads, extra_args, pbar,
+                       metrics=None, readahead=None, manifest=None):
+    ''' Upload files, recording every completed file and multipart part in a
+        journal so that an interrupted run can be resumed. Small files are uploaded
+        with one request; others are uploaded in parts, and checkpointed multipart
+        uploads are continued from the parts already uploaded.
+        Keyword arguments:
+          client: S3 client
+          uploads: list of (local path, bucket, key, size, mtime) tuples
+          journal: TransferJournal
+          chunk: multipart threshold and chunk size in bytes
+          threads: number of concurrent requests
+          extra_args: extra upload arguments
+          pbar: progress bar
+          metrics: Metrics
+          readahead: ReadAhead to stage files with (only the parts still to be
+                     uploaded are read)
+          manifest: UploadManifest to record each upload in as it completes
+        Returns:
+          List of uploads that succeeded, and list of (local path, error) tuples for
+          failed uploads
+    '''
+    extra_args = extra_args or {}
+    succeeded = []
+    failed = []
+    multipart = {}
+
+    def plan():
+        # Yield each file with the pieces (part number, offset, length) to upload;
+        # the part number is None for single-request uploads
+        for upload in uploads:
+            ranges, is_multipart = _part_ranges(upload[3], chunk)
+            if not is_multipart:
+                yield upload, [(None, 0, upload[3])]
+                continue
+            try:
+                upload_id, parts = _start_multipart(client, journal, upload, ranges[0][1],
+                                                    extra_args)
+            except ClientError as err:
+                failed.append((upload[0], err))
+                continue
+            multipart[upload[:3]] = {"upload_id": upload_id, "parts": parts,
+                                    "remaining": len(ranges), "failed": False}
+            pieces = []
+            for number, (offset, length) in enumerate(ranges, start=1):
+                if number in parts:
+                    multipart[upload[:3]]["remaining"] -= 1
+                    pbar.update(length)
+                else:
+                    pieces.append((number, offset, length))
+            if pieces:
+                yield upload, pieces
+            else:
+                complete(upload)
+
+    def complete(upload):
+        # Complete a multipart upload after its last part
+        state = multipart[upload[:3]]
+        try:
+            resp = client.complete_multipart_upload(
+                Bucket=upload[1], Key=upload[2], UploadId=state["upload_id"],
+                MultipartUpload={"Parts": [state["parts"][num]
+                                           for num in sorted(state["parts"])]})
+        except ClientError as err:
+            failed.append((upload[0], err))
+            return
+        journal.complete(upload, resp["ETag"].strip('"'))
+        if manifest:
+            manifest.record(upload[0], *upload[2:])
+        succeeded.append(upload)
+        if metrics:
+            metrics.add(_product(upload), 1)
+
+    def finish(future, upload, length):
+        # Record a finished upload request, and complete a multipart upload after
+        # its last part
+        try:
+            result = future.result()
+        except Exception as err: # pylint: disable=W0703
+            if length is None or not multipart[upload[:3]]["failed"]:
+                failed.append((upload[0], err))
+            if length is not None:
+                multipart[upload[:3]]["failed"] = True
+            return
+        if length is None:
+            journal.complete(upload, result)
+            if manifest:
+                manifest.record(upload[0], *upload[2:])
+            succeeded.append(upload)
+            pbar.update(upload[3])
+            if metrics:
+                metrics.add(_product(upload), 1, upload[3])
+            return
+        state = multipart[upload[:3]]
+        pbar.update(length)
+        if metrics:
+            metrics.add(_product(upload), 0, length)
+        journal.part(state["upload_id"], result)
+        state["parts"][result["PartNumber"]] = result
+        state["remaining"] -= 1
+        if not state["remaining"] and not state["failed"]:
+            complete(upload)
+
+    # Finished requests are queued by their done callbacks and recorded by this
+    # thread while it is still submitting, so the journal keeps up with the uploads
+    done = queue.Queue()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        outstanding = 0
+        if readahead:
+            staging = readahead.stage(list(plan()), metrics)
+        else:
+            staging = ((upload, piece, None) for upload, pieces in plan() for piece in pieces)
+        for upload, piece, staged in staging:
+            while not done.empty():
+                finish(*done.get())
+                outstanding -= 1
+            if isinstance(staged, Exception):
+                if upload[:3] not in multipart or not multipart[upload[:3]]["failed"]:
+                    failed.append((upload[0], staged))
+                if upload[:3] in multipart:
+                    multipart[upload[:3]]["failed"] = True
+                continue
+            number, offset, length = piece
+            if number is None:
+                future = executor.submit(_put_file, client, upload, extra_args, metrics,
+                                         staged)
+            else:
+                future = executor.submit(_put_part, client, upload,
+                                         multipart[upload[:3]]["upload_id"], number, offset,
+                                         length, extra_args, metrics, staged)
+            if staged:
+                future.add_done_callback(lambda _, staged=staged: staged.release())
+            outstanding += 1
+            future.add_done_callback(lambda future, upload=upload,
+                                     length=None if number is None else length:
+                                     done.put((future, upload, length)))
+        while outstanding:
+            finish(*done.get())
+            outstanding -= 1
+    return succeeded, failed
+
+
+# *****************************************************************************
+# * Callable routines                                                         *
+# *****************************************************************************
+
+def split_s3_url(url):
+    ''' Split an S3 URL into bucket and key
+        Keyword arguments:
+          url: S3 URL (s3://bucket/key)
+        Returns:
+          Bucket, key
+    '''
+    if not url.startswith("s3://"):
+        raise ValueError("Invalid S3 URL %s" % (url))
+    bucket, _, key = url[5:].partition("/")
+    return bucket, key
+
+
+def plan_uploads(transfers, manifest=None):
+    ''' Expand cp and sync transfers into individual file uploads
+        Keyword arguments:
+          transfers: list of Transfers
+          manifest: UploadManifest (files recorded as uploaded and unchanged are skipped)
+        Returns:
+          List of (local path, bucket, key, size, mtime) tuples
+    '''
+    uploads = []
+    for transfer in transfers:
+        if transfer.verb == "sync":
+            uploads.extend(_sync_plan(transfer.source, transfer.target, manifest))
+            continue
+        bucket, prefix = split_s3_url(transfer.target)
+        key = _cp_key(transfer.source, prefix)
+        stat = os.stat(transfer.source)
+        if manifest and manifest.lookup(transfer.source) == (key, stat.st_size, stat.st_mtime):
+            continue
+        uploads.append((transfer.source, bucket, key, stat.st_size, stat.st_mtime))
+    return uploads
+
+
+def start_verification(transfers, algorithm="md5", chunk_size=8, workers=None, manifest=None,
+                       uploads=None):
+    ''' Start hashing the local files for a list of transfers. With a manifest,
+        files that are not being uploaded reuse the checksums recorded for them
+        and only the others are hashed.
+        Keyword arguments:
+          transfers: list of Transfers
+          algorithm: md5 or sha256
+          chunk_size: multipart threshold and chunk size in MB
+          workers: number of hashing processes (defaults to the CPU count)
+          manifest: UploadManifest with recorded checksums
+          uploads: list of (local path, bucket, key, size, mtime) tuples to be uploaded
+        Returns:
+          Pending hashing state for verify_transfers
+    '''
+    files = _transfer_files(transfers)
+    recorded = {}
+    if manifest:
+        # Checksums are recorded with their algorithm and chunk size, since both
+        # change the value for multipart uploads
+        tag = f"{algorithm}/{chunk_size}:"
+        uploading = {upload[0] for upload in uploads or []}
+        for path, _, _, size, mtime in files:
+            checksum = None if path in uploading else manifest.checksum(path, size, mtime)
+            if checksum and checksum.startswith(tag):
+                recorded[path] = checksum[len(tag):]
+    executor = ProcessPoolExecutor(max_workers=workers)
+    plan, futures = _submit_checksums(executor, [(path, size) for path, _, _, size, _ in files
+                                                 if path not in recorded],
+                                      algorithm, chunk_size * MB)
+    return executor, files, plan, futures, recorded
+
+
+def verify_transfers(transfers, algorithm="md5", chunk_size=8, workers=None, threads=32,
+                     pending=None):
+    ''' Verify uploaded files against their remote checksums. Local files are hashed
+        in parallel by a process pool; hashing can be started before the uploads with
+        start_verification so that it overlaps with them.
+        Keyword arguments:
+          transfers: list of Transfers
+          algorithm: md5 (compared with ETags) or sha256 (compared with S3 checksums)
+          chunk_size: multipart threshold and chunk size in MB used for the uploads
+          workers: number of hashing processes (defaults to the CPU count)
+          threads: number of concurrent S3 requests
+          pending: hashing started by start_verification
+        Returns:
+          List of report dicts (path, key, size, local, remote, status)
+    '''
+    if not pending:
+        pending = start_verification(transfers, algorithm, chunk_size, workers)
+    executor, files, plan, futures, recorded = pending
+    try:
+        checksums = _collect_checksums(plan, futures, algorithm)
+    finally:
+        executor.shutdown()
+    checksums.update(recorded)
+    remote = _remote_checksums(transfers, files, algorithm, threads)
+    report = []
+    for path, bucket, key, size, _ in files:
+        rchecksum = remote.get((bucket, key))
+        report.append({"path": path, "key": f"s3://{bucket}/{key}", "size": size,
+                       "local": checksums[path], "remote": rchecksum,
+                       "status": _compare(checksums[path], rchecksum)})
+    return report
+
+
+def execute_transfers(transfers, profile=None, threads=32, chunk_size=8, manifest=None,
+                      verify=None, hash_workers=None, journal=None, metrics=None,
+                      readahead=None):
+    ''' Perform transfers in-process, with a shared boto3 transfer manager or (with
+        a journal) with checkpointed uploads that can be resumed
+        Keyword arguments:
+          transfers: list of Transfers
+          profile: AWS profile
+          threads: maximum number of concurrent transfer threads
+          chunk_size: multipart threshold and chunk size in MB
+          manifest: UploadManifest used to skip unchanged files and record uploads
+          verify: checksum algorithm (md5 or sha256) to verify every file with after
+                  uploading; local files are hashed while the uploads run, except
+                  for unchanged files with a checksum recorded in the manifest
+          hash_workers: number of hashing processes
+          journal: TransferJournal (files it has as committed are skipped)
+          metrics: Metrics (AWS API calls, throughput by product, and file reads are
+                   recorded)
+          readahead: ReadAhead to stage files with before they are uploaded (needs a
+                     journal)
+        Returns:
+          List of (local path, error) tuples for failed uploads, and the verification
+          report (None if verify is not set)
+    '''
+    if readahead and not journal:
+        raise ValueError("Read-ahead staging needs a transfer journal")
+    if profile:
+        boto3.setup_default_session(profile_name=profile)
+    if metrics:
+        metrics.instrument()
+    client = get_registry().client('s3', workers=threads)
+    if journal:
+        for state in journal.stale:
+            try:
+                client.abort_multipart_upload(Bucket=state["bucket"], Key=state["key"],
+                                              UploadId=state["upload_id"])
+            except ClientError:
+                pass
+        if manifest:
+            # Files committed in the journal are up to date, so the next plan can
+            # use the manifest instead of listing AWS S3 again
+            for (path, _, key), (size, mtime, _) in journal.completed.items():
+                if manifest.lookup(path) != (key, size, mtime):
+                    manifest.record(path, key, size, mtime)
+    uploads = plan_uploads(transfers, manifest)
+    if manifest:
+        manifest.flush()
+    if journal:
+        uploads = [upload for upload in uploads if not journal.committed(upload)]
+    pending = None
+    if verify:
+        pending = start_verification(transfers, verify, chunk_size, hash_workers, manifest,
+                                     uploads)
+    # Have S3 store SHA-256 checksums so that they can be verified
+    extra_args = {"ChecksumAlgorithm": "SHA256"} if verify == "sha256" else None
+    failed = []
+    with tqdm(total=sum(upload[3] for upload in uploads), unit="B", unit_scale=True,
+              desc="Upload") as pbar:
+        if journal:
+            _, failed = _journaled_uploads(client, uploads, journal, chunk_size * MB, threads,
+                                           extra_args, pbar, metrics, readahead, manifest)
+        else:
+            config = TransferConfig(max_concurrency=threads, multipart_threshold=chunk_size * MB,
+                                    multipart_chunksize=chunk_size * MB)
+            with create_transfer_manager(client, config) as manager:
+                futures = []
+                for upload in uploads:
+                    futures.append((upload, manager.upload(*upload[:3], extra_args=extra_args)))
+                for upload, future in futures:
+                    try:
+                        future.result()
+                    except Exception as err: # pylint: disable=W0703
+                        failed.append((upload[0], err))
+                    else:
+                        if manifest:
+                            manifest.record(upload[0], *upload[2:])
+                        if metrics:
+                            metrics.add(_product(upload), 1, upload[3])
+                    pbar.update(upload[3])
+    if not verify:
+        return failed, None
+    report = verify_transfers(transfers, verify, chunk_size, threads=threads, pending=pending)
+    if manifest:
+        for row, (path, _, key, size, mtime) in zip(report, pending[1]):
+            if row["status"] == "verified" and path not in pending[4]:
+                manifest.record(path, key, size, mtime, f"{verify}/{chunk_size}:{row['local']}")
+    return failed, report
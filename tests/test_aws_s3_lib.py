@@ -0,0 +1,269 @@
+''' Tests for aws_s3_lib listings, against an in-process moto S3
+'''
+
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import sys
+from urllib.parse import quote_plus
+import boto3
+from moto import mock_aws
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import aws_s3_lib # pylint: disable=C0413
+from metrics_lib import Metrics # pylint: disable=C0413
+
+BUCKET = "tracings-test"
+# More objects than one list_objects_v2 page holds
+DATES = {"2023-05-10": 700, "2023-06-01": 400, "2023-07-15": 100}
+# Inventory report layout: <destination prefix>/<source bucket>/<configuration>/
+INVENTORY = f"inventory/{BUCKET}/daily"
+INVENTORY_SCHEMA = ["Bucket", "Key", "VersionId", "IsLatest", "IsDeleteMarker", "Size",
+                    "LastModifiedDate", "ETag"]
+
+
+@pytest.fixture(name="s3")
+def fixture_s3(monkeypatch):
+    ''' Yield an S3 client for a moto bucket; aws_s3_lib uses the same session, and
+        its API calls are counted in s3.metrics
+    '''
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        session = boto3.session.Session(region_name="us-east-1")
+        s3c = session.client("s3")
+        s3c.create_bucket(Bucket=BUCKET)
+        s3c.metrics = Metrics()
+        s3c.metrics.instrument(session)
+        monkeypatch.setattr(aws_s3_lib, "REGISTRY", aws_s3_lib.ClientRegistry(session))
+        yield s3c
+
+
+def put_keys(s3c, keys):
+    ''' Create small objects
+        Keyword arguments:
+          s3c: S3 client
+          keys: object keys
+        Returns:
+          None
+    '''
+    for key in keys:
+        s3c.put_object(Bucket=BUCKET, Key=key, Body=b"12345")
+    s3c.metrics.calls.clear()
+
+
+def test_get_prefixes_full_single_listing(s3):
+    ''' get_prefixes(full=True) rolls up one paginated listing of the prefix, with
+        no per-prefix listings
+    '''
+    put_keys(s3, [f"tracings/{date}/G-{idx:04}/x.swc"
+                  for date, count in DATES.items() for idx in range(count)])
+    stats = aws_s3_lib.get_prefixes(BUCKET, "tracings", full=True)
+    assert sorted(stats) == sorted(DATES)
+    for date, count in DATES.items():
+        assert stats[date]["objects"] == count
+        assert stats[date]["size"] == 5 * count
+    assert s3.metrics.calls == {"s3.ListObjectsV2": 2}
+
+
+def test_parallel_listing_splits_large_child(s3):
+    ''' A child prefix with more than a page of keys is split into key ranges, and
+        the parallel listing matches the serial one
+    '''
+    keys = [f"neurons/2023-01-01/{idx}.swc" for idx in range(20)] \
+           + [f"neurons/2023-02-02/{'0aZ_'[idx % 4]}{idx:05}/x.swc" for idx in range(2500)] \
+           + [f"neurons/2023-03-03/{idx}.swc" for idx in range(1000)] + ["neurons/top.txt"]
+    put_keys(s3, keys)
+    serial = list(aws_s3_lib.iter_objects(BUCKET, "neurons/", full=True))
+    assert [rec.key for rec in serial] == sorted(keys)
+    with aws_s3_lib.ThreadPoolExecutor(max_workers=4) as executor:
+        _, shards = aws_s3_lib._plan_shards(s3, BUCKET, "neurons/", 4, # pylint: disable=W0212
+                                            executor)
+    assert len(shards) > 1
+    assert {shard[0] for shard in shards} == {"neurons/2023-02-02/"}
+    assert list(aws_s3_lib.iter_objects(BUCKET, "neurons/", full=True, workers=4)) == serial
+
+
+def test_parallel_listing_streams(s3, monkeypatch):
+    ''' Records are yielded while a shard is still being listed, and a caller can
+        stop early
+    '''
+    monkeypatch.setattr(aws_s3_lib, "SHARD_PAGES", 1)
+    # One key-range shard with four pages
+    put_keys(s3, [f"flat/k{idx:05}" for idx in range(3500)])
+    records = aws_s3_lib.iter_objects(BUCKET, "flat/", full=True, workers=1)
+    assert next(records).key == "flat/k00000"
+    # The shard has fetched at most the page being read, one queued page, and
+    # one waiting for room
+    early = s3.metrics.calls["s3.ListObjectsV2"]
+    assert len(list(records)) == 3499
+    assert early < s3.metrics.calls["s3.ListObjectsV2"]
+    records = aws_s3_lib.iter_objects(BUCKET, "flat/", full=True, workers=1)
+    assert next(records).key == "flat/k00000"
+    records.close()
+
+
+def test_listing_cache_probe(s3, tmp_path):
+    ''' A cached listing is checked with one delimiter listing, and only added
+        child prefixes are listed
+    '''
+    date = "tracings/Finished_Neurons/2023-05-10/"
+    put_keys(s3, [f"{date}G-{idx:03}/{name}" for idx in range(3)
+                  for name in ("soma.txt", "x.swc")] + [f"{date}notes.txt"])
+    cache = aws_s3_lib.ListingCache(str(tmp_path / "listing.db"))
+    first = aws_s3_lib.cached_objects(BUCKET, date, cache)
+    assert len(first) == 7
+    s3.metrics.calls.clear()
+    assert aws_s3_lib.cached_objects(BUCKET, date, cache) == first
+    assert s3.metrics.calls == {"s3.ListObjectsV2": 1}
+    # A new neuron folder is listed by itself, and a removed one is dropped
+    put_keys(s3, [f"{date}G-100/soma.txt"])
+    s3.delete_object(Bucket=BUCKET, Key=f"{date}G-000/soma.txt")
+    s3.delete_object(Bucket=BUCKET, Key=f"{date}G-000/x.swc")
+    s3.metrics.calls.clear()
+    keys = [rec.key for rec in aws_s3_lib.cached_objects(BUCKET, date, cache)]
+    assert keys == sorted([rec.key for rec in first if "G-000" not in rec.key]
+                          + [f"{date}G-100/soma.txt"])
+    assert s3.metrics.calls == {"s3.ListObjectsV2": 2}
+    assert [rec.key for rec in cache.get(BUCKET, date)] == keys
+    # Objects directly under the prefix are compared by ETag
+    s3.put_object(Bucket=BUCKET, Key=f"{date}notes.txt", Body=b"changed")
+    notes = [rec for rec in aws_s3_lib.cached_objects(BUCKET, date, cache)
+             if rec.key.endswith("notes.txt")]
+    assert notes[0].size == 7
+    # An expired listing is listed again in full
+    cache.ttl = 1
+    cache.conn.execute("UPDATE listing SET fetched=0")
+    s3.put_object(Bucket=BUCKET, Key=f"{date}G-001/x.swc", Body=b"replaced")
+    replaced = [rec for rec in aws_s3_lib.cached_objects(BUCKET, date, cache)
+                if rec.key.endswith("G-001/x.swc")]
+    assert replaced[0].size == 8
+    cache.close()
+
+
+def inventory_row(key, size=5, latest=True, deleted=False):
+    ''' Return an inventory row
+        Keyword arguments:
+          key: object key
+          size: object size
+          latest: the row is the current version
+          deleted: the row is a delete marker
+        Returns:
+          Row dict with the inventory schema fields
+    '''
+    return {"Bucket": BUCKET, "Key": key, "VersionId": "v1", "IsLatest": latest,
+            "IsDeleteMarker": deleted, "Size": None if deleted else size,
+            "LastModifiedDate": datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+            "ETag": None if deleted else "0123abcd"}
+
+
+def inventory_data(fmt, rows):
+    ''' Return the contents of an inventory data file
+        Keyword arguments:
+          fmt: CSV or Parquet
+          rows: inventory row dicts
+        Returns:
+          File contents
+    '''
+    if fmt == "CSV":
+        text = io.StringIO()
+        writer = csv.writer(text, quoting=csv.QUOTE_ALL)
+        for row in rows:
+            row = dict(row, Key=quote_plus(row["Key"], safe="/"),
+                       LastModifiedDate=row["LastModifiedDate"].strftime(
+                           "%Y-%m-%dT%H:%M:%S.000Z"))
+            writer.writerow(["" if row[field] is None else str(row[field]).lower()
+                             if isinstance(row[field], bool) else row[field]
+                             for field in INVENTORY_SCHEMA])
+        return gzip.compress(text.getvalue().encode())
+    pyarrow = pytest.importorskip("pyarrow")
+    pytest.importorskip("pyarrow.parquet")
+    table = pyarrow.table({column: [row[field] for row in rows] for field, column
+                           in aws_s3_lib.INVENTORY_COLUMNS.items()}
+                          | {"bucket": [row["Bucket"] for row in rows],
+                             "version_id": [row["VersionId"] for row in rows]})
+    sink = io.BytesIO()
+    pyarrow.parquet.write_table(table, sink)
+    return sink.getvalue()
+
+
+def write_inventory(root, fmt, rows):
+    ''' Write a local inventory report in the S3 Inventory layout, with an older
+        report beside it that must not be read
+        Keyword arguments:
+          root: pathlib.Path of the destination
+          fmt: CSV or Parquet
+          rows: inventory row dicts
+        Returns:
+          Dictionary of file contents keyed by destination key
+    '''
+    data = f"{INVENTORY}/data/0001.{'csv.gz' if fmt == 'CSV' else 'parquet'}"
+    files = {data: inventory_data(fmt, rows)}
+    for report, key in (("2024-01-01T01-00Z", f"{INVENTORY}/data/missing.csv.gz"),
+                        ("2024-01-02T01-00Z", data)):
+        manifest = {"sourceBucket": BUCKET, "destinationBucket": "arn:aws:s3:::inventory-dest",
+                    "fileFormat": fmt, "fileSchema": ", ".join(INVENTORY_SCHEMA),
+                    "files": [{"key": key, "size": len(files[data])}]}
+        files[f"{INVENTORY}/{report}/manifest.json"] = json.dumps(manifest).encode()
+    for key, body in files.items():
+        (root / key).parent.mkdir(parents=True, exist_ok=True)
+        (root / key).write_bytes(body)
+    return files
+
+
+@pytest.mark.parametrize("fmt", ["CSV", "Parquet"])
+def test_inventory_filters(tmp_path, fmt):
+    ''' Only current objects under the prefix are read from an inventory report,
+        and CSV keys are URL-decoded
+    '''
+    date = "tracings/2023-05-10/"
+    write_inventory(tmp_path, fmt, [inventory_row(f"{date}G-001/a b+c.swc", 7),
+                                    inventory_row(f"{date}G-001/old.swc", latest=False),
+                                    inventory_row(f"{date}G-002/gone.swc", deleted=True),
+                                    inventory_row(f"{date}G-002/x.swc"),
+                                    inventory_row("images/2023-05-10/x.tif")])
+    location = str(tmp_path / INVENTORY)
+    records = sorted(aws_s3_lib.iter_inventory(location, "tracings/", BUCKET))
+    assert [(rec.key, rec.size) for rec in records] == [(f"{date}G-001/a b+c.swc", 7),
+                                                       (f"{date}G-002/x.swc", 5)]
+    assert records[0].etag == "0123abcd"
+    assert records[0].last_modified == datetime.datetime(2024, 1, 1,
+                                                         tzinfo=datetime.timezone.utc)
+    with pytest.raises(ValueError):
+        list(aws_s3_lib.iter_inventory(location, bucket="other-bucket"))
+
+
+@pytest.mark.parametrize("fmt,remote", [("CSV", False), ("Parquet", False), ("CSV", True)])
+def test_inventory_matches_listing(s3, tmp_path, fmt, remote):
+    ''' get_objects and get_prefixes give the same results from an inventory
+        report (local or in its destination bucket) as from a listing
+    '''
+    put_keys(s3, [f"tracings/{date}/G-{idx:03}/{name}" for date in DATES
+                  for idx in range(5) for name in ("x.swc", "soma.txt")]
+             + ["tracings/readme.txt", "images/2023-05-10/x.tif"])
+    rows = [inventory_row(obj["Key"], obj["Size"])
+            for page in s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET)
+            for obj in page["Contents"]]
+    rows += [inventory_row("tracings/2023-05-10/G-000/x.swc", 9, latest=False),
+             inventory_row("tracings/2023-05-10/G-099/x.swc", deleted=True)]
+    files = write_inventory(tmp_path, fmt, rows[::-1])
+    location = str(tmp_path / INVENTORY)
+    if remote:
+        s3.create_bucket(Bucket="inventory-dest")
+        for key, body in files.items():
+            s3.put_object(Bucket="inventory-dest", Key=key, Body=body)
+        location = f"s3://inventory-dest/{INVENTORY}"
+    s3.metrics.calls.clear()
+    for func, full in ((aws_s3_lib.get_objects, False), (aws_s3_lib.get_objects, True),
+                       (aws_s3_lib.get_prefixes, False), (aws_s3_lib.get_prefixes, True)):
+        for prefix in ("tracings/", "tracings/2023-05-10/"):
+            assert func(BUCKET, prefix, full=full, inventory=location) \
+                   == func(BUCKET, prefix, full=full)
+    # A report is read without listing the source bucket; only a report folder in
+    # the destination bucket is listed, to find the latest report
+    s3.metrics.calls.clear()
+    aws_s3_lib.get_objects(BUCKET, "tracings/", inventory=location)
+    assert s3.metrics.calls.get("s3.ListObjectsV2", 0) == (1 if remote else 0)
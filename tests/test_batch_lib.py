@@ -0,0 +1,36 @@
+''' Tests for batch_lib scheduling
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import batch_lib # pylint: disable=C0413
+
+SOURCES = {"/nrs": {"limit": 3, "rate": 1}}
+
+
+def units(sizes):
+    ''' Return units of work on one storage source
+        Keyword arguments:
+          sizes: unit sizes in MB
+        Returns:
+          List of unit dicts
+    '''
+    return [{"name": f"unit{idx}", "source": "/nrs", "bytes": size * 1024 * 1024}
+            for idx, size in enumerate(sizes)]
+
+
+def test_schedule_balances_bytes():
+    ''' Units go largest first to the least-loaded lane
+    '''
+    plan = batch_lib.schedule(units([5, 4, 3, 3, 2, 1]), SOURCES)["/nrs"]
+    assert [[unit["name"] for unit in lane] for lane in plan["lanes"]] \
+           == [["unit0", "unit5"], ["unit1", "unit4"], ["unit2", "unit3"]]
+    assert plan["seconds"] == 6
+
+
+def test_schedule_spreads_ties():
+    ''' Equally loaded lanes take turns, so empty units are not all put in one lane
+    '''
+    plan = batch_lib.schedule(units([0] * 7), SOURCES)["/nrs"]
+    assert [len(lane) for lane in plan["lanes"]] == [3, 2, 2]
@@ -0,0 +1,96 @@
+''' Run a generated cluster script against a fake bsub and check its job graph
+'''
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import generate_upload_script as gus # pylint: disable=C0413
+
+SAMPLE = "2023-05-10"
+BSUB = '''#!{python}
+import json
+import sys
+with open({log!r}, "a", encoding="utf8") as outfile:
+    outfile.write(json.dumps(sys.argv[1:]) + "\\n")
+'''
+
+
+def submitted(log):
+    ''' Return the jobs a fake bsub was called with
+        Keyword arguments:
+          log: fake bsub log
+        Returns:
+          List of (name, dependency expression, command) tuples, in submission order
+    '''
+    jobs = []
+    with open(log, encoding="utf8") as infile:
+        for line in infile:
+            args = json.loads(line)
+            opts = dict(zip(args[:-1:2], args[1:-1:2]))
+            jobs.append((opts["-J"], opts.get("-w", ""), args[-1]))
+    return jobs
+
+
+def test_cluster_job_graph(tmp_path, monkeypatch):
+    ''' The metadata job waits for every tracings job, and the barrier for every job
+    '''
+    base = tmp_path / "base"
+    for sub in ["registration/Database", "shared_tracing/Finished_Neurons",
+                "tracing_complete"]:
+        (base / sub / SAMPLE).mkdir(parents=True)
+        (base / sub / SAMPLE / "file.swc").write_text("1 1 0 0 0 1 -1\n")
+    fake = tmp_path / "fakebin"
+    fake.mkdir()
+    log = tmp_path / "bsub.log"
+    (fake / "bsub").write_text(BSUB.format(python=sys.executable, log=str(log)))
+    (fake / "bsub").chmod(0o755)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gus, "BASE", str(base))
+    monkeypatch.setattr(gus, "JOBS", {})
+    monkeypatch.setattr(gus, "LOGGER", logging.getLogger(), raising=False)
+    monkeypatch.setattr(gus, "ARG", argparse.Namespace(
+        SAMPLE=SAMPLE, SHARDS=1, SLOTS=4, SCAN_WORKERS=2, EXECUTE=False,
+        REFRESH_METADATA=True, BARRIER=True), raising=False)
+    scripts = gus.plan_sample(["registration", "tracings"])
+    env = dict(os.environ, PATH=f"{fake}{os.pathsep}{os.environ['PATH']}")
+    subprocess.run(["sh", scripts["cluster"]], env=env, check=True, capture_output=True)
+    jobs = submitted(log)
+    names = [name for name, _, _ in jobs]
+    assert names == ["reg0510", "tra0510-1", "tra0510-2", "meta0510", "done0510"]
+    for idx, (_, wait, _) in enumerate(jobs):
+        # LSF needs a job to exist before another can depend on it
+        for dep in names[idx:]:
+            assert f"done({dep})" not in wait
+    graph = {name: (wait, command) for name, wait, command in jobs}
+    assert graph["reg0510"][0] == graph["tra0510-1"][0] == graph["tra0510-2"][0] == ""
+    assert graph["meta0510"][0] == "done(tra0510-1) && done(tra0510-2)"
+    assert "--write --incremental --refresh-mapping" in graph["meta0510"][1]
+    assert graph["done0510"][0] == " && ".join(f"done({name})" for name in names[:-1])
+
+
+def test_batch_job_names(tmp_path, monkeypatch):
+    ''' In batch mode, job names include the year, so samples from different years
+        do not collide
+    '''
+    base = tmp_path / "base"
+    for sample in (SAMPLE, "2024-05-10"):
+        (base / "registration/Database" / sample).mkdir(parents=True)
+        (base / "registration/Database" / sample / "file.txt").write_text("x")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gus, "BASE", str(base))
+    monkeypatch.setattr(gus, "JOBS", {})
+    monkeypatch.setattr(gus, "JOB_GROUP", "/mouselight/uploads/groups")
+    monkeypatch.setattr(gus, "LOGGER", logging.getLogger(), raising=False)
+    names = []
+    for sample in (SAMPLE, "2024-05-10"):
+        monkeypatch.setattr(gus, "ARG", argparse.Namespace(
+            SAMPLE=sample, SHARDS=1, SLOTS=4, SCAN_WORKERS=2, EXECUTE=False,
+            REFRESH_METADATA=True, BARRIER=True), raising=False)
+        gus.JOBS.clear()
+        gus.plan_sample(["registration"])
+        names.extend(gus.JOBS)
+    assert names == ["reg20230510", "done20230510", "reg20240510", "done20240510"]
@@ -0,0 +1,194 @@
+''' Tests for upload_lib transfers, against an in-process moto S3
+'''
+
+import os
+import sys
+import boto3
+from moto import mock_aws
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import aws_s3_lib # pylint: disable=C0413
+from metrics_lib import Metrics # pylint: disable=C0413
+import upload_lib # pylint: disable=C0413
+from upload_lib import Transfer, TransferJournal, UploadManifest # pylint: disable=C0413
+
+BUCKET = "upload-test"
+MB = upload_lib.MB
+# Smallest part size S3 accepts
+CHUNK = 5
+
+
+@pytest.fixture(name="s3")
+def fixture_s3(monkeypatch):
+    ''' Yield an S3 client for a moto bucket; upload_lib uses the same session, and
+        its API calls are counted in s3.metrics
+    '''
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        session = boto3.session.Session(region_name="us-east-1")
+        s3c = session.client("s3")
+        s3c.create_bucket(Bucket=BUCKET)
+        s3c.metrics = Metrics()
+        s3c.metrics.instrument(session)
+        monkeypatch.setattr(aws_s3_lib, "REGISTRY", aws_s3_lib.ClientRegistry(session))
+        yield s3c
+
+
+def write_tree(base):
+    ''' Create a directory to sync and a file to copy
+        Keyword arguments:
+          base: pathlib.Path to create them under
+        Returns:
+          Directory path, file path
+    '''
+    source = base / "sample"
+    (source / "sub").mkdir(parents=True)
+    (source / "a.swc").write_bytes(b"a" * 10)
+    (source / "sub" / "b.swc").write_bytes(b"b" * 20)
+    single = base / "image.tif"
+    single.write_bytes(b"i" * 30)
+    return str(source), str(single)
+
+
+def bucket_keys(s3c):
+    ''' Return the keys in the test bucket
+        Keyword arguments:
+          s3c: S3 client
+        Returns:
+          Sorted list of keys
+    '''
+    return sorted(obj["Key"] for obj in s3c.list_objects_v2(Bucket=BUCKET).get("Contents", []))
+
+
+def uploaded(s3c):
+    ''' Return the number of upload requests made since the counts were cleared
+        Keyword arguments:
+          s3c: S3 client
+        Returns:
+          Number of PutObject, CreateMultipartUpload and UploadPart calls
+    '''
+    return sum(s3c.metrics.calls.get(f"s3.{name}", 0)
+               for name in ("PutObject", "CreateMultipartUpload", "UploadPart"))
+
+
+@pytest.mark.parametrize("journaled", [False, True])
+def test_cp_sync_keys(s3, tmp_path, journaled):
+    ''' Keys are those "aws s3 cp" and "aws s3 sync" would write, with the transfer
+        manager and with journaled uploads
+    '''
+    source, single = write_tree(tmp_path)
+    transfers = [Transfer("sync", source, f"s3://{BUCKET}/tracings/sample"),
+                 Transfer("cp", single, f"s3://{BUCKET}/images/sample/"),
+                 Transfer("cp", single, f"s3://{BUCKET}/renamed.tif"),
+                 Transfer("cp", single, f"s3://{BUCKET}")]
+    journal = TransferJournal(str(tmp_path / "journal.jsonl")) if journaled else None
+    failed, _ = upload_lib.execute_transfers(transfers, chunk_size=CHUNK, journal=journal)
+    assert not failed
+    assert bucket_keys(s3) == ["image.tif", "images/sample/image.tif", "renamed.tif",
+                               "tracings/sample/a.swc", "tracings/sample/sub/b.swc"]
+
+
+@pytest.mark.parametrize("state", ["listing", "manifest", "journal"])
+def test_second_sync_uploads_nothing(s3, tmp_path, state):
+    ''' Unchanged files are not uploaded again, whether they are compared with a
+        listing, the manifest or the journal; a changed file is
+    '''
+    source, _ = write_tree(tmp_path)
+    transfers = [Transfer("sync", source, f"s3://{BUCKET}/tracings/sample/")]
+
+    def run():
+        manifest = UploadManifest(str(tmp_path / "manifest.db")) \
+                   if state == "manifest" else None
+        journal = TransferJournal(str(tmp_path / "journal.jsonl"), resume=True) \
+                  if state == "journal" else None
+        s3.metrics.calls.clear()
+        failed, _ = upload_lib.execute_transfers(transfers, chunk_size=CHUNK, manifest=manifest,
+                                                 journal=journal)
+        for store in (manifest, journal):
+            if store:
+                store.close()
+        assert not failed
+        return uploaded(s3)
+
+    assert run() == 2
+    assert run() == 0
+    with open(os.path.join(source, "a.swc"), "ab") as fhandle:
+        fhandle.write(b"more")
+    assert run() == 1
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_interrupted_multipart_resumes(s3, tmp_path, monkeypatch, staged):
+    ''' A multipart upload that failed part way is continued from the journal, and
+        only its missing part is uploaded, with and without read-ahead staging
+    '''
+    path = tmp_path / "stack.tif"
+    data = os.urandom(3 * CHUNK * MB + 1000)
+    path.write_bytes(data)
+    transfers = [Transfer("cp", str(path), f"s3://{BUCKET}/images/")]
+    put_part = upload_lib._put_part # pylint: disable=W0212
+
+    def flaky(client, upload, upload_id, number, *args, **kwargs):
+        if number == 3:
+            raise OSError("connection reset")
+        return put_part(client, upload, upload_id, number, *args, **kwargs)
+
+    def run():
+        journal = TransferJournal(str(tmp_path / "journal.jsonl"), resume=True)
+        readahead = upload_lib.ReadAhead(memory=2 * CHUNK * MB, readers=2) if staged else None
+        s3.metrics.calls.clear()
+        failed, _ = upload_lib.execute_transfers(transfers, chunk_size=CHUNK, journal=journal,
+                                                 readahead=readahead)
+        journal.close()
+        return failed
+
+    monkeypatch.setattr(upload_lib, "_put_part", flaky)
+    failed = run()
+    assert [name for name, _ in failed] == [str(path)]
+    assert s3.metrics.calls["s3.UploadPart"] == 3
+    assert "s3.CompleteMultipartUpload" not in s3.metrics.calls
+    monkeypatch.setattr(upload_lib, "_put_part", put_part)
+    assert not run()
+    assert s3.metrics.calls["s3.UploadPart"] == 1
+    assert "s3.CreateMultipartUpload" not in s3.metrics.calls
+    assert s3.metrics.calls["s3.CompleteMultipartUpload"] == 1
+    assert s3.get_object(Bucket=BUCKET, Key="images/stack.tif")["Body"].read() == data
+    # The completed file is committed in the journal
+    assert not run()
+    assert not uploaded(s3)
+
+
+def test_one_file_to_two_targets(s3, tmp_path, monkeypatch):
+    ''' Multipart uploads of one file to two keys are journaled and resumed
+        separately
+    '''
+    path = tmp_path / "stack.tif"
+    data = os.urandom(2 * CHUNK * MB + 1000)
+    path.write_bytes(data)
+    transfers = [Transfer("cp", str(path), f"s3://{BUCKET}/images/"),
+                 Transfer("cp", str(path), f"s3://{BUCKET}/backup/")]
+    put_part = upload_lib._put_part # pylint: disable=W0212
+
+    def flaky(client, upload, upload_id, number, *args, **kwargs):
+        if number == 2:
+            raise OSError("connection reset")
+        return put_part(client, upload, upload_id, number, *args, **kwargs)
+
+    def run():
+        journal = TransferJournal(str(tmp_path / "journal.jsonl"), resume=True)
+        s3.metrics.calls.clear()
+        failed, _ = upload_lib.execute_transfers(transfers, chunk_size=CHUNK, journal=journal)
+        journal.close()
+        return failed
+
+    monkeypatch.setattr(upload_lib, "_put_part", flaky)
+    assert len(run()) == 2
+    monkeypatch.setattr(upload_lib, "_put_part", put_part)
+    assert not run()
+    assert s3.metrics.calls["s3.UploadPart"] == 2
+    assert "s3.CreateMultipartUpload" not in s3.metrics.calls
+    for key in ("images/stack.tif", "backup/stack.tif"):
+        assert s3.get_object(Bucket=BUCKET, Key=key)["Body"].read() == data
+    assert not run()
+    assert not uploaded(s3)